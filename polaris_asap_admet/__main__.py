@@ -0,0 +1,3 @@
+from polaris_asap_admet.cli import main
+
+main()
@@ -0,0 +1,255 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import polars as pl
+import torch
+from chemprop import featurizers
+from chemprop.data import BatchMolGraph
+
+from polaris_asap_admet.conformers import shape_features
+from polaris_asap_admet.driver import SMILES_COL, descriptor_width, latest_models, load_model
+from polaris_asap_admet.features import N_FEATURES, _featurize_chunk
+from polaris_asap_admet.io import PARQUET_OPTIONS, migrate_csv
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.similarity import (TOP_K, _fingerprint_chunk, _open_index, index_for,
+                                           similarity_columns, train_paths_for)
+
+CHUNK_SIZE = 10_000  # molecules per chunk, i.e. per featurization task and per output part
+BATCH_SIZE = 512  # molecules per forward pass
+CHECKPOINT = "_checkpoint.json"
+
+
+def iter_chunks(
+    path: Path | str,
+    chunk_size: int = CHUNK_SIZE,
+    smiles_col: str = SMILES_COL,
+    id_col: str | None = None,
+    skip: int = 0,
+) -> Iterator[pl.DataFrame]:
+    """
+    Chunks of (CXSMILES[, id_col]) from a CSV, Parquet or .smi file, starting skip rows in, without
+    reading the whole file.  .smi files are "SMILES [name]" per line; the name becomes id_col ("name"),
+    and blank and "#" lines are ignored.
+    CSV chunks are only roughly chunk_size rows - polars' batched reader decides.
+    """
+    path = Path(path)
+    cols = [smiles_col] + ([id_col] if id_col else [])
+    if path.suffix == ".parquet":
+        n_rows = pl.scan_parquet(path).select(pl.len()).collect().item()
+        for offset in range(skip, n_rows, chunk_size):
+            yield (
+                pl.scan_parquet(path).select(cols).slice(offset, chunk_size).collect()
+                .rename({smiles_col: SMILES_COL})
+            )
+    elif path.suffix == ".csv":
+        reader = pl.read_csv_batched(
+            path, columns=cols, batch_size=chunk_size, skip_rows_after_header=skip
+        )
+        while batches := reader.next_batches(1):
+            yield batches[0].rename({smiles_col: SMILES_COL})
+    elif path.suffix in (".smi", ".smiles"):
+        with open(path) as f:
+            # blank and "#" comment lines aren't molecules, so skip counts molecules, like rows_done
+            lines = (line for line in f if line.strip() and not line.lstrip().startswith("#"))
+            smiles, names = [], []
+            for line in islice(lines, skip, None):
+                smi, *name = line.split(maxsplit=1)
+                smiles.append(smi)
+                names.append(name[0].strip() if name else None)
+                if len(smiles) == chunk_size:
+                    yield pl.DataFrame({SMILES_COL: smiles, id_col or "name": names})
+                    smiles, names = [], []
+            if smiles:
+                yield pl.DataFrame({SMILES_COL: smiles, id_col or "name": names})
+    else:
+        raise ValueError(f"Unsupported file format: {path}")
+
+
+def _featurize_for_prediction(
+    smiles: list[str | None], index_paths: dict[str, str] | None = None, k: int = TOP_K, shape: bool = False
+) -> tuple[np.ndarray, list, np.ndarray, dict[str, np.ndarray]]:
+    """
+    Molecule graphs and v1_rdkit_2d_normalized descriptors (then 3D shape descriptors, with shape) for a
+    chunk.  Runs in a worker process.  Returns the indices of the SMILES RDKit could parse, their graphs,
+    their descriptors, and the top-k Tanimoto similarities of every SMILES to each of index_paths' training sets.
+    """
+    from rdkit import Chem, RDLogger
+
+    RDLogger.DisableLog("rdApp.*")
+    featurizer = featurizers.SimpleMoleculeMolGraphFeaturizer()
+    valid, graphs = [], []
+    for i, smi in enumerate(smiles):
+        mol = Chem.MolFromSmiles(smi) if smi else None
+        if mol is None:
+            continue
+        valid.append(i)
+        graphs.append(featurizer(mol))
+    X_d = _featurize_chunk([smiles[i] for i in valid])
+    if shape:
+        X_d = np.hstack([X_d, shape_features([smiles[i] for i in valid])])
+    # descriptastorus gives NaN for some valid molecules (C[Se]C, organotins);
+    # MoleculeDatapoint zeroes those for training, driver.predict and the server, so do the same here
+    X_d = np.nan_to_num(X_d)
+    fps = _fingerprint_chunk(smiles) if index_paths else None
+    sims = {tgt: _open_index(path).query(fps, k)[0] for tgt, path in (index_paths or {}).items()}
+    return np.array(valid, dtype=np.int64), graphs, X_d, sims
+
+
+def _score(loaded: dict, graphs: list, X_d: np.ndarray, batch_size: int) -> dict[str, np.ndarray]:
+    preds = {tgt: np.empty(len(graphs), dtype=np.float32) for tgt in loaded}
+    with torch.inference_mode():
+        for start in range(0, len(graphs), batch_size):
+            end = start + batch_size
+            bmg = BatchMolGraph(graphs[start:end])
+            X = torch.from_numpy(X_d[start:end])
+            for tgt, (model, column) in loaded.items():
+                # models trained without shape descriptors just see the 2D columns
+                preds[tgt][start:end] = model(bmg, None, X[:, : descriptor_width(model)])[:, column].numpy()
+    return preds
+
+
+def read_checkpoint(output_dir: Path | str) -> dict | None:
+    path = Path(output_dir) / CHECKPOINT
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_checkpoint(output_dir: Path, checkpoint: dict) -> None:
+    tmp_path = output_dir / f"{CHECKPOINT}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, output_dir / CHECKPOINT)
+
+
+@stage("predict_library")
+def predict_library(
+    input_path: Path | str,
+    output_dir: Path | str,
+    model_paths: dict[str, Path | str] | None = None,
+    chunk_size: int = CHUNK_SIZE,
+    batch_size: int = BATCH_SIZE,
+    n_workers: int | None = None,
+    smiles_col: str = SMILES_COL,
+    id_col: str | None = None,
+    restart: bool = False,
+    similarity: bool = True,
+) -> Path:
+    """
+    Score a library of any size with every target's model, in bounded memory.
+
+    Chunks of input are featurized on a process pool, a few chunks ahead of the chunk being scored.
+    Each scored chunk becomes one Parquet file, output_dir/part-{n:05d}.parquet - read them all with
+    pl.scan_parquet(f"{output_dir}/*.parquet").  After every part, output_dir/_checkpoint.json records
+    how many input rows are done, so re-running the same command after a crash picks up where it left off.
+    restart throws the existing output away instead.
+
+    model_paths defaults to the newest best.pt per target under runs/.  With similarity, each target also
+    gets {target}_nn_similarity and {target}_knn_similarity columns against its combined training set,
+    where that's on disk (see similarity.nn_similarity).
+    """
+    input_path, output_dir = Path(input_path), Path(output_dir)
+    model_paths = {tgt: str(Path(p).resolve()) for tgt, p in (model_paths or latest_models()).items()}
+    if not model_paths:
+        raise ValueError("No models to predict with - train some first, or pass model_paths.")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Built (or found) here, once, so the workers only ever open them
+    index_paths = {
+        tgt: str(index_for(f).path)
+        for tgt in (model_paths if similarity else [])
+        for f in train_paths_for(tgt).values()
+        if migrate_csv(f) or f.exists()
+    }
+
+    checkpoint = None if restart else read_checkpoint(output_dir)
+    if checkpoint is not None:
+        if (
+            checkpoint["input"] != str(input_path.resolve())
+            or checkpoint["models"] != model_paths
+            or checkpoint.get("similarity", {}) != index_paths
+        ):
+            raise ValueError(
+                f"{output_dir} holds predictions for a different input, different models or training sets; "
+                "use another output_dir, or restart=True to overwrite."
+            )
+        if checkpoint["complete"]:
+            logger.info(f"{output_dir} is already complete ({checkpoint['rows_done']} rows).")
+            return output_dir
+        logger.info(f"Resuming {input_path} at row {checkpoint['rows_done']} (part {checkpoint['parts']}).")
+    else:
+        for old in output_dir.glob("part-*.parquet"):
+            old.unlink()
+        checkpoint = {
+            "input": str(input_path.resolve()),
+            "models": model_paths,
+            "similarity": index_paths,
+            "rows_done": 0,
+            "parts": 0,
+            "complete": False,
+        }
+
+    loaded = {tgt: load_model(path, tgt) for tgt, path in model_paths.items()}
+    targets = list(loaded)
+    shape = any(descriptor_width(model) > N_FEATURES for model, _ in loaded.values())
+    n_workers = max(1, n_workers or os.cpu_count() or 1)
+    chunks = iter_chunks(input_path, chunk_size, smiles_col, id_col, skip=checkpoint["rows_done"])
+    rows_at_start = checkpoint["rows_done"]
+    logger.info(f"Predicting {targets} for {input_path} in chunks of {chunk_size} on {n_workers} workers...")
+
+    # spawn, not fork:  polars' thread pool is already running
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+        # at most n_workers + 1 chunks in flight, so memory stays bounded however big the input is
+        pending = deque()
+
+        def fill():
+            while len(pending) <= n_workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                pending.append(
+                    (chunk, pool.submit(_featurize_for_prediction, chunk[SMILES_COL].to_list(), index_paths, TOP_K, shape))
+                )
+
+        fill()
+        while pending:
+            chunk, future = pending.popleft()
+            fill()
+            valid, graphs, X_d, sims = future.result()
+            preds = _score(loaded, graphs, X_d, batch_size)
+            is_valid = np.zeros(len(chunk), dtype=bool)
+            is_valid[valid] = True
+            columns = []
+            for tgt in targets:
+                values = np.full(len(chunk), np.nan, dtype=np.float32)
+                values[valid] = preds[tgt]
+                columns.append(pl.Series(tgt, values).fill_nan(None))
+            for tgt, tgt_sims in sims.items():
+                columns.extend(similarity_columns(tgt_sims, prefix=f"{tgt}_"))
+            df_out = chunk.with_columns(
+                *columns,
+                pl.when(pl.Series(is_valid)).then(None).otherwise(pl.lit("unparseable SMILES")).alias("error"),
+            )
+            part_path = output_dir / f"part-{checkpoint['parts']:05d}.parquet"
+            tmp_path = part_path.with_name(f"{part_path.name}.tmp")
+            df_out.write_parquet(tmp_path, **PARQUET_OPTIONS)
+            os.replace(tmp_path, part_path)
+            checkpoint["parts"] += 1
+            checkpoint["rows_done"] += len(chunk)
+            _write_checkpoint(output_dir, checkpoint)
+            logger.info(f"{checkpoint['rows_done']} rows done, {len(chunk) - len(valid)} unparseable in the last chunk.")
+
+    checkpoint["complete"] = True
+    _write_checkpoint(output_dir, checkpoint)
+    metrics = current_stage()
+    metrics.rows_in = metrics.rows_out = checkpoint["rows_done"] - rows_at_start
+    logger.info(f"Done. Wrote {checkpoint['rows_done']} rows of predictions to {output_dir}.")
+    return output_dir
@@ -0,0 +1,312 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from polaris_asap_admet import io
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import StageMetrics, stage
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+SEED = 0
+# Synthetic inputs are kept here between runs (they're deterministic); each run works in a fresh data dir next to them
+BENCH_DIR = Path(os.getenv("POLARIS_ASAP_ADMET_BENCH_DIR", Path(tempfile.gettempdir()) / "polaris_asap_admet_bench"))
+# One JSON line per (run, size, stage).  Relative to the working dir, like runs/ - meant to be committed.
+HISTORY_PATH = Path(os.getenv("POLARIS_ASAP_ADMET_BENCH_HISTORY", "benchmarks/history.jsonl"))
+# A stage regressed if it's this many times slower than the median of its last BASELINE_RUNS runs on this host...
+REGRESSION_THRESHOLD = float(os.getenv("POLARIS_ASAP_ADMET_BENCH_THRESHOLD", 1.25))
+# ...with these stages allowed more slack, since they're noisier
+THRESHOLDS = {"featurize": 1.5, "train_epoch": 1.5, "predict": 1.5}
+BASELINE_RUNS = 5
+MIN_REGRESSION_SECONDS = 0.1  # and at least this much slower; below it everything's noise
+# RDKit descriptors and training cost ~ms per molecule; past these many rows they're timed on a sample
+FEATURIZE_MAX_ROWS = 5_000
+TRAIN_MAX_ROWS = 5_000
+PREDICT_MAX_ROWS = 5_000
+REPLICATE_FRACTION = 0.05  # rows that repeat another row's SMILES, so dedup has something to do
+
+# Enumeration space for synthetic molecules:  a ring with two substituents and a linker to a second ring
+# with two more.  Ring-closure digits are 1 (first ring), 2 (second ring), 3 (rings inside substituents),
+# so any combination is a valid SMILES.  ~2e8 combinations.
+CORES = ["c1c{0}cc{1}c{2}c1", "c1c{0}nc{1}c{2}c1", "c1{0}nc{1}ncc1{2}", "C1C{0}CC{1}C{2}C1",
+         "C1C{0}NC{1}C{2}C1", "c1c{0}sc{1}c1{2}", "c1c{0}oc{1}c1{2}", "C1C{0}OC{1}C{2}C1"]
+TAILS = ["c2cc{0}cc{1}c2", "c2cc{0}ncc2{1}", "c2nc{0}ncc2{1}", "C2CC{0}CC2{1}",
+         "C2CN{0}CC2{1}", "c2cc{0}sc2{1}", "c2cc{0}oc2{1}", "C2COC{0}C2{1}"]
+SUBSTITUENTS = ["", "C", "CC", "F", "Cl", "Br", "O", "OC", "N", "N(C)C", "C(F)(F)F", "C#N", "C(=O)O",
+                "C(=O)N", "S(=O)(=O)C", "c3ccccc3", "C3CC3", "OCC", "C(C)C", "N3CCOCC3", "OC(F)(F)F",
+                "C(=O)OC", "NC(=O)C", "CO", "CN"]
+LINKERS = ["", "C", "CC", "O", "N", "C(=O)N", "NC(=O)", "S(=O)(=O)N", "OC"]
+
+
+def synthetic_smiles(n: int, seed: int = SEED) -> pl.Series:
+    """
+    n valid SMILES, enumerated from CORES/TAILS/SUBSTITUENTS/LINKERS by a seeded random draw.
+    Some are spelled differently but are the same molecule, as in real data.
+    """
+    rng = np.random.default_rng(seed)
+
+    def pick(options: list[str], branch: bool = False) -> pl.Series:
+        values = [f"({s})" if branch and s else s for s in options]
+        return pl.Series(values).gather(rng.integers(0, len(options), n))
+
+    df = pl.DataFrame(
+        {
+            "core": pick(CORES), "a": pick(SUBSTITUENTS, True), "b": pick(SUBSTITUENTS, True),
+            "linker": pick(LINKERS), "tail": pick(TAILS), "d": pick(SUBSTITUENTS, True), "e": pick(SUBSTITUENTS, True),
+        }
+    )
+    # str.format, vectorized:  fill the tail's slots, then the core's, with the linker + tail as the core's third
+    tail = pl.col("tail").str.replace("{0}", pl.col("d"), literal=True).str.replace("{1}", pl.col("e"), literal=True)
+    third = pl.concat_str(pl.lit("("), pl.col("linker"), tail, pl.lit(")"))
+    smiles = (
+        pl.col("core")
+        .str.replace("{0}", pl.col("a"), literal=True)
+        .str.replace("{1}", pl.col("b"), literal=True)
+        .str.replace("{2}", third, literal=True)
+    )
+    return df.select(smiles.alias("smiles"))["smiles"]
+
+
+def _values(rng: np.random.Generator, n: int, mean: float, std: float, null_fraction: float) -> np.ndarray:
+    values = rng.normal(mean, std, n)
+    values[rng.random(n) < null_fraction] = np.nan
+    return values
+
+
+def write_synthetic_raw(n: int, seed: int = SEED) -> None:
+    """
+    Synthetic stand-ins for every raw source, written where the real ones live in the current data dir:
+    n rows of computational ADME, n // 4 of TDC lipophilicity and n // 10 of ASAP train.  Column names,
+    types and rough value ranges match the real files; REPLICATE_FRACTION of rows repeat an earlier molecule.
+    """
+    rng = np.random.default_rng(seed)
+    n_tdc, n_asap = max(n // 4, 10), max(n // 10, 10)
+    smiles = synthetic_smiles(n + n_tdc + n_asap, seed)
+    replicates = rng.random(len(smiles)) < REPLICATE_FRACTION
+    smiles = smiles.scatter(
+        np.flatnonzero(replicates), smiles.gather(rng.integers(0, len(smiles), replicates.sum()))
+    )
+
+    df_adme = pl.DataFrame(
+        {
+            "SMILES": smiles[:n],
+            "LOG HLM_CLint (mL/min/kg)": _values(rng, n, 1.3, 0.6, 0.3),
+            "LOG SOLUBILITY PH 6.8 (ug/mL)": _values(rng, n, 1.4, 0.7, 0.05),
+            "LOG MDR1-MDCK ER (B-A/A-B)": np.abs(_values(rng, n, 0.5, 0.5, 0.2)) + 0.01,
+            "LOG RLM_CLint (mL/min/kg)": _values(rng, n, 1.8, 0.6, 0.3),
+        }
+    ).fill_nan(None)
+    df_tdc = pl.DataFrame({"Drug": smiles[n : n + n_tdc], "Y": _values(rng, n_tdc, 2.2, 1.2, 0.0)})
+    df_asap = pl.DataFrame(
+        {
+            "CXSMILES": smiles[n + n_tdc :],
+            "HLM": np.exp(_values(rng, n_asap, 3.0, 1.0, 0.4)),
+            "KSOL": np.exp(_values(rng, n_asap, 4.0, 1.2, 0.4)),
+            "LogD": _values(rng, n_asap, 2.0, 1.2, 0.4),
+            "MDR1-MDCKII": np.exp(_values(rng, n_asap, 2.0, 1.0, 0.4)),
+            "MLM": np.exp(_values(rng, n_asap, 4.0, 1.0, 0.4)),
+        }
+    ).fill_nan(None)
+    for ds, df in [(io.computational_adme_raw, df_adme), (io.tdc_lipophilicity_az_raw, df_tdc), (io.asap_train_raw, df_asap)]:
+        ds.filepath.parent.mkdir(parents=True, exist_ok=True)
+        df.write_parquet(ds.filepath, **io.PARQUET_OPTIONS)
+
+
+def _use_data_dir(home: Path) -> None:
+    """
+    Point every dataset, the molecule cache and the feature store at home/data, for the rest of this process.
+    """
+    os.environ["POLARIS_ASAP_ADMET_HOME"] = str(home)
+    io.data_dir.cache_clear()
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def bench_size(n: int, seed: int = SEED) -> list[StageMetrics]:
+    """
+    Time every stage on synthetic data with n computational ADME rows, in a fresh data dir
+    (so the molecule cache and feature store start cold).  Returns one StageMetrics per stage.
+    """
+    from polaris_asap_admet.driver import TrainConfig, load_datapoints, make_dataset, predict, train
+    from polaris_asap_admet.features import feature_store
+    from polaris_asap_admet.sources import SOURCES, TARGETS, collapse_replicates, compile_source, dedup_keys
+
+    inputs, home = BENCH_DIR / f"inputs_{n}", BENCH_DIR / f"home_{n}"
+    _use_data_dir(inputs)
+    if not io.computational_adme_raw.filepath.exists():
+        logger.info(f"Generating synthetic inputs for n={n} in {inputs}...")
+        write_synthetic_raw(n, seed)
+    shutil.rmtree(home, ignore_errors=True)
+    shutil.copytree(inputs, home)
+    _use_data_dir(home)
+    os.chdir(home)  # train() writes to runs/
+
+    results = []
+
+    def run(name: str, fn, rows: int | None = None):
+        with stage(f"bench_{name}", size=n) as m:
+            out = fn()
+            # rows processed, whatever the stage itself says it read and wrote
+            m.rows_in = m.rows_out = rows if rows is not None else len(out)
+        results.append(m)
+        return out
+
+    df_adme = run("dataset_read", io.computational_adme_raw.read)
+    copy = io.NamedDataset("bench_copy", io.DIRTY / "bench_copy.parquet")
+    run("dataset_save", lambda: copy.save(df_adme), len(df_adme))
+    wide = [run(f"compile_source_{src.name}", lambda src=src: compile_source(src).collect()) for src in SOURCES]
+    all_smiles = pl.concat([df["CXSMILES"] for df in wide])
+    df_keys = run("dedup_keys", lambda: dedup_keys(all_smiles), len(all_smiles))
+    combined = {}
+    for tgt in TARGETS:
+        df = pl.concat(
+            [
+                df.select("CXSMILES", tgt, pl.lit(src.name).alias("_source"), pl.lit(src.preferred).alias("_preferred"))
+                .filter(pl.col(tgt).is_not_null())
+                for src, df in zip(SOURCES, wide)
+                if tgt in src.targets
+            ]
+        )
+        combined[tgt] = run(f"collapse_replicates_{tgt}", lambda df=df, tgt=tgt: collapse_replicates(df, tgt, df_keys)[0], len(df))
+
+    df_hlm = combined["HLM"].head(TRAIN_MAX_ROWS)
+    smiles = df_hlm["CXSMILES"].head(FEATURIZE_MAX_ROWS)
+    run("featurize", lambda: feature_store.update(smiles), len(smiles))
+    config = TrainConfig(epochs=1, num_workers=0, accelerator="cpu")
+    result = run("train_epoch", lambda: train(df_hlm, ["HLM"], Path("runs") / "bench", config), len(df_hlm))
+    dset = make_dataset(load_datapoints(df_hlm.head(PREDICT_MAX_ROWS).select("CXSMILES")))
+    run("predict", lambda: predict(result.model, dset, config), len(dset))
+    return results
+
+
+def load_history(path: Path | str = HISTORY_PATH) -> pl.DataFrame:
+    path = Path(path)
+    if not path.exists() or path.stat().st_size == 0:
+        return pl.DataFrame()
+    return pl.read_ndjson(path)
+
+
+def check_regressions(df_run: pl.DataFrame, df_history: pl.DataFrame) -> pl.DataFrame:
+    """
+    df_run's stages against the median wall time of their last BASELINE_RUNS runs on this host.
+    Adds baseline, ratio, threshold and regressed columns.
+    """
+    if df_history.is_empty():
+        return df_run.with_columns(
+            baseline=pl.lit(None, pl.Float64), ratio=pl.lit(None, pl.Float64),
+            threshold=pl.lit(None, pl.Float64), regressed=pl.lit(False),
+        )
+    df_baseline = (
+        df_history.filter(pl.col("host") == platform.node())
+        .sort("timestamp")
+        .group_by("stage", "size")
+        .agg(pl.col("wall_time").tail(BASELINE_RUNS).median().alias("baseline"))
+    )
+    threshold = pl.col("stage").replace_strict(THRESHOLDS, default=REGRESSION_THRESHOLD, return_dtype=pl.Float64)
+    return (
+        df_run.join(df_baseline, on=["stage", "size"], how="left")
+        .with_columns(ratio=pl.col("wall_time") / pl.col("baseline"), threshold=threshold)
+        .with_columns(
+            regressed=(
+                (pl.col("ratio") > pl.col("threshold"))
+                & (pl.col("wall_time") - pl.col("baseline") > MIN_REGRESSION_SECONDS)
+            ).fill_null(False)
+        )
+    )
+
+
+def scaling_exponents(df_run: pl.DataFrame) -> dict[str, float]:
+    """
+    Per stage, the slope of log(wall time) against log(rows) across sizes:  1 is linear, 2 quadratic.
+    """
+    out = {}
+    for (name,), df in df_run.filter(pl.col("wall_time") > 0, pl.col("rows") > 0).group_by("stage"):
+        # featurize/train/predict are capped, so at big sizes their rows stop growing
+        if df["rows"].n_unique() >= 2:
+            slope = np.polyfit(np.log(df["rows"].to_numpy()), np.log(df["wall_time"].to_numpy()), 1)[0]
+            out[name] = round(float(slope), 2)
+    return out
+
+
+def run_benchmarks(sizes: list[int] | None = None, seed: int = SEED, fail_on_regression: bool = True) -> pl.DataFrame:
+    """
+    Benchmark every stage at each size, append the results to HISTORY_PATH, and compare against history.
+
+    Stages:  NamedDataset read/save, each source's conversion query (compile_source), dedup keys, each
+    target's replicate collapse (what used to be split/convert/combine), featurization, one CPU training
+    epoch and prediction.  The last three run on at most FEATURIZE/TRAIN/PREDICT_MAX_ROWS rows, so compare
+    their rows_per_second across sizes rather than wall time.  Raises if any stage regressed.
+    """
+    sizes = sizes or SIZES
+    history_path = HISTORY_PATH.resolve()  # bench_size changes directory
+    cwd, home = Path.cwd(), os.environ.get("POLARIS_ASAP_ADMET_HOME")
+    run_info = {
+        "run_id": datetime.now().strftime("%Y%m%d_%H%M%S"),
+        "timestamp": datetime.now().isoformat(),
+        "commit": _git_commit(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+    }
+    records = []
+    try:
+        for n in sizes:
+            logger.info(f"Benchmarking n={n}...")
+            for m in bench_size(n, seed):
+                rows = m.rows_out if m.rows_out is not None else m.rows_in
+                records.append(
+                    {
+                        **run_info,
+                        "size": n,
+                        "stage": m.stage.removeprefix("bench_"),
+                        "wall_time": m.wall_time,
+                        "cpu_time": m.cpu_time,
+                        "peak_rss_mb": m.peak_rss_mb,
+                        "rows": rows,
+                        "rows_per_second": rows / m.wall_time if rows and m.wall_time else None,
+                        "ok": m.ok,
+                    }
+                )
+    finally:
+        os.chdir(cwd)
+        if home is None:
+            os.environ.pop("POLARIS_ASAP_ADMET_HOME", None)
+        else:
+            os.environ["POLARIS_ASAP_ADMET_HOME"] = home
+        io.data_dir.cache_clear()
+
+    df_run = pl.DataFrame(records)
+    df = check_regressions(df_run, load_history(history_path))
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        print(
+            df.select("size", "stage", "wall_time", "rows", "rows_per_second", "peak_rss_mb", "baseline", "ratio", "regressed")
+            .sort("stage", "size")
+        )
+    logger.info(f"Scaling exponents (log wall time vs log rows): {scaling_exponents(df_run)}")
+    logger.info(f"Appended {len(records)} results to {history_path}.")
+    regressed = df.filter("regressed")
+    if len(regressed) and fail_on_regression:
+        raise RuntimeError(
+            "Benchmark regressions: "
+            + ", ".join(f"{r['stage']}@{r['size']} {r['ratio']:.2f}x" for r in regressed.iter_rows(named=True))
+        )
+    return df
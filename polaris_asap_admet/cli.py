@@ -0,0 +1,166 @@
+import argparse
+import importlib
+import os
+import sys
+import time
+
+# Everything the Makefile runs, as stage name -> ("module:attribute", kwargs, help).
+# Strings rather than functions, so `--help` doesn't import polars/torch/rdkit/polaris - each stage
+# imports what it needs when it runs.  Keep this module stdlib-only at the top level.
+STAGES = {
+    "download": ("polaris_asap_admet.download:download", {}, "every source below, concurrently; skips what's current"),
+    "download-computational-adme": ("polaris_asap_admet.download:download_computational_adme", {}, "Computational-ADME CSV, resumable"),
+    "download-comp-data": ("polaris_asap_admet.download:download_comp_data", {}, "ASAP competition train/test sets from the Polaris hub"),
+    "download-tdc-lipo-az": ("polaris_asap_admet.download:make_tdc_lipo_az", {}, "TDC AstraZeneca lipophilicity from the Polaris hub"),
+    "populate-mirror": ("polaris_asap_admet.download:populate_mirror", {}, "copy raw downloads to $POLARIS_ASAP_ADMET_MIRROR"),
+    "prep-data": ("polaris_asap_admet.sources:build_training_sets", {}, "all five combined training sets, one pass per source"),
+    "prep-data-debug": ("polaris_asap_admet.sources:build_training_sets", {"debug": True}, "same, also writing each source's endpoints to dirty/"),
+    "prep-data-hlm": ("polaris_asap_admet.sources:build_training_sets", {"targets": ["HLM"]}, "combined HLM training set"),
+    "prep-data-ksol": ("polaris_asap_admet.sources:build_training_sets", {"targets": ["KSOL"]}, "combined KSOL training set"),
+    "prep-data-logd": ("polaris_asap_admet.sources:build_training_sets", {"targets": ["LogD"]}, "combined LogD training set"),
+    "prep-data-mdr1": ("polaris_asap_admet.sources:build_training_sets", {"targets": ["MDR1-MDCKII"]}, "combined MDR1-MDCKII training set"),
+    "prep-data-mlm": ("polaris_asap_admet.sources:build_training_sets", {"targets": ["MLM"]}, "combined MLM training set"),
+    "prep-data-multitask": ("polaris_asap_admet.multitask:make_multitask_train", {}, "wide table over all five targets"),
+    "featurize": ("polaris_asap_admet.features:featurize", {}, "warm the descriptor feature store"),
+    "splits": ("polaris_asap_admet.splits:make_splits", {}, "cluster every training set into train/val/test once"),
+    "conformers": ("polaris_asap_admet.conformers:embed_conformers", {}, "3D conformers and shape descriptors for shape_descriptors runs, resumably"),
+    "pipeline": ("polaris_asap_admet.pipeline:run_pipeline", {}, "rebuild whatever's stale"),
+    "pipeline-dry-run": ("polaris_asap_admet.pipeline:run_pipeline", {"dry_run": True}, "show what's stale and why"),
+    "run-parallel": ("polaris_asap_admet.scheduler:run_parallel", {}, "per-target runs as parallel subprocesses"),
+    "run-all": ("polaris_asap_admet.driver:run_all", {}, "per-target runs in this process"),
+    "run-multitask": ("polaris_asap_admet.multitask:run_multitask", {}, "one multi-task model"),
+    "benchmark-multitask": ("polaris_asap_admet.multitask:benchmark_multitask", {}, "per-target vs multi-task"),
+    "benchmark-ensemble": ("polaris_asap_admet.ensemble:benchmark_ensemble_scaling", {}, "HLM ensemble wall time vs worker count"),
+    "serve": ("polaris_asap_admet.server:serve", {}, "all five latest models over HTTP (or $POLARIS_ASAP_ADMET_SERVE_SOCKET)"),
+    "stage-metrics": ("polaris_asap_admet.metrics:summarize_metrics", {}, "latest cost of every instrumented stage"),
+    "export-tensorboard-logs": ("polaris_asap_admet.tensorboard_export:export_tensorboard_logs", {}, "runs/ event-file scalars into one Parquet table, incrementally"),
+    "model-cache": ("polaris_asap_admet.model_cache:model_cache.summarize", {}, "trained runs reusable by identical training runs"),
+    "gc-model-cache": ("polaris_asap_admet.model_cache:model_cache.gc", {}, "delete least recently used cached runs over $POLARIS_ASAP_ADMET_MODEL_CACHE_MAX_GB"),
+    "submission": ("polaris_asap_admet.submission:assemble_submission", {}, "every target's newest predictions in one file, by mol_id"),
+    "add-similarity": ("polaris_asap_admet.similarity:add_similarity_columns", {}, "nearest-training-molecule similarity for older runs/*_preds.csv"),
+    "clear-mol-cache": ("polaris_asap_admet.mol_cache:mol_cache.clear", {}, "delete the molecule cache"),
+    "benchmark-startup": ("polaris_asap_admet.cli:benchmark_startup", {}, "check --help stays under budget"),
+    "benchmark-logging": ("polaris_asap_admet.logger:benchmark_logging", {}, "check filtered-out log calls stay near free"),
+    "benchmark": ("polaris_asap_admet.benchmark:run_benchmarks", {}, "every stage on 1k-1M synthetic rows, vs history"),
+    "benchmark-quick": ("polaris_asap_admet.benchmark:run_benchmarks", {"sizes": [1_000, 10_000]}, "same, 1k and 10k rows only"),
+}
+
+# --help's cost on top of a bare `python -c pass`.  Interpreter + site startup alone varies from ~40 ms
+# to well over 150 ms between machines and venvs, so it isn't counted against us.
+STARTUP_BUDGET_MS = 50
+# Modules that cost 100s of ms to import, and that --help / importing io shouldn't need
+HEAVY_MODULES = ["chemprop", "lightning", "numpy", "pandas", "polaris", "polars", "rdkit", "torch"]
+# Modules that should be importable without POLARIS_ASAP_ADMET_HOME set, and without RDKit or polaris
+LIGHT_MODULES = [
+    "polaris_asap_admet.io",
+    "polaris_asap_admet.mol",
+    "polaris_asap_admet.download",
+    "polaris_asap_admet.sources",
+]
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="polaris-asap-admet",
+        description="Run one or more pipeline stages, in order, in one process.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="stages:\n"
+        + "\n".join(f"  {name:<26}{help_}" for name, (_, _, help_) in STAGES.items()),
+    )
+    parser.add_argument("stages", nargs="+", choices=list(STAGES), metavar="STAGE", help="see below")
+    return parser
+
+
+def resolve(target: str):
+    """
+    "module:attr.attr" -> the object, importing the module.
+    """
+    module, attr = target.split(":")
+    obj = importlib.import_module(module)
+    for part in attr.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = build_parser().parse_args(argv)
+
+    import polars as pl
+
+    from polaris_asap_admet.logger import logger
+
+    pl.Config(tbl_rows=500)
+    pl.Config(fmt_str_lengths=500)
+
+    for stage in args.stages:
+        target, kwargs, _ = STAGES[stage]
+        logger.info(f"Running {stage} ({target})...")
+        start = time.perf_counter()
+        resolve(target)(**kwargs)
+        logger.info(f"{stage} done in {time.perf_counter() - start:.1f}s.")
+
+
+def _imported_heavy_modules(code: str, env: dict | None = None) -> list[str]:
+    import subprocess
+
+    check = f"import sys\n{code}\nprint(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    out = subprocess.run(
+        [sys.executable, "-c", check], env=env, check=True, capture_output=True, text=True
+    )
+    return out.stdout.split()
+
+
+def _median_ms(cmd: list[str], n: int) -> tuple[float, list[float]]:
+    import statistics
+    import subprocess
+
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), times
+
+
+def benchmark_startup(n: int = 10, budget_ms: float = STARTUP_BUDGET_MS) -> float:
+    """
+    Median wall time of `polaris-asap-admet --help` over n fresh interpreters, less that of a bare
+    `python -c pass`, in ms.
+
+    Raises if that's over budget, if --help imports anything in HEAVY_MODULES, or if the
+    LIGHT_MODULES need POLARIS_ASAP_ADMET_HOME or pull in RDKit/polaris when imported.
+    """
+    import subprocess
+
+    baseline, _ = _median_ms([sys.executable, "-c", "pass"], n)
+    median, times = _median_ms([sys.executable, "-m", "polaris_asap_admet", "--help"], n)
+    overhead = median - baseline
+    print(
+        f"--help: median {median:.0f} ms, min {min(times):.0f} ms, max {max(times):.0f} ms over {n} runs; "
+        f"bare interpreter {baseline:.0f} ms, so {overhead:.0f} ms is ours (budget {budget_ms:.0f} ms)"
+    )
+
+    problems = []
+    if overhead > budget_ms:
+        problems.append(f"--help took {overhead:.0f} ms over a bare interpreter, over the {budget_ms:.0f} ms budget")
+    heavy = _imported_heavy_modules("from polaris_asap_admet import cli; cli.build_parser().format_help()")
+    if heavy:
+        problems.append(f"--help imports {heavy}")
+
+    env = {k: v for k, v in os.environ.items() if k != "POLARIS_ASAP_ADMET_HOME"}
+    try:
+        heavy = _imported_heavy_modules("\n".join(f"import {m}" for m in LIGHT_MODULES), env=env)
+    except subprocess.CalledProcessError as e:
+        problems.append(f"importing {LIGHT_MODULES} without POLARIS_ASAP_ADMET_HOME failed:\n{e.stderr}")
+    else:
+        heavy = [m for m in heavy if m in ("rdkit", "polaris", "torch", "chemprop")]
+        if heavy:
+            problems.append(f"importing {LIGHT_MODULES} imports {heavy}")
+
+    if problems:
+        raise RuntimeError("Startup benchmark failed: " + "; ".join(problems))
+    return overhead
+
+
+if __name__ == "__main__":
+    main()
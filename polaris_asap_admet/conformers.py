@@ -0,0 +1,271 @@
+import importlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from polaris_asap_admet.features import FEATURE_DIR
+from polaris_asap_admet.io import admet_train_combined, asap_test_raw, data_dir
+from polaris_asap_admet.logger import RateLimitedLogger, logger
+from polaris_asap_admet.metrics import stage
+from polaris_asap_admet.mol_cache import mol_cache
+
+FEATURIZER = "conformers_3d"
+N_CONFORMERS = 10  # ETKDG embeddings per molecule, before dedup
+EMBED_SEED = 0xF00D  # fixed, so a molecule's conformers (and descriptors) don't depend on when it was embedded
+EMBED_TIMEOUT = 60  # seconds per molecule; macrocycles and cages can take forever
+MMFF_ITERS = 200
+RMSD_THRESHOLD = 0.5  # Å, symmetry-corrected heavy-atom RMSD under which two conformers count as one
+# Per-conformer shape descriptors, as (RDKit module, function), averaged over a molecule's distinct conformers
+SHAPE_DESCRIPTORS = {
+    "pmi1": ("rdkit.Chem.rdMolDescriptors", "CalcPMI1"),
+    "pmi2": ("rdkit.Chem.rdMolDescriptors", "CalcPMI2"),
+    "pmi3": ("rdkit.Chem.rdMolDescriptors", "CalcPMI3"),
+    "npr1": ("rdkit.Chem.rdMolDescriptors", "CalcNPR1"),
+    "npr2": ("rdkit.Chem.rdMolDescriptors", "CalcNPR2"),
+    "radius_of_gyration": ("rdkit.Chem.rdMolDescriptors", "CalcRadiusOfGyration"),
+    "inertial_shape_factor": ("rdkit.Chem.rdMolDescriptors", "CalcInertialShapeFactor"),
+    "eccentricity": ("rdkit.Chem.rdMolDescriptors", "CalcEccentricity"),
+    "asphericity": ("rdkit.Chem.rdMolDescriptors", "CalcAsphericity"),
+    "spherocity_index": ("rdkit.Chem.rdMolDescriptors", "CalcSpherocityIndex"),
+    "pbf": ("rdkit.Chem.rdMolDescriptors", "CalcPBF"),
+}
+# What goes into X_d, in order:  how many distinct conformers, then each descriptor's mean and std over them
+FEATURE_COLUMNS = [
+    "n_conformers",
+    *(f"{name}_mean" for name in SHAPE_DESCRIPTORS),
+    *(f"{name}_std" for name in SHAPE_DESCRIPTORS),
+]
+N_SHAPE_FEATURES = len(FEATURE_COLUMNS)
+SCHEMA = {
+    "canonical_smiles": pl.String,
+    "n_conformers": pl.Int32,
+    **{col: pl.Float32 for col in FEATURE_COLUMNS[1:]},
+    "error": pl.String,
+}
+CHUNK_SIZE = 16  # molecules per task:  at ~0.1-1 s a molecule, small enough to keep every worker busy
+FLUSH_ROWS = 1024  # finished molecules written out as a new part this often, so an interrupted run keeps them
+MAX_PARTS = 64  # past this many parts, they're compacted into one
+per_molecule = RateLimitedLogger(per_second=1)
+
+
+def _distinct_conformers(mol, conf_ids: list[int]) -> list[int]:
+    """
+    Greedy dedup:  keep each conformer unless it's within RMSD_THRESHOLD of one already kept.
+    Heavy atoms only, symmetry-corrected and after superposition (spyrmsd), so a rotated methyl or a
+    flipped phenyl doesn't count as a new conformer.
+    """
+    from rdkit import Chem
+    from spyrmsd.rmsd import symmrmsd
+
+    heavy = Chem.RemoveHs(mol)
+    if heavy.GetNumAtoms() < 2:
+        return conf_ids[:1]
+    aprops = np.array([a.GetAtomicNum() for a in heavy.GetAtoms()])
+    am = Chem.GetAdjacencyMatrix(heavy)
+    kept, kept_coords = [], []
+    for cid in conf_ids:
+        coords = heavy.GetConformer(cid).GetPositions()
+        # cache=True:  the graph isomorphisms are worked out once per molecule, not once per pair
+        if kept_coords and min(symmrmsd(coords, kept_coords, aprops, aprops, am, am, minimize=True, cache=True)) < RMSD_THRESHOLD:
+            continue
+        kept.append(cid)
+        kept_coords.append(coords)
+    return kept
+
+
+def _embed_chunk(smiles: list[str]) -> dict[str, list]:
+    """
+    Embed, optimize and dedup conformers for a chunk of canonical SMILES, and compute SHAPE_DESCRIPTORS
+    over the distinct ones.  Runs in a worker process.  Failures are recorded per row in "error", with
+    n_conformers 0 and NaN descriptors.
+    """
+    from rdkit import Chem, RDLogger
+    from rdkit.Chem import rdDistGeom, rdForceFieldHelpers
+
+    RDLogger.DisableLog("rdApp.*")
+    descriptors = {
+        name: getattr(importlib.import_module(module), fn) for name, (module, fn) in SHAPE_DESCRIPTORS.items()
+    }
+    params = rdDistGeom.ETKDGv3()
+    params.randomSeed = EMBED_SEED
+    params.numThreads = 1  # the pool is the parallelism
+    params.timeout = EMBED_TIMEOUT
+    out = {k: [] for k in SCHEMA}
+    for smi in smiles:
+        row = {"canonical_smiles": smi, "n_conformers": 0, "error": None}
+        try:
+            mol = Chem.AddHs(Chem.MolFromSmiles(smi))
+            conf_ids = list(rdDistGeom.EmbedMultipleConfs(mol, N_CONFORMERS, params))
+            if not conf_ids:
+                params.useRandomCoords = True
+                conf_ids = list(rdDistGeom.EmbedMultipleConfs(mol, N_CONFORMERS, params))
+                params.useRandomCoords = False
+            if not conf_ids:
+                raise ValueError("no conformers embedded")
+            if rdForceFieldHelpers.MMFFHasAllMoleculeParams(mol):
+                rdForceFieldHelpers.MMFFOptimizeMoleculeConfs(mol, numThreads=1, maxIters=MMFF_ITERS)
+            conf_ids = _distinct_conformers(mol, conf_ids)
+            values = np.array([[fn(mol, confId=cid) for fn in descriptors.values()] for cid in conf_ids])
+            row["n_conformers"] = len(conf_ids)
+            row.update(zip((f"{name}_mean" for name in descriptors), values.mean(axis=0)))
+            row.update(zip((f"{name}_std" for name in descriptors), values.std(axis=0)))
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+            per_molecule.debug("3D embedding of {!r} failed: {}", smi, row["error"])
+        for k in SCHEMA:
+            out[k].append(row.get(k))
+    return out
+
+
+def _canonical(smiles: list[str | None]) -> list[str | None]:
+    """
+    Canonical SMILES, as mol.process_smiles writes them, without going through the molecule cache.
+    """
+    from rdkit import Chem, RDLogger
+
+    RDLogger.DisableLog("rdApp.*")
+    mols = [Chem.MolFromSmiles(smi) if smi else None for smi in smiles]
+    return [Chem.MolToSmiles(mol) if mol is not None else None for mol in mols]
+
+
+def _to_matrix(df: pl.DataFrame) -> np.ndarray:
+    return df.select(pl.col(FEATURE_COLUMNS).cast(pl.Float32)).to_numpy()
+
+
+@dataclass
+class ConformerStore:
+    """
+    3D shape descriptors, computed once per molecule - embedding is the most expensive thing we do to a
+    molecule, so nothing is ever embedded twice.
+
+    Keyed by canonical SMILES, so the same structure written two ways shares a row.  Lives in
+    {root}/conformers_3d/ as Parquet parts, each written whole and renamed into place as a run goes along:
+    stop a run at any point and the next one only embeds what's left.  One writer at a time.
+    """
+
+    root: Path | None = None  # defaults to {data dir}/FEATURE_DIR
+
+    @property
+    def path(self) -> Path:
+        return Path(self.root or data_dir() / FEATURE_DIR) / FEATURIZER
+
+    def parts(self) -> list[Path]:
+        return sorted(self.path.glob("part-*.parquet"))
+
+    def scan(self) -> pl.LazyFrame:
+        parts = self.parts()
+        if not parts:
+            return pl.LazyFrame(schema=SCHEMA)
+        return pl.scan_parquet(parts)
+
+    def _write_part(self, frames: list[pl.DataFrame]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        name = f"part-{time.time_ns()}-{os.getpid()}.parquet"
+        tmp_path = self.path / f"{name}.tmp"
+        pl.concat(frames).write_parquet(tmp_path)
+        os.replace(tmp_path, self.path / name)
+
+    def _compact(self) -> None:
+        parts = self.parts()
+        df_all = pl.read_parquet(parts).unique("canonical_smiles", keep="first", maintain_order=True)
+        self._write_part([df_all])
+        for part in parts:
+            part.unlink()
+        logger.info(f"Compacted {len(parts)} conformer store parts into one ({len(df_all)} molecules).")
+
+    def update(self, smiles: pl.Series, n_workers: int | None = None) -> pl.Series:
+        """
+        Embed any molecules in smiles that aren't in the store yet.  Returns their canonical SMILES
+        (null where unparseable), aligned with smiles.
+        """
+        canonical_all = mol_cache.lookup(smiles, n_workers=n_workers)["canonical_smiles"]
+        canonical = canonical_all.drop_nulls().unique()
+        done = self.scan().select("canonical_smiles").collect()["canonical_smiles"]
+        todo = canonical.filter(~canonical.is_in(done)).sort().to_list()
+        logger.info(f"Conformer store: {len(canonical) - len(todo)} hits, {len(todo)} to embed.")
+        if not todo:
+            return canonical_all
+
+        chunks = [todo[i : i + CHUNK_SIZE] for i in range(0, len(todo), CHUNK_SIZE)]
+        n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(chunks)))
+        logger.info(f"Embedding {len(todo)} molecules x {N_CONFORMERS} conformers on {n_workers} workers...")
+        buffer, n_done, n_failed = [], 0, 0
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+            futures = [pool.submit(_embed_chunk, chunk) for chunk in chunks]
+            try:
+                for future in as_completed(futures):
+                    df = pl.DataFrame(future.result(), schema=SCHEMA)
+                    buffer.append(df)
+                    n_done += len(df)
+                    n_failed += df["error"].is_not_null().sum()
+                    if sum(len(b) for b in buffer) >= FLUSH_ROWS:
+                        self._write_part(buffer)
+                        buffer = []
+                        logger.info(f"{n_done}/{len(todo)} embedded ({n_failed} failed).")
+            finally:
+                # Keep whatever finished, even on Ctrl-C
+                for future in futures:
+                    future.cancel()
+                if buffer:
+                    self._write_part(buffer)
+        if len(self.parts()) > MAX_PARTS:
+            self._compact()
+        logger.info(f"Done. Embedded {n_done} molecules, {n_failed} failed.")
+        return canonical_all
+
+    def lookup(self, canonical: list[str | None]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Features for whichever canonical SMILES are in the store already, without embedding or writing
+        anything.  Returns the matrix aligned with canonical (NaN rows for misses) and a boolean mask of hits.
+        """
+        df_query = pl.DataFrame({"canonical_smiles": canonical}, schema={"canonical_smiles": pl.String})
+        df_store = (
+            self.scan()
+            .join(df_query.lazy().unique(), on="canonical_smiles", how="semi")
+            .unique("canonical_smiles", keep="first")
+            .collect()
+        )
+        df = df_query.join(df_store, on="canonical_smiles", how="left", maintain_order="left")
+        return _to_matrix(df), df["n_conformers"].is_not_null().to_numpy()
+
+    def get(self, smiles: pl.Series, n_workers: int | None = None) -> np.ndarray:
+        """
+        X_d columns (FEATURE_COLUMNS) aligned with smiles, embedding whatever's missing first.
+        Molecules that couldn't be parsed or embedded are all zeros - n_conformers 0 tells the model.
+        """
+        return np.nan_to_num(self.lookup(self.update(smiles, n_workers=n_workers).to_list())[0])
+
+
+conformer_store = ConformerStore()
+
+
+def shape_features(smiles: list[str | None]) -> np.ndarray:
+    """
+    ConformerStore.get for a chunk of SMILES at prediction time:  from the store if they're there
+    (read-only), embedded on the spot if not.  Runs in a worker process, or the server.
+    """
+    canonical = _canonical(smiles)
+    X, found = conformer_store.lookup(canonical)
+    missing = [i for i, (smi, hit) in enumerate(zip(canonical, found)) if smi is not None and not hit]
+    if missing:
+        X[missing] = _to_matrix(pl.DataFrame(_embed_chunk([canonical[i] for i in missing]), schema=SCHEMA))
+    return np.nan_to_num(X)
+
+
+@stage("conformers")
+def embed_conformers(n_workers: int | None = None) -> None:
+    """
+    Warm the conformer store with every training set and the test set, in one go.  Resumable:  re-run it
+    after an interruption and it picks up where it stopped.
+    """
+    smiles = pl.concat(
+        [ds.read()["CXSMILES"] for ds in admet_train_combined.values()]
+        + [asap_test_raw.read()["CXSMILES"]]
+    )
+    conformer_store.update(smiles, n_workers=n_workers)
@@ -1,17 +1,237 @@
-import pandas as pd
-import polaris as po
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
 import polars as pl
-from polaris.competition import CompetitionSpecification
-from polaris.dataset import Dataset
 from typeguard import typechecked
 
-from polaris_asap_admet.io import (asap_test_raw, asap_train_clean,
-                                   asap_train_raw, tdc_lipophilicity_az_clean,
-                                   tdc_lipophilicity_az_raw)
+from polaris_asap_admet.io import (RAW, NamedDataset, asap_test_raw,
+                                   asap_train_raw, computational_adme_raw,
+                                   data_dir, file_hash, tdc_lipophilicity_az_raw)
 from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import record_write, stage
 from polaris_asap_admet.util import print_info
 
+# polaris takes seconds to import and only the hub downloads need it, so it's imported inside those
+if TYPE_CHECKING:
+    from polaris.competition import CompetitionSpecification
+    from polaris.dataset import Subset
+
 CHALLENGE = "antiviral-admet-2025"
+TDC_LIPO_AZ = "tdcommons/lipophilicity-astrazeneca"
+ADME_URL = "https://raw.githubusercontent.com/molecularinformatics/Computational-ADME/refs/heads/main/ADME_public_set_3521.csv"
+ADME_CSV = RAW / "ADME_public_set_3521.csv"  # relative to the data dir
+# Pin this to refuse anything else from ADME_URL.  Unpinned, downloads are checked against Content-Length only.
+ADME_SHA256: str | None = None
+
+# A directory holding copies of the raw files (see populate_mirror), used instead of the hub and
+# the network when set - e.g. on a cluster node with no internet, or to make CI reproducible.
+MIRROR_DIR = os.getenv("POLARIS_ASAP_ADMET_MIRROR")
+MIRROR_CHECKSUMS = "checksums.json"
+# What we fetched, from where, and its sha256 - so we can tell if a local file is still what we fetched
+LEDGER = RAW / "downloads.json"
+
+_ledger_lock = threading.Lock()
+
+####################################
+# Download bookkeeping
+####################################
+
+
+def read_ledger() -> dict:
+    path = data_dir() / LEDGER
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _record_download(path: Path, source: str, **extra) -> None:
+    """
+    Note in the ledger that path was just fetched from source.  Sources download on parallel threads.
+    """
+    with _ledger_lock:
+        ledger = read_ledger()
+        ledger[Path(path).name] = {
+            "source": source,
+            "sha256": file_hash(path),
+            "fetched_at": datetime.now().isoformat(),
+            **extra,
+        }
+        ledger_path = data_dir() / LEDGER
+        ledger_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = ledger_path.with_name(f"{ledger_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(ledger, f, indent=2)
+        os.replace(tmp_path, ledger_path)
+
+
+def is_intact(*datasets: NamedDataset) -> bool:
+    """
+    Whether every dataset exists and is byte-for-byte what we last wrote (per its manifest).
+    """
+    for ds in datasets:
+        manifest = ds.read_manifest()
+        if manifest is None or manifest["content_hash"] != file_hash(ds.filepath):
+            return False
+    return True
+
+
+def fetch_url(url: str, dest: Path | str, sha256: str | None = None, etag: str | None = None) -> tuple[bool, str | None]:
+    """
+    Download url to dest, resuming from {dest}.part if an earlier download was interrupted.
+
+    With the ETag of the last download and dest still there, the server gets to say nothing changed (304)
+    and nothing is downloaded.  A resumed download whose source changed in the meantime starts over.
+    Raises if the result is short, or doesn't match sha256 when given.  Returns (whether dest changed, ETag).
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part = dest.with_name(f"{dest.name}.part")
+    part_etag = dest.with_name(f"{dest.name}.part.etag")
+    headers = {}
+    offset = part.stat().st_size if part.exists() else 0
+    if offset and part_etag.exists():
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = part_etag.read_text()
+    elif etag and dest.exists():
+        headers["If-None-Match"] = etag
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=60)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logger.info(f"{url} hasn't changed since we last fetched it.")
+            return False, etag
+        if e.code == 416:  # the .part is already whole, or from a bigger version of the file
+            part.unlink()
+            return fetch_url(url, dest, sha256=sha256, etag=etag)
+        raise
+    with response:
+        new_etag = response.headers.get("ETag")
+        if response.status == 206:
+            logger.info(f"Resuming {url} at byte {offset}...")
+            total = int(response.headers["Content-Range"].split("/")[-1])
+            mode = "ab"
+        else:
+            logger.info(f"Downloading {url}...")
+            length = response.headers.get("Content-Length")
+            total = int(length) if length else None
+            mode = "wb"
+        if new_etag:
+            part_etag.write_text(new_etag)
+        with open(part, mode) as f:
+            shutil.copyfileobj(response, f, 1 << 20)
+    if total is not None and part.stat().st_size != total:
+        raise OSError(f"Download of {url} stopped at {part.stat().st_size} of {total} bytes; run again to resume.")
+    if sha256 is not None and file_hash(part) != sha256:
+        part.unlink()
+        raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, got something else.")
+    os.replace(part, dest)
+    part_etag.unlink(missing_ok=True)
+    return True, new_etag
+
+
+def _mirror_checksums(mirror: Path) -> dict:
+    path = mirror / MIRROR_CHECKSUMS
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def fetch_from_mirror(mirror: Path | str, dest: Path | str) -> bool:
+    """
+    Copy the file named like dest out of the mirror, verifying it against the mirror's checksums.json.
+    Returns whether dest changed - it doesn't if it already matches the mirror.
+    """
+    mirror, dest = Path(mirror), Path(dest)
+    src = mirror / dest.name
+    if not src.exists():
+        raise FileNotFoundError(f"{dest.name} isn't in the mirror at {mirror}.")
+    expected = _mirror_checksums(mirror).get(dest.name)
+    if expected is not None and dest.exists() and file_hash(dest) == expected:
+        logger.info(f"{dest} already matches the mirror.")
+        return False
+    logger.info(f"Copying {src} to {dest}...")
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = dest.with_name(f"{dest.name}.tmp")
+    shutil.copyfile(src, tmp_path)
+    if expected is not None and file_hash(tmp_path) != expected:
+        tmp_path.unlink()
+        raise ValueError(f"{src} doesn't match its checksum in {mirror / MIRROR_CHECKSUMS}.")
+    os.replace(tmp_path, dest)
+    _record_download(dest, f"mirror:{src}")
+    return True
+
+
+def _install_from_mirror(mirror: Path | str, ds: NamedDataset) -> bool:
+    changed = fetch_from_mirror(mirror, ds.filepath)
+    if changed or not is_intact(ds):
+        record_write(ds.filepath)
+        ds.write_manifest()
+    return changed
+
+
+@typechecked
+def populate_mirror(mirror: Path | str | None = MIRROR_DIR) -> Path:
+    """
+    Copy the raw files we've downloaded into mirror (POLARIS_ASAP_ADMET_MIRROR by default), with checksums.
+    """
+    if mirror is None:
+        raise ValueError("No mirror directory - pass one, or set POLARIS_ASAP_ADMET_MIRROR.")
+    mirror = Path(mirror)
+    mirror.mkdir(parents=True, exist_ok=True)
+    checksums = _mirror_checksums(mirror)
+    for path in [data_dir() / ADME_CSV, *(ds.filepath for ds in RAW_DATASETS)]:
+        if not path.exists():
+            logger.warning(f"{path} hasn't been downloaded; leaving it out of the mirror.")
+            continue
+        shutil.copyfile(path, mirror / path.name)
+        checksums[path.name] = file_hash(path)
+        logger.info(f"Mirrored {path.name}.")
+    with open(mirror / MIRROR_CHECKSUMS, "w") as f:
+        json.dump(checksums, f, indent=2)
+    return mirror
+
+
+####################################
+# Computational-ADME
+####################################
+
+
+@stage("download_computational_adme")
+def download_computational_adme(force: bool = False, mirror: Path | str | None = MIRROR_DIR) -> bool:
+    """
+    Fetch ADME_public_set_3521.csv and convert it to Parquet.  Cheap to re-run:  unless forced,
+    it's only re-downloaded if the server says it changed, and only re-converted if the CSV did.
+    """
+    csv_path = data_dir() / ADME_CSV
+    entry = read_ledger().get(ADME_CSV.name, {})
+    if force:
+        entry = {}
+    if mirror:
+        changed = fetch_from_mirror(mirror, csv_path)
+    else:
+        # an ETag is only worth sending if the CSV is still what it was fetched as
+        etag = entry.get("etag") if entry.get("sha256") == file_hash(csv_path) else None
+        changed, etag = fetch_url(ADME_URL, csv_path, sha256=ADME_SHA256, etag=etag)
+        if changed:
+            _record_download(csv_path, ADME_URL, etag=etag)
+    if not changed and is_intact(computational_adme_raw):
+        logger.info(f"{computational_adme_raw.name} is current.")
+        return False
+    computational_adme_raw.save(pl.read_csv(csv_path))
+    return True
+
 
 ####################################
 # Polaris competition downloads
@@ -25,27 +245,30 @@ def load_comp(challenge: str = CHALLENGE) -> CompetitionSpecification:
 
     Run `polaris login` before running this.
     """
+    import polaris as po
+
     logger.info(f"Loading competition for challenge {challenge}...")
     competition = po.load_competition(f"asap-discovery/{challenge}")
     logger.info("Done. Caching...")
-    # when you set this to "skip", polaris throws an exception I don't care to debug
-    # cache_dir = competition.cache(if_exists="skip")
-    cache_dir = competition.cache()
+    try:
+        cache_dir = competition.cache(if_exists="skip")
+    except Exception as e:
+        # some polaris versions choke on "skip" over a partial cache; a full re-cache fixes that
+        logger.warning(f"Re-caching from scratch, since skipping the existing cache failed: {e!r}")
+        cache_dir = competition.cache()
     logger.info(f"Cached data to {cache_dir}.")
     return competition
 
 
 @typechecked
-def get_df_train_for_comp(
-    comp: CompetitionSpecification, save: bool = False
-) -> pl.DataFrame:
+def get_df_train_for_comp(train: Subset, save: bool = False) -> pl.DataFrame:
     """
     Load training data as polars DataFrame
     Polaris has some dumbass bug where converting a competition subset to a dataframe fails, because polaris keeps adding duplicate columns to the DF?
     It doesn't make sense, I didn't dig into it, but this is the magic incantation that keeps that bug from manifesting.
     """
-    logger.info(f"Loading training dataframe for comp {comp.name}...")
-    df_train = pl.from_pandas(comp.get_train_test_split()[0].as_dataframe())
+    logger.info("Loading training dataframe...")
+    df_train = pl.from_pandas(train.as_dataframe())
     print_info(df_train)
     if save:
         logger.info("Saving...")
@@ -54,14 +277,9 @@ def get_df_train_for_comp(
 
 
 @typechecked
-def get_df_test_for_comp(
-    comp: CompetitionSpecification, save: bool = False
-) -> pl.DataFrame:
-    logger.info(f"Loading test data for comp {comp.name}...")
-
-    test = comp.get_train_test_split()[1]
-    d = {"CXSMILES": test.X}
-    df_test = pl.DataFrame(d)
+def get_df_test_for_comp(test: Subset, save: bool = False) -> pl.DataFrame:
+    logger.info("Loading test data...")
+    df_test = pl.DataFrame({"CXSMILES": test.X})
     print_info(df_test)
     if save:
         logger.info("Saving...")
@@ -69,35 +287,27 @@ def get_df_test_for_comp(
     return df_test
 
 
-def download_comp_data():
-    logger.info(f"Downloading competition data for challenge {CHALLENGE}...")
-    comp = load_comp()
-    df_train = get_df_train_for_comp(comp, save=True)
-    df_test = get_df_test_for_comp(comp, save=True)
-    logger.info("Done.")
-
-
-TARGETS = [
-    "HLM",
-    "KSOL",
-    "LogD",
-    "MDR1-MDCKII",
-    "MLM",
-]
-
-
-def split_train_by_targets():
+@stage("download_comp_data")
+def download_comp_data(force: bool = False, mirror: Path | str | None = MIRROR_DIR) -> bool:
     """
-    Create separate training datasets for each target.
+    The competition's train and test sets.  Skipped if we already have both, unless forced.
     """
-    df = asap_train_raw.read()
-    for tgt in TARGETS:
-        logger.info(f"Splitting training data for target {tgt}...")
-        df_tgt = df.select(["CXSMILES", tgt]).filter(pl.col(tgt).is_not_null())
-        print_info(df_tgt)
-        logger.info(f"Saving {tgt}...")
-        asap_train_clean[tgt].save(df_tgt)
+    if mirror:
+        changed = [_install_from_mirror(mirror, ds) for ds in (asap_train_raw, asap_test_raw)]
+        return any(changed)
+    if not force and is_intact(asap_train_raw, asap_test_raw):
+        logger.info("Competition data is already downloaded.")
+        return False
+    logger.info(f"Downloading competition data for challenge {CHALLENGE}...")
+    comp = load_comp()
+    # materializing the split is the slow part, so do it once for both
+    train, test = comp.get_train_test_split()
+    get_df_train_for_comp(train, save=True)
+    get_df_test_for_comp(test, save=True)
+    _record_download(asap_train_raw.filepath, f"polaris:asap-discovery/{CHALLENGE}")
+    _record_download(asap_test_raw.filepath, f"polaris:asap-discovery/{CHALLENGE}")
     logger.info("Done.")
+    return True
 
 
 ####################################
@@ -105,32 +315,78 @@ def split_train_by_targets():
 ####################################
 
 
-def get_tdc_lipo_az_raw(
-    ds_name: str = "tdcommons/lipophilicity-astrazeneca", save: bool = False
-) -> Dataset:
+def get_tdc_lipo_az_raw(ds_name: str = TDC_LIPO_AZ, save: bool = False) -> pl.DataFrame:
     """
     Fetch dataset from Polaris hub.
     """
+    import polaris as po
+
     dataset = po.load_dataset(ds_name)
-    df = pl.from_pandas(pd.DataFrame(dataset.table))
+    # dataset.table is already a pandas DataFrame
+    df = pl.from_pandas(dataset.table)
     print_info(df)
     if save:
         logger.info("Saving...")
         tdc_lipophilicity_az_raw.save(df)
+        _record_download(tdc_lipophilicity_az_raw.filepath, f"polaris:{ds_name}")
     return df
 
 
-def prep_tdc_lipo_az(df: pl.DataFrame, save: bool = False) -> pl.DataFrame:
+@stage("download_tdc_lipo_az")
+def make_tdc_lipo_az(force: bool = False, mirror: Path | str | None = MIRROR_DIR) -> bool:
     """
-    Prep the raw AZ dataset for use in our model training - rename columns, etc.
+    The raw AZ dataset.  Skipped if we already have it, unless forced.
+    sources.py maps its columns to ours (Drug -> CXSMILES, Y -> LogD).
     """
-    df = df.select(["Drug", "Y"]).rename({"Drug": "CXSMILES", "Y": "LogD"})
-    if save:
-        tdc_lipophilicity_az_clean.save(df)
-    return df
+    if mirror:
+        return _install_from_mirror(mirror, tdc_lipophilicity_az_raw)
+    if not force and is_intact(tdc_lipophilicity_az_raw):
+        logger.info("TDC lipophilicity data is already downloaded.")
+        return False
+    get_tdc_lipo_az_raw(TDC_LIPO_AZ, save=True)
+    return True
 
 
-def make_tdc_lipo_az(save: bool = True) -> pl.DataFrame:
-    df = get_tdc_lipo_az_raw("tdcommons/lipophilicity-astrazeneca", save=save)
-    df = prep_tdc_lipo_az(df, save=save)
-    return df
+####################################
+# Everything at once
+####################################
+
+# Each source, as a function (force, mirror) -> whether it fetched anything
+SOURCES = {
+    "computational_adme": download_computational_adme,
+    "comp": download_comp_data,
+    "tdc_lipo_az": make_tdc_lipo_az,
+}
+# What the sources produce, i.e. what goes in a mirror (plus the ADME CSV)
+RAW_DATASETS = [asap_train_raw, asap_test_raw, tdc_lipophilicity_az_raw]
+
+
+def download(
+    sources: list[str] | None = None,
+    force: bool = False,
+    mirror: Path | str | None = MIRROR_DIR,
+) -> dict[str, bool]:
+    """
+    Fetch every source (or just the ones named) concurrently, on threads - it's all network and disk.
+    One source failing doesn't stop the others; the failures get raised together at the end.
+    Returns {source: whether it fetched anything}.
+    """
+    sources = sources or list(SOURCES)
+    logger.info(f"Fetching {sources} {'from mirror ' + str(mirror) if mirror else 'from the hub'}...")
+    if not mirror and set(sources) - {"computational_adme"}:
+        # import polaris once up front, rather than racing to import it from two threads
+        import polaris  # noqa: F401
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = {name: pool.submit(SOURCES[name], force=force, mirror=mirror) for name in sources}
+    results, errors = {}, {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logger.error(f"Fetching {name} failed: {e!r}")
+            errors[name] = e
+    if errors:
+        raise RuntimeError(f"Failed to fetch {list(errors)}") from next(iter(errors.values()))
+    logger.info(f"Done. Fetched {[n for n, changed in results.items() if changed]}, skipped the rest.")
+    return results
@@ -0,0 +1,484 @@
+import json
+import re
+from collections.abc import Sequence
+from dataclasses import asdict, dataclass, field, fields
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import torch
+from chemprop import data, featurizers, models, nn
+from chemprop.data.molgraph import MolGraph
+from lightning import pytorch as lightning_pl
+from lightning.pytorch.callbacks import Callback, EarlyStopping, ModelCheckpoint
+from lightning.pytorch.loggers import TensorBoardLogger
+
+from polaris_asap_admet.conformers import conformer_store
+from polaris_asap_admet.features import feature_store
+from polaris_asap_admet.io import admet_train_combined, asap_test_raw, scan_table
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.model_cache import model_cache, training_key
+from polaris_asap_admet.molecules import ID_COL, molecule_table
+from polaris_asap_admet.similarity import nn_similarity
+from polaris_asap_admet.splits import SPLIT_TYPES, dataset_split, split_indices
+
+SMILES_COL = "CXSMILES"
+RUNS_DIR = Path("runs")
+TARGETS = [
+    "HLM",
+    "KSOL",
+    "LogD",
+    "MDR1-MDCKII",
+    "MLM",
+]
+# runs/{target}_{timestamp}/model_0/best.pt, as written by run() and run_chemprop.py
+RUN_DIR_RE = re.compile(r"^(?P<target>.+)_\d{8}_\d{6}$")
+
+
+@dataclass
+class TrainConfig:
+    """
+    Hyperparameters and run settings.  Defaults match what run_chemprop.py used to pass to the chemprop CLI.
+    """
+
+    dropout: float = 0.2
+    epochs: int = 10
+    batch_size: int = 64
+    num_workers: int = 4
+    accelerator: str = "auto"
+    metrics: list[str] = field(default_factory=lambda: ["r2"])
+    split_type: str = "kmeans"
+    split_sizes: tuple[float, float, float] = (0.8, 0.1, 0.1)
+    data_seed: int = 0
+    message_hidden_dim: int = 300
+    depth: int = 3
+    ffn_hidden_dim: int = 300
+    ffn_num_layers: int = 1
+    warmup_epochs: int = 2
+    init_lr: float = 1e-4
+    max_lr: float = 1e-3
+    final_lr: float = 1e-4
+    shape_descriptors: bool = False  # add 3D shape descriptors (conformers.FEATURE_COLUMNS) to X_d
+
+    @classmethod
+    def load(cls, path: Path | str) -> "TrainConfig":
+        """
+        From a JSON file of field values, e.g. configs/HLM.json from hpo.search.  Missing fields keep their defaults.
+        """
+        with open(path) as f:
+            values = json.load(f)
+        names = {f.name for f in fields(cls)}
+        unknown = set(values) - names
+        if unknown:
+            raise ValueError(f"Unknown TrainConfig fields in {path}: {sorted(unknown)}")
+        if "split_sizes" in values:
+            values["split_sizes"] = tuple(values["split_sizes"])
+        return cls(**values)
+
+    def save(self, path: Path | str) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(asdict(self), f, indent=2)
+
+
+@dataclass
+class TrainResult:
+    model: models.MPNN
+    target_cols: list[str]
+    output_dir: Path
+    test_scores: dict[str, float]
+    best_val_loss: float = float("nan")
+
+
+class KeepBestWeights(Callback):
+    """
+    Keep a copy of the best weights (by val_loss) in memory, so we don't have to reload best.pt to predict.
+    """
+
+    def __init__(self):
+        self.best_score = float("inf")
+        self.best_state = None
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+        score = trainer.callback_metrics.get("val_loss")
+        if score is not None and float(score) < self.best_score:
+            self.best_score = float(score)
+            self.best_state = {
+                k: v.detach().cpu().clone() for k, v in pl_module.state_dict().items()
+            }
+
+
+def make_datapoints(
+    smiles: list[str], Y: np.ndarray | None = None, X_d: np.ndarray | None = None
+) -> list[data.MoleculeDatapoint]:
+    return [
+        data.MoleculeDatapoint.from_smi(
+            smi,
+            y=Y[i] if Y is not None else None,
+            x_d=X_d[i] if X_d is not None else None,
+        )
+        for i, smi in enumerate(smiles)
+    ]
+
+
+def load_datapoints(
+    df: pl.DataFrame, target_cols: list[str] | None = None, shape_descriptors: bool = False
+) -> list[data.MoleculeDatapoint]:
+    """
+    Datapoints for every row of df, with v1_rdkit_2d_normalized descriptors from the feature store -
+    and with shape_descriptors, 3D shape descriptors from the conformer store after them.
+    """
+    X_d = feature_store.get(df[SMILES_COL])
+    if shape_descriptors:
+        X_d = np.hstack([X_d, conformer_store.get(df[SMILES_COL])])
+    Y = df.select(target_cols).to_numpy().astype(float) if target_cols else None
+    return make_datapoints(df[SMILES_COL].to_list(), Y=Y, X_d=X_d)
+
+
+class SharedMolGraphs(Sequence):
+    """
+    Molecule graphs featurized once and written to dir as a few flat .npy files, read back memory-mapped -
+    so processes training on the same molecules (ensemble members) share the pages instead of each
+    featurizing its own copy.  A drop-in for a MoleculeDataset's mg_cache (see make_dataset).
+    """
+
+    FIELDS = ("V", "E", "edge_index", "rev_edge_index")
+
+    def __init__(self, dir: Path | str, idx: list[int] | None = None):
+        self.dir = Path(dir)
+        self.idx = idx
+        self._open()
+
+    def _open(self) -> None:
+        self._arrays = {f: np.load(self.dir / f"{f}.npy", mmap_mode="r") for f in (*self.FIELDS, "offsets")}
+
+    @classmethod
+    def write(cls, smiles: list[str], dir: Path | str) -> "SharedMolGraphs":
+        featurizer = featurizers.SimpleMoleculeMolGraphFeaturizer()
+        mgs = [featurizer(d.mol) for d in make_datapoints(smiles)]
+        dir = Path(dir)
+        dir.mkdir(parents=True, exist_ok=True)
+        # row i: where molecule i's atoms and bonds start
+        offsets = np.zeros((len(mgs) + 1, 2), dtype=np.int64)
+        offsets[1:] = np.cumsum([(len(mg.V), len(mg.E)) for mg in mgs], axis=0)
+        np.save(dir / "offsets.npy", offsets)
+        for f in cls.FIELDS:
+            np.save(dir / f"{f}.npy", np.concatenate([getattr(mg, f) for mg in mgs], axis=-1 if f == "edge_index" else 0))
+        return cls(dir)
+
+    def take(self, idx: list[int]) -> "SharedMolGraphs":
+        return SharedMolGraphs(self.dir, [self.idx[i] for i in idx] if self.idx is not None else list(idx))
+
+    def __len__(self) -> int:
+        return len(self.idx) if self.idx is not None else len(self._arrays["offsets"]) - 1
+
+    def __getitem__(self, i: int) -> MolGraph:
+        i = self.idx[i] if self.idx is not None else i
+        (a0, b0), (a1, b1) = self._arrays["offsets"][i : i + 2]
+        arrays = self._arrays
+        return MolGraph(arrays["V"][a0:a1], arrays["E"][b0:b1], arrays["edge_index"][:, b0:b1], arrays["rev_edge_index"][b0:b1])
+
+    def __getstate__(self) -> dict:
+        # dataloader workers get the path, not a copy of the arrays
+        return {"dir": self.dir, "idx": self.idx}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._open()
+
+
+def make_dataset(
+    datapoints: list[data.MoleculeDatapoint], molgraphs: SharedMolGraphs | None = None
+) -> data.MoleculeDataset:
+    """
+    With molgraphs (one per datapoint, in order), those are used as they are instead of featurizing again.
+    """
+    dset = data.MoleculeDataset(datapoints, featurizers.SimpleMoleculeMolGraphFeaturizer())
+    if molgraphs is not None:
+        dset.mg_cache = molgraphs
+    else:
+        # featurize each molecule graph once, instead of once per epoch
+        dset.cache = True
+    return dset
+
+
+def datapoint_split(
+    datapoints: list[data.MoleculeDatapoint],
+    config: TrainConfig,
+    split: tuple[list[int], list[int], list[int]] | None = None,
+) -> tuple[list[int], list[int], list[int]]:
+    """
+    (train, val, test) indices into datapoints, by config.split_type unless split already gives them.
+    """
+    if split is not None:
+        return tuple(list(idx) for idx in split)
+    train_idx, val_idx, test_idx = data.make_split_indices(
+        [d.mol for d in datapoints], config.split_type, config.split_sizes, config.data_seed
+    )
+    return train_idx[0], val_idx[0], test_idx[0]
+
+
+def build_model(
+    train_dset: data.MoleculeDataset,
+    config: TrainConfig,
+    X_d_transform: nn.ScaleTransform | None,
+    output_transform: nn.UnscaleTransform | None,
+) -> models.MPNN:
+    featurizer = train_dset.featurizer
+    mp = nn.BondMessagePassing(
+        featurizer.atom_fdim,
+        featurizer.bond_fdim,
+        d_h=config.message_hidden_dim,
+        depth=config.depth,
+        dropout=config.dropout,
+    )
+    predictor = nn.RegressionFFN(
+        n_tasks=train_dset.Y.shape[1],
+        input_dim=mp.output_dim + train_dset.d_xd,
+        hidden_dim=config.ffn_hidden_dim,
+        n_layers=config.ffn_num_layers,
+        dropout=config.dropout,
+        output_transform=output_transform,
+    )
+    metrics = [nn.MetricRegistry[m]() for m in config.metrics]
+    return models.MPNN(
+        mp,
+        nn.MeanAggregation(),
+        predictor,
+        batch_norm=False,
+        metrics=metrics,
+        warmup_epochs=config.warmup_epochs,
+        init_lr=config.init_lr,
+        max_lr=config.max_lr,
+        final_lr=config.final_lr,
+        X_d_transform=X_d_transform,
+    )
+
+
+def latest_models(runs_dir: Path | str = RUNS_DIR, targets: list[str] = TARGETS) -> dict[str, Path]:
+    """
+    {target: newest best.pt for it}.  Run dirs are matched to targets case-insensitively (LOGD is LogD).
+    """
+    by_name = {tgt.upper(): tgt for tgt in targets}
+    latest, mtimes = {}, {}
+    for path in Path(runs_dir).glob("*/model_0/best.pt"):
+        match = RUN_DIR_RE.match(path.parent.parent.name)
+        target = by_name.get(match["target"].upper()) if match else None
+        if target is None:
+            continue
+        mtime = path.stat().st_mtime
+        if mtime > mtimes.get(target, -1):
+            latest[target], mtimes[target] = path, mtime
+    return latest
+
+
+def descriptor_width(model: models.MPNN) -> int:
+    """
+    How many X_d columns a model was trained on:  N_FEATURES, or more with shape_descriptors.
+    """
+    return model.X_d_transform.mean.shape[-1]
+
+
+def load_model(path: Path | str, target: str | None = None) -> tuple[models.MPNN, int]:
+    """
+    A saved model, on the CPU and in eval mode, plus which of its outputs is target (0 if it doesn't say).
+    """
+    model = models.MPNN.load_from_file(path, map_location=torch.device("cpu"))
+    model.eval()
+    columns = models.utils.load_output_columns(path) or []
+    return model, columns.index(target) if target in columns else 0
+
+
+@stage("predict")
+def predict(
+    model: models.MPNN, dset: data.MoleculeDataset, config: TrainConfig
+) -> np.ndarray:
+    """
+    Predictions in target units, shape (n_molecules, n_tasks).
+    """
+    loader = data.build_dataloader(
+        dset, config.batch_size, config.num_workers, shuffle=False
+    )
+    trainer = lightning_pl.Trainer(
+        logger=False, enable_progress_bar=False, accelerator=config.accelerator, devices=1
+    )
+    with torch.inference_mode():
+        preds = torch.concat(trainer.predict(model, loader), 0).numpy()
+    metrics = current_stage()
+    metrics.rows_in, metrics.rows_out = len(dset), len(preds)
+    return preds
+
+
+def score(y_true: np.ndarray, y_pred: np.ndarray) -> dict[str, float]:
+    """
+    r2 and MAE, ignoring missing targets.
+    """
+    mask = ~np.isnan(y_true)
+    y_true, y_pred = y_true[mask], y_pred[mask]
+    if len(y_true) == 0:
+        return {"r2": float("nan"), "mae": float("nan")}
+    ss_res = ((y_true - y_pred) ** 2).sum()
+    ss_tot = ((y_true - y_true.mean()) ** 2).sum()
+    return {
+        "r2": float(1 - ss_res / ss_tot) if ss_tot > 0 else float("nan"),
+        "mae": float(np.abs(y_true - y_pred).mean()),
+    }
+
+
+@stage("train")
+def train(
+    df_train: pl.DataFrame,
+    target_cols: list[str],
+    output_dir: Path,
+    config: TrainConfig | None = None,
+    member: int = 0,
+    split: tuple[list[int], list[int], list[int]] | None = None,
+    callbacks: list[Callback] | None = None,
+    molgraphs: SharedMolGraphs | None = None,
+) -> TrainResult:
+    """
+    Split, scale, train.  Writes model_{member}/best.pt and tensorboard logs like `chemprop train` does,
+    but hands back the trained model too.  split overrides config.split_type (see datapoint_split) -
+    pass splits.dataset_split's to reuse a precomputed one; without it, kmeans and scaffold_balanced
+    splits are clustered here, from scratch.  callbacks are added to the Trainer's (hpo uses this to prune).
+    molgraphs, one per row of df_train, saves featurizing them again (see SharedMolGraphs).
+    """
+    config = config or TrainConfig()
+    output_dir = Path(output_dir)
+    model_dir = output_dir / f"model_{member}"
+    model_dir.mkdir(parents=True, exist_ok=True)
+    metrics = current_stage()
+    metrics.tags["targets"] = target_cols
+    metrics.rows_in = len(df_train)
+
+    datapoints = load_datapoints(df_train, target_cols, config.shape_descriptors)
+    if split is None and config.split_type.lower() in SPLIT_TYPES:
+        split = split_indices(df_train[SMILES_COL].to_list(), config.split_type, config.split_sizes, config.data_seed)
+    split = datapoint_split(datapoints, config, split)
+    logger.info(f"train/val/test sizes: {[len(idx) for idx in split]}")
+    train_dset, val_dset, test_dset = (
+        make_dataset([datapoints[i] for i in idx], molgraphs.take(idx) if molgraphs is not None else None)
+        for idx in split
+    )
+
+    X_d_scaler = train_dset.normalize_inputs("X_d")
+    val_dset.normalize_inputs("X_d", X_d_scaler)
+    X_d_transform = nn.ScaleTransform.from_standard_scaler(X_d_scaler)
+    output_scaler = train_dset.normalize_targets()
+    val_dset.normalize_targets(output_scaler)
+    output_transform = nn.UnscaleTransform.from_standard_scaler(output_scaler)
+
+    model = build_model(train_dset, config, X_d_transform, output_transform)
+    train_loader = data.build_dataloader(
+        train_dset, config.batch_size, config.num_workers, seed=config.data_seed
+    )
+    val_loader = data.build_dataloader(
+        val_dset, config.batch_size, config.num_workers, shuffle=False
+    )
+
+    keep_best = KeepBestWeights()
+    trainer = lightning_pl.Trainer(
+        logger=TensorBoardLogger(model_dir, "trainer_logs", default_hp_metric=False),
+        enable_progress_bar=True,
+        accelerator=config.accelerator,
+        devices=1,
+        max_epochs=config.epochs,
+        callbacks=[
+            keep_best,
+            ModelCheckpoint(model_dir / "checkpoints", monitor="val_loss", mode="min"),
+            EarlyStopping("val_loss", patience=config.epochs, mode="min"),
+            *(callbacks or []),
+        ],
+    )
+    trainer.fit(model, train_loader, val_loader)
+    if keep_best.best_state is not None:
+        model.load_state_dict(keep_best.best_state)
+    model.eval()
+
+    models.save_model(model_dir / "best.pt", model, target_cols)
+    logger.info(f"Best model saved to {model_dir / 'best.pt'}")
+
+    # test_dset was never normalized, so its Y is still in target units
+    test_preds = predict(model, test_dset, config)
+    test_scores = {}
+    for i, col in enumerate(target_cols):
+        for metric, value in score(test_dset.Y[:, i], test_preds[:, i]).items():
+            test_scores[f"{col}/{metric}"] = value
+    logger.info(f"Held-out test scores: {test_scores}")
+    return TrainResult(model, target_cols, output_dir, test_scores, keep_best.best_score)
+
+
+def run(
+    target: str,
+    train_path: Path | str,
+    test_path: Path | str,
+    config: TrainConfig | None = None,
+    test_dset: data.MoleculeDataset | None = None,
+    df_test: pl.DataFrame | None = None,
+    use_cache: bool = True,
+) -> pl.DataFrame:
+    """
+    Train on train_path, predict test_path, write runs/{target}_{timestamp}_preds.csv - keyed by mol_id
+    (molecules.molecule_table), with each test molecule's similarity to its nearest training molecules
+    (similarity.nn_similarity).
+
+    If the same data has been trained on with the same config (and code, and package versions) before,
+    and that run is still in the model cache, its best.pt is reused instead - unless use_cache is False.
+    Pass test_dset/df_test to reuse an already-featurized test set (see run_all).
+    """
+    config = config or TrainConfig()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_dir = RUNS_DIR / f"{target}_{timestamp}"
+    preds_file = RUNS_DIR / f"{target}_{timestamp}_preds.csv"
+
+    df_train = scan_table(train_path).collect()
+    target_cols = [c for c in df_train.columns if c not in (SMILES_COL, ID_COL)]
+    key, key_inputs = training_key(df_train, target_cols, config)
+    cached_dir = model_cache.lookup(key) if use_cache else None
+    if cached_dir is not None:
+        logger.info(f"{target} on {train_path} is unchanged since {cached_dir} (key {key}), reusing its model.")
+        model, _ = load_model(cached_dir / "model_0" / "best.pt")
+    else:
+        logger.info(f"Training {target} on {train_path}, targets {target_cols}...")
+        split = dataset_split(train_path, config.split_type, config.split_sizes, config.data_seed)
+        model = train(df_train, target_cols, output_dir, config, split=split).model
+        model_cache.add(key, target, output_dir, key_inputs)
+
+    if test_dset is None:
+        df_test = scan_table(test_path).collect()
+        test_dset = make_dataset(load_datapoints(df_test, shape_descriptors=config.shape_descriptors))
+    logger.info(f"Predicting {test_path}...")
+    preds = predict(model, test_dset, config)
+    df_preds = molecule_table.with_ids(df_test).select(ID_COL).with_columns(
+        [pl.Series(col, preds[:, i]) for i, col in enumerate(target_cols)]
+    )
+    df_preds = df_preds.with_columns(nn_similarity(df_test[SMILES_COL], train_path))
+    df_preds.write_csv(preds_file)
+    logger.info(f"Wrote predictions to {preds_file}")
+    return df_preds
+
+
+def run_all(
+    jobs: dict[str, str | Path] | None = None,
+    test_path: Path | str | None = None,
+    config: TrainConfig | None = None,
+) -> dict[str, pl.DataFrame]:
+    """
+    Run several targets in one process, e.g. {"HLM": "data/combined/admet_HLM_train.parquet", ...}.
+    Defaults to every combined training set against asap_test_raw.
+    The test set is read and featurized once and shared by every target.
+    """
+    jobs = jobs or {tgt: ds.filepath for tgt, ds in admet_train_combined.items()}
+    test_path = test_path or asap_test_raw.filepath
+    config = config or TrainConfig()
+    df_test = molecule_table.with_ids(scan_table(test_path).collect())
+    test_dset = make_dataset(load_datapoints(df_test, shape_descriptors=config.shape_descriptors))
+    return {
+        target: run(target, train_path, test_path, config, test_dset=test_dset, df_test=df_test)
+        for target, train_path in jobs.items()
+    }
@@ -0,0 +1,297 @@
+import json
+import resource
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import replace
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import psutil
+import torch
+from lightning import pytorch as lightning_pl
+
+from polaris_asap_admet.driver import (RUNS_DIR, SMILES_COL, SharedMolGraphs,
+                                       TrainConfig, load_datapoints, make_dataset,
+                                       predict, train)
+from polaris_asap_admet.conformers import conformer_store
+from polaris_asap_admet.features import feature_store
+from polaris_asap_admet.io import admet_train_combined, asap_test_raw, scan_table
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.molecules import ID_COL, molecule_table
+from polaris_asap_admet.scheduler import available_cores, plan
+from polaris_asap_admet.similarity import nn_similarity
+from polaris_asap_admet.splits import dataset_split
+
+N_MEMBERS = 5
+SPREAD_TOP_N = 10  # test molecules the members disagree on most, listed in the report
+
+
+def kfold_splits(n: int, k: int, seed: int = 0) -> list[tuple[list[int], list[int], list[int]]]:
+    """
+    (train, val, test) indices for k folds over n rows: fold i is test, fold i+1 is val, the rest train.
+    Every row is in exactly one test fold.
+    """
+    if k < 3:
+        raise ValueError(f"Need at least 3 folds (train/val/test), got {k}")
+    fold = np.random.default_rng(seed).permutation(n) % k
+    splits = []
+    for i in range(k):
+        test, val = fold == i, fold == (i + 1) % k
+        splits.append(
+            (
+                np.flatnonzero(~(test | val)).tolist(),
+                np.flatnonzero(val).tolist(),
+                np.flatnonzero(test).tolist(),
+            )
+        )
+    return splits
+
+
+def reduce_ensemble(preds: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Mean/std/min/max over members of stacked predictions, shape (n_members, n_molecules, n_tasks).
+    """
+    return {
+        "mean": np.nanmean(preds, axis=0),
+        "std": np.nanstd(preds, axis=0),
+        "min": np.nanmin(preds, axis=0),
+        "max": np.nanmax(preds, axis=0),
+    }
+
+
+def _init_worker(threads: int) -> None:
+    torch.set_num_threads(threads)
+
+
+def _train_member(
+    train_path: str,
+    test_path: str,
+    target_cols: list[str],
+    output_dir: Path,
+    config: TrainConfig,
+    member: int,
+    seed: int,
+    split: tuple[list[int], list[int], list[int]] | None,
+) -> dict:
+    """
+    Train one member and predict the test set with it.  Runs in a worker process.
+
+    Descriptors come from the feature store, which the parent has already filled, and molecule graphs
+    from output_dir/molgraphs, which the parent has already written (see SharedMolGraphs) - so this only
+    reads memory-mapped files, and every worker shares the same pages.
+    """
+    lightning_pl.seed_everything(seed, verbose=False)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    df_train = scan_table(train_path).collect()
+    result = train(
+        df_train, target_cols, output_dir, config, member=member, split=split,
+        molgraphs=SharedMolGraphs(output_dir / "molgraphs" / "train"),
+    )
+    df_test = scan_table(test_path).collect()
+    test_dset = make_dataset(
+        load_datapoints(df_test, shape_descriptors=config.shape_descriptors),
+        SharedMolGraphs(output_dir / "molgraphs" / "test"),
+    )
+    preds = predict(result.model, test_dset, config)
+    return {
+        "member": member,
+        "seed": seed,
+        "test_scores": result.test_scores,
+        "preds": preds.astype(np.float32),
+        "wall_seconds": time.perf_counter() - start,
+        "cpu_seconds": time.process_time() - start_cpu,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def spread_report(df_test: pl.DataFrame, target_cols: list[str], reduced: dict[str, np.ndarray]) -> dict:
+    """
+    How much the members disagree on the test set, per target: summary of the per-molecule std,
+    and the molecules with the largest.
+    """
+    report = {}
+    for i, col in enumerate(target_cols):
+        std = reduced["std"][:, i]
+        top = np.argsort(-np.nan_to_num(std, nan=-1))[:SPREAD_TOP_N]
+        report[col] = {
+            "std_mean": float(np.nanmean(std)),
+            "std_median": float(np.nanmedian(std)),
+            "std_p90": float(np.nanpercentile(std, 90)),
+            "std_max": float(np.nanmax(std)),
+            "widest": [
+                {
+                    SMILES_COL: df_test[SMILES_COL][int(j)],
+                    "mean": float(reduced["mean"][j, i]),
+                    "std": float(std[j]),
+                    "min": float(reduced["min"][j, i]),
+                    "max": float(reduced["max"][j, i]),
+                }
+                for j in top
+            ],
+        }
+    return report
+
+
+@stage("train_ensemble")
+def train_ensemble(
+    target: str,
+    train_path: Path | str,
+    test_path: Path | str,
+    n_members: int = N_MEMBERS,
+    folds: int | None = None,
+    n_workers: int | None = None,
+    config: TrainConfig | None = None,
+) -> pl.DataFrame:
+    """
+    Train n_members replicates (or, with folds, one model per fold) in parallel and average them.
+
+    Replicates share config's split and differ by seed (initialization, shuffling); folds come from
+    kfold_splits, so each member's held-out scores are on a different fold.  Members go to
+    runs/{target}_{timestamp}/model_{i}/, the averaged predictions - with a {col}_std column per
+    target, and nearest-neighbour similarity to the training set - to runs/{target}_{timestamp}_preds.csv,
+    and the spread/timing report to runs/{target}_{timestamp}/ensemble_report.json.
+
+    n_workers defaults to however many members fit in cores and memory at once (scheduler.plan);
+    the cores are split evenly between them.
+    """
+    config = config or TrainConfig()
+    train_path, test_path = str(train_path), str(test_path)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_dir = RUNS_DIR / f"{target}_{timestamp}"
+    preds_file = RUNS_DIR / f"{target}_{timestamp}_preds.csv"
+
+    df_train = scan_table(train_path).collect()
+    df_test = scan_table(test_path).collect()
+    target_cols = [c for c in df_train.columns if c not in (SMILES_COL, ID_COL)]
+    if folds:
+        splits = kfold_splits(len(df_train), folds, config.data_seed)
+    else:
+        splits = [dataset_split(train_path, config.split_type, config.split_sizes, config.data_seed)] * n_members
+    n_members = len(splits)
+
+    # Featurize everything up front, once, so the workers only ever read the stores and the graphs
+    feature_store.update(pl.concat([df_train[SMILES_COL], df_test[SMILES_COL]]))
+    if config.shape_descriptors:
+        conformer_store.update(pl.concat([df_train[SMILES_COL], df_test[SMILES_COL]]))
+    SharedMolGraphs.write(df_train[SMILES_COL].to_list(), output_dir / "molgraphs" / "train")
+    SharedMolGraphs.write(df_test[SMILES_COL].to_list(), output_dir / "molgraphs" / "test")
+
+    cores = available_cores()
+    if n_workers is None:
+        n_workers = plan(n_members, cores, psutil.virtual_memory().available / 1024**3)[0]
+    n_workers = max(1, min(n_workers, n_members))
+    threads = max(1, cores // n_workers)
+    member_config = replace(config, num_workers=threads // 4)
+    mode = f"{n_members}-fold" if folds else f"{n_members} replicates"
+    logger.info(
+        f"Training {target} as {mode} on {n_workers} workers x {threads} threads, targets {target_cols}..."
+    )
+
+    start = time.perf_counter()
+    results = []
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(threads,),
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _train_member,
+                    train_path,
+                    test_path,
+                    target_cols,
+                    output_dir,
+                    member_config,
+                    member,
+                    config.data_seed + member,
+                    split,
+                )
+                for member, split in enumerate(splits)
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                logger.info(
+                    f"Member {result['member']} done in {result['wall_seconds']:.1f}s: {result['test_scores']}"
+                )
+                results.append(result)
+    finally:
+        shutil.rmtree(output_dir / "molgraphs")  # only the members needed them
+    wall_seconds = time.perf_counter() - start
+    results.sort(key=lambda r: r["member"])
+
+    reduced = reduce_ensemble(np.stack([r["preds"] for r in results]))
+    df_preds = molecule_table.with_ids(df_test).select(ID_COL).with_columns(
+        *[pl.Series(col, reduced["mean"][:, i]) for i, col in enumerate(target_cols)],
+        *[pl.Series(f"{col}_std", reduced["std"][:, i]) for i, col in enumerate(target_cols)],
+        *nn_similarity(df_test[SMILES_COL], train_path),
+    )
+    df_preds.write_csv(preds_file)
+    logger.info(f"Wrote ensemble predictions to {preds_file}")
+
+    scores = pl.DataFrame([r["test_scores"] for r in results])
+    member_seconds = sum(r["wall_seconds"] for r in results)
+    report = {
+        "target": target,
+        "mode": "kfold" if folds else "replicates",
+        "n_members": n_members,
+        "n_workers": n_workers,
+        "threads_per_worker": threads,
+        "wall_seconds": wall_seconds,
+        "member_seconds": member_seconds,
+        # > 1 means the members really did overlap
+        "parallel_speedup": member_seconds / wall_seconds if wall_seconds else 0.0,
+        "members": [{k: v for k, v in r.items() if k != "preds"} for r in results],
+        "test_scores_mean": scores.mean().row(0, named=True),
+        "test_scores_std": scores.std().row(0, named=True) if n_members > 1 else None,
+        "spread": spread_report(df_test, target_cols, reduced),
+    }
+    with open(output_dir / "ensemble_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(
+        f"{target} ensemble: {wall_seconds:.1f}s wall for {member_seconds:.1f}s of training "
+        f"({report['parallel_speedup']:.2f}x); held-out scores {report['test_scores_mean']}, "
+        f"mean spread {[round(s['std_mean'], 4) for s in report['spread'].values()]}."
+    )
+    metrics = current_stage()
+    metrics.tags.update(target=target, n_members=n_members, n_workers=n_workers)
+    metrics.rows_in, metrics.rows_out = len(df_train), len(df_preds)
+    return df_preds
+
+
+def benchmark_ensemble_scaling(
+    target: str = "HLM",
+    worker_counts: list[int] | None = None,
+    n_members: int = 4,
+    config: TrainConfig | None = None,
+) -> pl.DataFrame:
+    """
+    Wall time of the same n_members ensemble at each worker count (default 1, 2, 4, ... up to the
+    core count), with speedup and efficiency against the first (fewest workers).  Goes to runs/ensemble_scaling_{timestamp}.json.
+    """
+    cores = available_cores()
+    worker_counts = worker_counts or [2**i for i in range(cores.bit_length()) if 2**i <= min(cores, n_members)]
+    train_path, test_path = admet_train_combined[target].filepath, asap_test_raw.filepath
+    rows = []
+    for n_workers in worker_counts:
+        start = time.perf_counter()
+        train_ensemble(target, train_path, test_path, n_members=n_members, n_workers=n_workers, config=config)
+        rows.append({"n_workers": n_workers, "wall_seconds": time.perf_counter() - start})
+
+    df = pl.DataFrame(rows).with_columns(
+        speedup=pl.col("wall_seconds").first() / pl.col("wall_seconds")
+    ).with_columns(efficiency=pl.col("speedup") / (pl.col("n_workers") / pl.col("n_workers").first()))
+    print(df)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    out = RUNS_DIR / f"ensemble_scaling_{timestamp}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({"target": target, "n_members": n_members, "cores": cores, "runs": df.to_dicts()}, f, indent=2)
+    logger.info(f"Wrote {out}")
+    return df
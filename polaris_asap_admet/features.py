@@ -0,0 +1,206 @@
+import fcntl
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from polaris_asap_admet.io import (admet_train_combined, asap_test_raw, data_dir,
+                                   scan_table)
+from polaris_asap_admet.logger import RateLimitedLogger, logger
+from polaris_asap_admet.metrics import stage
+from polaris_asap_admet.mol_cache import smiles_key
+
+FEATURIZER = "v1_rdkit_2d_normalized"
+FEATURE_DIR = Path("features")  # relative to the data dir
+N_FEATURES = 200
+CHUNK_SIZE = 256
+per_molecule = RateLimitedLogger(per_second=1)
+
+
+def _featurize_chunk(smiles: list[str]) -> np.ndarray:
+    """
+    Compute v1_rdkit_2d_normalized descriptors for a chunk of SMILES.  Runs in a worker process.
+
+    This is what chemprop's V1RDKit2DNormalizedFeaturizer does, minus the torch import:
+    parse, re-emit isomeric SMILES, hand that to descriptastorus.  Unparseable SMILES get a row of NaN.
+    """
+    from descriptastorus.descriptors import rdNormalizedDescriptors
+    from rdkit import Chem, RDLogger
+
+    RDLogger.DisableLog("rdApp.*")
+    generator = rdNormalizedDescriptors.RDKit2DNormalized()
+    out = np.full((len(smiles), N_FEATURES), np.nan, dtype=np.float32)
+    for i, smi in enumerate(smiles):
+        mol = Chem.MolFromSmiles(smi)
+        if mol is None:
+            per_molecule.debug("Couldn't parse {!r}; its descriptors are NaN.", smi)
+            continue
+        out[i] = generator.process(Chem.MolToSmiles(mol, isomericSmiles=True))[1:]
+    return out
+
+
+@dataclass
+class FeatureStore:
+    """
+    Precomputed molecule descriptors, computed once per unique molecule.
+
+    Lives in {root}/{featurizer}/ as:
+      - features.npy, features-00001.npy, ...: float32 shards, one row per molecule, opened memory-mapped.
+        Each update adds a shard for its new molecules, so existing rows are never rewritten.
+      - index.parquet: smiles_key (same key as the molecule cache) -> (shard, row in that shard)
+
+    A new shard and the index are swapped in separately, so updates (exclusive) and lookups (shared) hold a
+    lock on the directory - otherwise a reader could see the index before its shard exists.
+    """
+
+    featurizer: str = FEATURIZER
+    root: Path | None = None  # defaults to {data dir}/FEATURE_DIR
+
+    @property
+    def path(self) -> Path:
+        return Path(self.root or data_dir() / FEATURE_DIR) / self.featurizer
+
+    def shard_path(self, shard: int) -> Path:
+        # shard 0 keeps the name stores from before sharding used
+        return self.path / ("features.npy" if shard == 0 else f"features-{shard:05d}.npy")
+
+    @property
+    def index_path(self) -> Path:
+        return self.path / "index.parquet"
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False):
+        # run-parallel jobs, batch_predict and the server all update and read the one store
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def load_index(self) -> pl.DataFrame:
+        if not self.index_path.exists():
+            return pl.DataFrame(schema={"smiles_key": pl.String, "shard": pl.UInt32, "row": pl.UInt32})
+        df_index = pl.read_parquet(self.index_path)
+        if "shard" not in df_index.columns:  # from before sharding:  everything's in features.npy
+            df_index = df_index.select("smiles_key", pl.lit(0, dtype=pl.UInt32).alias("shard"), "row")
+        return df_index
+
+    def load_shard(self, shard: int) -> np.ndarray:
+        """
+        Memory-mapped, read-only.
+        """
+        return np.load(self.shard_path(shard), mmap_mode="r")
+
+    def update(self, smiles: pl.Series, n_workers: int | None = None) -> None:
+        """
+        Featurize any molecules in smiles that aren't in the store yet.  Featurizing happens outside the
+        lock; only the merge into the store holds it.
+        """
+        with self._locked():
+            df_index = self.load_index()
+        df_query = (
+            pl.DataFrame([smiles.cast(pl.String).alias("smiles"), smiles_key(smiles)])
+            .drop_nulls()
+            .unique("smiles_key", maintain_order=True)
+        )
+        df_new = df_query.join(df_index, on="smiles_key", how="anti")
+        logger.info(
+            f"Feature store {self.featurizer}: {len(df_query) - len(df_new)} hits, {len(df_new)} to featurize."
+        )
+        if len(df_new) == 0:
+            return
+
+        values = df_new["smiles"].to_list()
+        chunks = [values[i : i + CHUNK_SIZE] for i in range(0, len(values), CHUNK_SIZE)]
+        n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(chunks)))
+        logger.info(f"Featurizing {len(values)} molecules on {n_workers} workers...")
+        if n_workers == 1:
+            X_new = np.vstack([_featurize_chunk(c) for c in chunks])
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+                X_new = np.vstack(list(pool.map(_featurize_chunk, chunks)))
+
+        with self._locked(exclusive=True):
+            # someone else may have added some of these while we featurized
+            df_index = self.load_index()
+            keep = ~df_new["smiles_key"].is_in(df_index["smiles_key"]).to_numpy()
+            df_new, X_new = df_new.filter(keep), X_new[keep]
+            if len(df_new) == 0:
+                return
+            # the new molecules go in a shard of their own; nothing already in the store is touched
+            shard = df_index["shard"].max() + 1 if len(df_index) else 0
+            tmp_features = self.path / f"features.{os.getpid()}.tmp.npy"
+            np.save(tmp_features, X_new)
+            df_index = pl.concat(
+                [
+                    df_index,
+                    df_new.select(
+                        "smiles_key",
+                        pl.lit(shard, dtype=pl.UInt32).alias("shard"),
+                        pl.int_range(len(df_new), dtype=pl.UInt32).alias("row"),
+                    ),
+                ]
+            )
+            tmp_index = self.path / f"index.{os.getpid()}.tmp.parquet"
+            df_index.write_parquet(tmp_index)
+            os.replace(tmp_features, self.shard_path(shard))
+            os.replace(tmp_index, self.index_path)
+        logger.info(f"Done. Feature store now holds {len(df_index)} molecules.")
+
+    def get(self, smiles: pl.Series, n_workers: int | None = None) -> np.ndarray:
+        """
+        Descriptor matrix aligned with smiles, featurizing whatever's missing first.
+        """
+        self.update(smiles, n_workers=n_workers)
+        return self.lookup(smiles)[0]
+
+    def lookup(self, smiles: pl.Series) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Descriptors for whichever of smiles are in the store already, without featurizing or writing anything.
+        Returns the matrix aligned with smiles (NaN rows for misses) and a boolean mask of hits.
+        """
+        # shards are never rewritten, so once the index is read they can be opened without the lock
+        with self._locked():
+            df_index = self.load_index()
+        df_rows = smiles_key(smiles).to_frame().join(df_index, on="smiles_key", how="left", maintain_order="left")
+        out = np.full((len(smiles), N_FEATURES), np.nan, dtype=np.float32)
+        found = df_rows["row"].is_not_null().to_numpy()
+        shards = df_rows["shard"].to_numpy()
+        rows = df_rows["row"].to_numpy()
+        for shard in df_rows["shard"].drop_nulls().unique().to_list():
+            in_shard = found & (shards == shard)
+            out[in_shard] = self.load_shard(shard)[rows[in_shard].astype(np.int64)]
+        return out, found
+
+    def write_descriptors_npz(
+        self, data_path: Path | str, out_path: Path | str, smiles_col: str = "CXSMILES"
+    ) -> Path:
+        """
+        Write descriptors for the rows of a CSV/Parquet file in the layout `chemprop --descriptors-path` expects.
+        """
+        smiles = scan_table(data_path).select(smiles_col).collect()[smiles_col]
+        X = self.get(smiles)
+        out_path = Path(out_path)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(out_path, X)
+        logger.info(f"Wrote {X.shape} descriptors for {data_path} to {out_path}.")
+        return out_path
+
+
+feature_store = FeatureStore()
+
+
+@stage("featurize")
+def featurize(n_workers: int | None = None) -> None:
+    """
+    Warm the feature store with every training set and the test set, in one go.
+    """
+    smiles = pl.concat(
+        [ds.read()["CXSMILES"] for ds in admet_train_combined.values()]
+        + [asap_test_raw.read()["CXSMILES"]]
+    )
+    feature_store.update(smiles, n_workers=n_workers)
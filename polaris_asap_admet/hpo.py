@@ -0,0 +1,302 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, replace
+from multiprocessing import get_context
+from pathlib import Path
+
+import optuna
+import polars as pl
+import psutil
+import torch
+from lightning.pytorch.callbacks import Callback
+from optuna.storages import RDBStorage, RetryHeartbeatStaleTrialCallback
+from optuna.trial import FixedTrial, TrialState
+
+from polaris_asap_admet.driver import RUNS_DIR, SMILES_COL, TrainConfig, train
+from polaris_asap_admet.conformers import conformer_store
+from polaris_asap_admet.features import feature_store
+from polaris_asap_admet.io import admet_train_combined, scan_table
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.molecules import ID_COL
+from polaris_asap_admet.scheduler import available_cores, plan
+from polaris_asap_admet.splits import dataset_split
+
+HPO_DIR = RUNS_DIR / "hpo"  # trial models and logs, runs/hpo/{target}/trial_{n}/
+# One SQLite file holds every target's study; point this at a server DB to search from several machines
+STORAGE = os.getenv("POLARIS_ASAP_ADMET_HPO_STORAGE", f"sqlite:///{HPO_DIR / 'studies.sqlite3'}")
+CONFIG_DIR = Path("configs")  # best config per target, for run_chemprop.py --config configs/{target}.json
+MAX_EPOCHS = 30  # what a trial that's never pruned trains for
+MIN_EPOCHS = 2  # what every trial gets before the pruner can stop it
+REDUCTION_FACTOR = 3  # keep the best 1/3 at each successive-halving rung
+HEARTBEAT_SECONDS = 60  # a trial silent for two heartbeats was interrupted; it's marked failed and retried once
+SAMPLERS = ["tpe", "random"]
+PRUNERS = ["hyperband", "sha", "none"]
+
+
+def suggest_config(trial: optuna.Trial, base: TrainConfig) -> TrainConfig:
+    """
+    The search space:  base with the model size, dropout, batch size and learning rate drawn by trial.
+    """
+    max_lr = trial.suggest_float("max_lr", 1e-4, 1e-2, log=True)
+    return replace(
+        base,
+        dropout=trial.suggest_float("dropout", 0.0, 0.5),
+        batch_size=trial.suggest_categorical("batch_size", [32, 64, 128]),
+        message_hidden_dim=trial.suggest_int("message_hidden_dim", 100, 600, step=100),
+        depth=trial.suggest_int("depth", 2, 6),
+        ffn_hidden_dim=trial.suggest_int("ffn_hidden_dim", 100, 600, step=100),
+        ffn_num_layers=trial.suggest_int("ffn_num_layers", 1, 3),
+        max_lr=max_lr,
+        init_lr=max_lr / 10,
+        final_lr=max_lr / 10,
+    )
+
+
+class ReportToTrial(Callback):
+    """
+    Report val_loss to the trial after every epoch, and stop training as soon as the pruner says it won't win.
+    """
+
+    def __init__(self, trial: optuna.Trial):
+        self.trial = trial
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+        val_loss = trainer.callback_metrics.get("val_loss")
+        if val_loss is None:
+            return
+        epoch = trainer.current_epoch + 1
+        self.trial.report(float(val_loss), epoch)
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f"val_loss {float(val_loss):.4f} after {epoch} epochs")
+
+
+class StopAtBudget:
+    """
+    Study callback:  stop once the study as a whole - every worker, every session - has used up
+    budget_cpu_seconds of trial CPU time, or finished n_trials.
+    """
+
+    def __init__(self, budget_cpu_seconds: float | None, n_trials: int | None):
+        self.budget_cpu_seconds = budget_cpu_seconds
+        self.n_trials = n_trials
+
+    def exhausted(self, study: optuna.Study) -> bool:
+        trials = study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED))
+        spent = sum(t.user_attrs.get("cpu_seconds", 0.0) for t in trials)
+        return (self.budget_cpu_seconds is not None and spent >= self.budget_cpu_seconds) or (
+            self.n_trials is not None and len(trials) >= self.n_trials
+        )
+
+    def __call__(self, study: optuna.Study, trial: optuna.trial.FrozenTrial) -> None:
+        if self.exhausted(study):
+            study.stop()
+
+
+def make_storage(url: str = STORAGE) -> RDBStorage:
+    if url.startswith("sqlite:///"):
+        Path(url.removeprefix("sqlite:///")).parent.mkdir(parents=True, exist_ok=True)
+    # heartbeats and retries are "experimental", and have been since optuna 2.8
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", optuna.exceptions.ExperimentalWarning)
+        return RDBStorage(
+            url,
+            # several workers write to the one SQLite file; wait for the lock rather than failing
+            engine_kwargs={"connect_args": {"timeout": 60}} if url.startswith("sqlite") else None,
+            heartbeat_interval=HEARTBEAT_SECONDS,
+            grace_period=2 * HEARTBEAT_SECONDS,
+            heartbeat_stale_trial_callback=RetryHeartbeatStaleTrialCallback(max_retry=1),
+        )
+
+
+def make_sampler(name: str, seed: int) -> optuna.samplers.BaseSampler:
+    if name == "tpe":
+        # constant_liar: concurrent workers treat each other's running trials as bad, so they don't pile onto one spot
+        return optuna.samplers.TPESampler(seed=seed, constant_liar=True)
+    if name == "random":
+        return optuna.samplers.RandomSampler(seed=seed)
+    raise ValueError(f"Unknown sampler {name!r}, expected one of {SAMPLERS}")
+
+
+def make_pruner(name: str, max_epochs: int) -> optuna.pruners.BasePruner:
+    if name == "hyperband":
+        return optuna.pruners.HyperbandPruner(MIN_EPOCHS, max_epochs, REDUCTION_FACTOR)
+    if name == "sha":
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=MIN_EPOCHS, reduction_factor=REDUCTION_FACTOR)
+    if name == "none":
+        return optuna.pruners.NopPruner()
+    raise ValueError(f"Unknown pruner {name!r}, expected one of {PRUNERS}")
+
+
+def load_study(
+    target: str, storage: str = STORAGE, sampler: str = "tpe", pruner: str = "hyperband", seed: int = 0,
+    max_epochs: int = MAX_EPOCHS,
+) -> optuna.Study:
+    """
+    The study for target, creating it if need be.  Samplers and pruners aren't stored with the study,
+    so every process that works on it builds its own.
+    """
+    return optuna.create_study(
+        study_name=target,
+        storage=make_storage(storage),
+        sampler=make_sampler(sampler, seed),
+        pruner=make_pruner(pruner, max_epochs),
+        direction="minimize",
+        load_if_exists=True,
+    )
+
+
+def _cpu_seconds() -> float:
+    """
+    CPU time of this process and its children:  dataloader workers (and anything else a trial starts)
+    count, whether they've exited or are still running.
+    """
+    proc = psutil.Process()
+    t = proc.cpu_times()
+    live = 0.0
+    for child in proc.children(recursive=True):
+        try:
+            child_t = child.cpu_times()
+        except psutil.NoSuchProcess:
+            continue
+        live += child_t.user + child_t.system
+    return t.user + t.system + t.children_user + t.children_system + live
+
+
+def _objective(
+    trial: optuna.Trial, df_train: pl.DataFrame, target_cols: list[str], base: TrainConfig, split: tuple | None
+) -> float:
+    """
+    Best val_loss of one training run.  Every trial uses base's split, so they're scored on the same molecules.
+    """
+    config = suggest_config(trial, base)
+    start = _cpu_seconds()
+    try:
+        result = train(
+            df_train, target_cols, HPO_DIR / trial.study.study_name / f"trial_{trial.number}", config,
+            split=split, callbacks=[ReportToTrial(trial)],
+        )
+    finally:
+        # all threads of this process and its children, pruned or not:  what the budget counts
+        trial.set_user_attr("cpu_seconds", _cpu_seconds() - start)
+    for name, value in result.test_scores.items():
+        trial.set_user_attr(name, value)
+    return result.best_val_loss
+
+
+def _search_worker(
+    worker: int,
+    target: str,
+    train_path: str,
+    storage: str,
+    sampler: str,
+    pruner: str,
+    base: TrainConfig,
+    n_trials: int | None,
+    budget_cpu_seconds: float | None,
+    threads: int,
+) -> None:
+    """
+    Run trials until the study's budget is spent.  Runs in a worker process (or in-process with one job).
+    """
+    torch.set_num_threads(threads)
+    study = load_study(target, storage, sampler, pruner, seed=base.data_seed + worker, max_epochs=base.epochs)
+    stop = StopAtBudget(budget_cpu_seconds, n_trials)
+    if stop.exhausted(study):
+        return
+    df_train = scan_table(train_path).collect()
+    target_cols = [c for c in df_train.columns if c not in (SMILES_COL, ID_COL)]
+    split = dataset_split(train_path, base.split_type, base.split_sizes, base.data_seed)
+    study.optimize(
+        lambda trial: _objective(trial, df_train, target_cols, base, split),
+        callbacks=[stop],
+        # a trial that blows up (bad config, OOM) is recorded as failed; the search goes on
+        catch=(RuntimeError, ValueError),
+    )
+
+
+def export_best_config(target: str, storage: str = STORAGE) -> TrainConfig:
+    """
+    Write the best trial's config so far to configs/{target}.json, and return it.
+    """
+    study = load_study(target, storage)
+    base = TrainConfig(**study.user_attrs["base_config"])
+    config = suggest_config(FixedTrial(study.best_trial.params), base)
+    path = CONFIG_DIR / f"{target}.json"
+    config.save(path)
+    logger.info(f"Best {target} config (trial {study.best_trial.number}, val_loss {study.best_value:.4f}) written to {path}.")
+    return config
+
+
+@stage("hpo_search")
+def search(
+    target: str,
+    n_trials: int | None = None,
+    budget_cpu_hours: float | None = None,
+    n_jobs: int | None = None,
+    sampler: str = "tpe",
+    pruner: str = "hyperband",
+    max_epochs: int = MAX_EPOCHS,
+    storage: str = STORAGE,
+    train_path: Path | str | None = None,
+    base: TrainConfig | None = None,
+) -> TrainConfig:
+    """
+    Search target's hyperparameters until the study has n_trials finished trials or has spent budget_cpu_hours
+    of CPU time, whichever comes first, then write the best config to configs/{target}.json.
+
+    Trials report val_loss every epoch and the pruner (Hyperband or successive halving, on epochs) stops the ones
+    that won't win, so most of the budget goes to promising configs.  n_jobs trials run at once, each in its own
+    process, all sharing the study in storage - so the last few may overshoot n_trials by up to n_jobs - 1.
+    The budget and trial count are for the study, not the call:  interrupt it and run it again to pick up
+    where it stopped.
+    """
+    if n_trials is None and budget_cpu_hours is None:
+        raise ValueError("Give a budget: n_trials, budget_cpu_hours, or both.")
+    train_path = str(train_path or admet_train_combined[target].filepath)
+    budget_cpu_seconds = budget_cpu_hours * 3600 if budget_cpu_hours is not None else None
+
+    # Featurize once, up front, so the workers only read the feature store
+    smiles = scan_table(train_path).select(SMILES_COL).collect()[SMILES_COL]
+    feature_store.update(smiles)
+    if base and base.shape_descriptors:
+        conformer_store.update(smiles)
+
+    cores = available_cores()
+    if n_jobs is None:
+        n_jobs = plan(n_trials or cores, cores, psutil.virtual_memory().available / 1024**3)[0]
+    threads = max(1, cores // n_jobs)
+    base = replace(base or TrainConfig(), epochs=max_epochs, num_workers=threads // 4)
+
+    # ...and split once, so the workers only read the split
+    dataset_split(train_path, base.split_type, base.split_sizes, base.data_seed)
+
+    study = load_study(target, storage, sampler, pruner, seed=base.data_seed, max_epochs=max_epochs)
+    if "base_config" not in study.user_attrs:
+        study.set_user_attr("base_config", asdict(base))
+    done = len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED)))
+    logger.info(
+        f"Searching {target} ({sampler} sampling, {pruner} pruning, up to {max_epochs} epochs a trial) "
+        f"with {n_jobs} jobs x {threads} threads; {done} trials done already, "
+        f"budget {n_trials} trials / {budget_cpu_hours} CPU hours..."
+    )
+
+    args = (target, train_path, storage, sampler, pruner, base, n_trials, budget_cpu_seconds, threads)
+    if n_jobs == 1:
+        _search_worker(0, *args)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=get_context("spawn")) as pool:
+            for future in [pool.submit(_search_worker, worker, *args) for worker in range(n_jobs)]:
+                future.result()
+
+    trials = study.get_trials(deepcopy=False)
+    states = pl.Series([t.state.name for t in trials]).value_counts().rows()
+    cpu_hours = sum(t.user_attrs.get("cpu_seconds", 0.0) for t in trials) / 3600
+    logger.info(f"{target} study: {len(trials)} trials {dict(states)}, {cpu_hours:.3f} CPU hours.")
+    metrics = current_stage()
+    metrics.tags.update(target=target, n_jobs=n_jobs)
+    metrics.rows_out = len(trials)
+    return export_best_config(target, storage)
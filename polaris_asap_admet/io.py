@@ -1,176 +1,315 @@
+import ast
+import hashlib
+import importlib.util
+import json
 import os
-from dataclasses import dataclass
+import warnings
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import cache
 from pathlib import Path
 
 import polars as pl
 
 from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import record_read, record_write
 from polaris_asap_admet.util import print_info
 
-pl.Config(tbl_rows=500)
-pl.Config(fmt_str_lengths=500)
+# Subdirectories of the data dir.  Dataset paths below are relative to it, so importing this module
+# doesn't need POLARIS_ASAP_ADMET_HOME set - it's only read when a path is first used.
+RAW = Path("raw")
+CLEAN = Path("clean")
+DIRTY = Path("dirty")
+COMBINED = Path("combined")
+_DATA_DIRS = {
+    "DATA_DIR": Path(),
+    "DATA_DIR_RAW": RAW,
+    "DATA_DIR_CLEAN": CLEAN,
+    "DATA_DIR_DIRTY": DIRTY,
+    "DATA_DIR_COMBINED": COMBINED,
+}
+
+
+@cache
+def data_dir() -> Path:
+    return Path(os.environ["POLARIS_ASAP_ADMET_HOME"]) / "data"
+
+
+def __getattr__(name: str) -> Path:
+    # DATA_DIR, DATA_DIR_RAW etc. still work, they're just resolved on first access
+    if name in _DATA_DIRS:
+        return data_dir() / _DATA_DIRS[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# What every Parquet file we write gets; statistics let scans skip row groups on predicates
+PARQUET_OPTIONS = {"compression": "zstd", "statistics": True}
+
+
+def migrate_csv(path: Path | str) -> bool:
+    """
+    If path is a .parquet file that doesn't exist yet but a .csv of the same name does, convert it.
+    Everything used to be CSV; this lets old data dirs keep working.
+    """
+    path = Path(path)
+    csv_path = path.with_suffix(".csv")
+    if path.suffix != ".parquet" or path.exists() or not csv_path.exists():
+        return False
+    logger.info(f"Migrating {csv_path} to {path}...")
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    pl.read_csv(csv_path).write_parquet(tmp_path, **PARQUET_OPTIONS)
+    os.replace(tmp_path, path)
+    return True
+
+
+def scan_table(path: Path | str) -> pl.LazyFrame:
+    """
+    Lazily scan a CSV or Parquet file, migrating CSV to Parquet first if need be (see migrate_csv).
+    Files keyed by mol_id alone get their SMILES back from the molecule table, as a CXSMILES column.
+    """
+    migrate_csv(path)
+    record_read(path)
+    if str(path).endswith(".parquet"):
+        lf = pl.scan_parquet(path)
+        columns = lf.collect_schema().names() if os.path.exists(path) else []
+        if "mol_id" in columns and "CXSMILES" not in columns:
+            from polaris_asap_admet.molecules import molecule_table
+
+            return molecule_table.with_smiles(lf, source=path)
+        return lf
+    elif str(path).endswith(".csv"):
+        return pl.scan_csv(path)
+    raise ValueError(f"Unsupported file format: {path}")
+
+
+def file_hash(path: Path | str) -> str | None:
+    if not Path(path).exists():
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
 
-POLARIS_ASAP_ADMET_HOME = os.environ["POLARIS_ASAP_ADMET_HOME"]
-DATA_DIR = Path(POLARIS_ASAP_ADMET_HOME) / "data"
-DATA_DIR_RAW = DATA_DIR / "raw"
-DATA_DIR_CLEAN = DATA_DIR / "clean"
-DATA_DIR_DIRTY = DATA_DIR / "dirty"
-DATA_DIR_COMBINED = DATA_DIR / "combined"
+PACKAGE = "polaris_asap_admet"
 
-# yeah don't do this, but we'll live with it
-DATA_DIR_RAW.mkdir(parents=True, exist_ok=True)
-DATA_DIR_CLEAN.mkdir(parents=True, exist_ok=True)
-DATA_DIR_DIRTY.mkdir(parents=True, exist_ok=True)
-DATA_DIR_COMBINED.mkdir(parents=True, exist_ok=True)
+
+@cache
+def _package_imports(origin: str, mtime_ns: int) -> frozenset[str]:
+    """
+    The polaris_asap_admet modules a source file imports, anywhere in it (function-level imports too).
+    """
+    with open(origin) as f:
+        tree = ast.parse(f.read(), origin)
+    found = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            found.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            found.add(node.module)
+            if node.module == PACKAGE:  # from polaris_asap_admet import io
+                found.update(f"{PACKAGE}.{alias.name}" for alias in node.names)
+    return frozenset(m for m in found if m.startswith(f"{PACKAGE}.") and importlib.util.find_spec(m))
+
+
+def code_hash(producer: str | None) -> str | None:
+    """
+    Hash of the source of the module a producer ("module:function") lives in, and of every
+    polaris_asap_admet module it imports, transitively - so a change to mol.py marks whatever
+    sources.py builds stale too.
+    Found via importlib.util.find_spec and read with ast, so we don't import anything heavy just to check staleness.
+    """
+    if producer is None:
+        return None
+    todo, origins = [producer.split(":")[0]], {}
+    while todo:
+        module = todo.pop()
+        spec = importlib.util.find_spec(module)
+        if module in origins or not spec or not spec.origin:
+            continue
+        origins[module] = spec.origin
+        todo.extend(_package_imports(spec.origin, os.stat(spec.origin).st_mtime_ns))
+    h = hashlib.sha256()
+    for module in sorted(origins):
+        h.update(f"{module} {file_hash(origins[module])}\n".encode())
+    return h.hexdigest() if origins else None
 
 
 @dataclass
 class NamedDataset:
     """
-    put a tags dict in here someday or something
+    A dataset on disk, plus how it gets made:  the datasets it's built from (upstream) and the
+    function that builds it (producer, as "module:function" - a string, since producers import io),
+    called with producer_kwargs.  Datasets sharing a producer with different kwargs are built separately.
+
+    Every save() writes a sidecar {filepath}.manifest.json with the content hash of what was written,
+    the hash of the producer's code and the content hashes of the upstream datasets it was built from.
+    pipeline.py uses those to figure out what's stale.
     """
 
     name: str
-    filepath: Path | str
+    relpath: Path | str  # relative to data_dir()
+    upstream: list["NamedDataset"] = field(default_factory=list)
+    producer: str | None = None
+    producer_kwargs: dict = field(default_factory=dict)
 
-    def save(self, df: pl.DataFrame) -> None:
-        logger.info(f"Saving {self.name} to {self.filepath}...")
+    @property
+    def filepath(self) -> Path:
+        return data_dir() / self.relpath
+
+    @property
+    def manifest_path(self) -> Path:
+        return Path(f"{self.filepath}.manifest.json")
+
+    def read_manifest(self) -> dict | None:
+        if not self.manifest_path.exists():
+            return None
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def write_manifest(self) -> None:
+        manifest = {
+            "name": self.name,
+            "content_hash": file_hash(self.filepath),
+            "code_hash": code_hash(self.producer),
+            "producer": self.producer,
+            "upstream": {ds.name: file_hash(ds.filepath) for ds in self.upstream},
+            "built_at": datetime.now().isoformat(),
+        }
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def _write(self, df: pl.DataFrame, path: Path) -> None:
         if str(self.filepath).endswith(".csv"):
-            df.write_csv(self.filepath)
+            df.write_csv(path)
         elif str(self.filepath).endswith(".parquet"):
-            df.write_parquet(self.filepath)
+            df.write_parquet(path, **PARQUET_OPTIONS)
         else:
             raise ValueError(f"Unsupported file format: {self.filepath}")
+
+    def save(self, df: pl.DataFrame) -> None:
+        logger.info(f"Saving {self.name} to {self.filepath}...")
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(f"{self.filepath}.tmp")
+        self._write(df, tmp_path)
+        os.replace(tmp_path, self.filepath)
+        record_write(self.filepath, rows=len(df))
+        self.write_manifest()
+        logger.info("Done.")
+
+    def sink(self, lf: pl.LazyFrame) -> None:
+        """
+        Like save(), but for a lazy query:  stream it to disk without materializing it, where polars can.
+        Queries the streaming engine doesn't support yet (e.g. joins) get collected and written instead.
+        """
+        logger.info(f"Sinking {self.name} to {self.filepath}...")
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(f"{self.filepath}.tmp")
+        with warnings.catch_warnings():
+            # polars 1.23 warns about the old streaming engine on every sink
+            warnings.filterwarnings("ignore", message=".*streaming engine.*", category=DeprecationWarning)
+            try:
+                if str(self.filepath).endswith(".parquet"):
+                    lf.sink_parquet(tmp_path, **PARQUET_OPTIONS)
+                else:
+                    lf.sink_csv(tmp_path)
+            except pl.exceptions.InvalidOperationError:
+                self._write(lf.collect(), tmp_path)
+        os.replace(tmp_path, self.filepath)
+        record_write(self.filepath)
+        self.write_manifest()
         logger.info("Done.")
 
+    def migrate(self) -> bool:
+        return migrate_csv(self.filepath)
+
+    def scan(self) -> pl.LazyFrame:
+        """
+        A LazyFrame over this dataset, so polars can push column selections and filters down into the read.
+        """
+        return scan_table(self.filepath)
+
     def read(
         self,
         show_columns: bool = False,
-        show_unique: bool = False,
+        show_unique: bool | None = None,
         n: int | None = None,
     ) -> pl.DataFrame:
         logger.info(f"Reading {self.name} from {self.filepath}...")
-        if str(self.filepath).endswith(".csv"):
-            df = pl.read_csv(self.filepath, n_rows=n)
-        elif str(self.filepath).endswith(".parquet"):
-            df = pl.read_parquet(self.filepath, n_rows=n)
-        else:
-            raise ValueError(f"Unsupported file format: {self.filepath}")
+        lf = self.scan()
+        if n is not None:
+            lf = lf.head(n)
+        df = lf.collect()
         print_info(df, show_columns=show_columns, show_unique=show_unique)
         logger.info("Done.")
         return df
 
 
+DOWNLOAD = "polaris_asap_admet.download"
+BUILD = "polaris_asap_admet.sources:build_training_sets"
+
 asap_train_raw = NamedDataset(
-    name="asap_train_raw", filepath=DATA_DIR_RAW / "asap_train_raw.csv"
+    name="asap_train_raw",
+    relpath=RAW / "asap_train_raw.parquet",
+    producer=f"{DOWNLOAD}:download_comp_data",
 )
 asap_test_raw = NamedDataset(
-    name="asap_test_raw", filepath=DATA_DIR_RAW / "asap_test_raw.csv"
+    name="asap_test_raw",
+    relpath=RAW / "asap_test_raw.parquet",
+    producer=f"{DOWNLOAD}:download_comp_data",
 )
+# fetched as CSV (kept next to it, as raw/ADME_public_set_3521.csv) and converted
 computational_adme_raw = NamedDataset(
-    name="computational_adme_raw", filepath=DATA_DIR_RAW / "ADME_public_set_3521.csv"
-)
-
-##########################
-# computational-adme data
-##########################
-computational_adme_HLM_dirty = NamedDataset(
-    "computational_adme_HLM_dirty", DATA_DIR_DIRTY / "computational_adme_HLM_dirty.csv"
-)
-computational_adme_KSOL_dirty = NamedDataset(
-    "computational_adme_KSOL_dirty",
-    DATA_DIR_DIRTY / "computational_adme_KSOL_dirty.csv",
-)
-computational_adme_LogD_dirty = NamedDataset(
-    "computational_adme_LogD_dirty",
-    DATA_DIR_DIRTY / "computational_adme_LogD_dirty.csv",
-)
-computational_adme_MDR1_MDCKII_dirty = NamedDataset(
-    "computational_adme_MDR1_MDCKII_dirty",
-    DATA_DIR_DIRTY / "computational_adme_MDR1_MDCKII_dirty.csv",
-)
-computational_adme_MLM_dirty = NamedDataset(
-    "computational_adme_MLM_dirty", DATA_DIR_DIRTY / "computational_adme_MLM_dirty.csv"
-)
-
-computational_adme_dirty = {
-    "HLM": computational_adme_HLM_dirty,
-    "KSOL": computational_adme_KSOL_dirty,
-    "LogD": computational_adme_LogD_dirty,
-    "MDR1-MDCKII": computational_adme_MDR1_MDCKII_dirty,
-    "MLM": computational_adme_MLM_dirty,
-}
-
-computational_adme_HLM_converted = NamedDataset(
-    "computational_adme_HLM_converted",
-    DATA_DIR_DIRTY / "computational_adme_HLM_converted.csv",
-)
-computational_adme_KSOL_converted = NamedDataset(
-    "computational_adme_KSOL_converted",
-    DATA_DIR_DIRTY / "computational_adme_KSOL_converted.csv",
-)
-computational_adme_LogD_converted = NamedDataset(
-    "computational_adme_LogD_converted",
-    DATA_DIR_DIRTY / "computational_adme_LogD_converted.csv",
-)
-computational_adme_MDR1_MDCKII_converted = NamedDataset(
-    "computational_adme_MDR1_MDCKII_converted",
-    DATA_DIR_DIRTY / "computational_adme_MDR1_MDCKII_converted.csv",
-)
-computational_adme_MLM_converted = NamedDataset(
-    "computational_adme_MLM_converted",
-    DATA_DIR_DIRTY / "computational_adme_MLM_converted.csv",
-)
-
-computational_adme_converted = {
-    "HLM": computational_adme_HLM_converted,
-    "KSOL": computational_adme_KSOL_converted,
-    "LogD": computational_adme_LogD_converted,
-    "MDR1-MDCKII": computational_adme_MDR1_MDCKII_converted,
-    "MLM": computational_adme_MLM_converted,
-}
-
-##########################
-# ASAP-Discovery data, with just the columns we need for each target
-##########################
-asap_HLM_train = NamedDataset("asap_HLM_train", DATA_DIR_CLEAN / "asap_HLM_train.csv")
-asap_KSOL_train = NamedDataset(
-    "asap_KSOL_train", DATA_DIR_CLEAN / "asap_KSOL_train.csv"
+    name="computational_adme_raw",
+    relpath=RAW / "ADME_public_set_3521.parquet",
+    producer=f"{DOWNLOAD}:download_computational_adme",
 )
-asap_LogD_train = NamedDataset(
-    "asap_LogD_train", DATA_DIR_CLEAN / "asap_LogD_train.csv"
-)
-asap_MDR1_MDCKII_train = NamedDataset(
-    "asap_MDR1_MDCKII_train", DATA_DIR_CLEAN / "asap_MDR1_MDCKII_train.csv"
+tdc_lipophilicity_az_raw = NamedDataset(
+    "tdc_lipophilicity_az_raw",
+    RAW / "tdc_lipophilicity_az.parquet",
+    producer=f"{DOWNLOAD}:make_tdc_lipo_az",
 )
-asap_MLM_train = NamedDataset("asap_MLM_train", DATA_DIR_CLEAN / "asap_MLM_train.csv")
-
-asap_train_clean = {
-    "HLM": asap_HLM_train,
-    "KSOL": asap_KSOL_train,
-    "LogD": asap_LogD_train,
-    "MDR1-MDCKII": asap_MDR1_MDCKII_train,
-    "MLM": asap_MLM_train,
-}
 
 ##########################
 # ASAP-Discovery data combined with whatever we've added from Computational-ADME, TDC Commons, etc.
-# Should be suitable for training.
+# Should be suitable for training.  Built straight from the raw files, by the spec in sources.py -
+# upstream here should list the raw dataset of every Source there with an endpoint for that target.
+# Each is built on its own, so a change that only touches one target's sources only rebuilds that target.
 ##########################
 admet_HLM_train_combined = NamedDataset(
-    "admet_HLM_train", DATA_DIR_COMBINED / "admet_HLM_train.csv"
+    "admet_HLM_train",
+    COMBINED / "admet_HLM_train.parquet",
+    [computational_adme_raw, asap_train_raw],
+    BUILD,
+    {"targets": ["HLM"]},
 )
 admet_KSOL_train_combined = NamedDataset(
-    "admet_KSOL_train", DATA_DIR_COMBINED / "admet_KSOL_train.csv"
+    "admet_KSOL_train",
+    COMBINED / "admet_KSOL_train.parquet",
+    [computational_adme_raw, asap_train_raw],
+    BUILD,
+    {"targets": ["KSOL"]},
 )
 admet_LogD_train_combined = NamedDataset(
-    "admet_LogD_train", DATA_DIR_COMBINED / "admet_LogD_train.csv"
+    "admet_LogD_train",
+    COMBINED / "admet_LogD_train.parquet",
+    [tdc_lipophilicity_az_raw, asap_train_raw],
+    BUILD,
+    {"targets": ["LogD"]},
 )
 admet_MDR1_MDCKII_train_combined = NamedDataset(
-    "admet_MDR1_MDCKII_train", DATA_DIR_COMBINED / "admet_MDR1_MDCKII_train.csv"
+    "admet_MDR1_MDCKII_train",
+    COMBINED / "admet_MDR1_MDCKII_train.parquet",
+    [computational_adme_raw, asap_train_raw],
+    BUILD,
+    {"targets": ["MDR1-MDCKII"]},
 )
 admet_MLM_train_combined = NamedDataset(
-    "admet_MLM_train", DATA_DIR_COMBINED / "admet_MLM_train.csv"
+    "admet_MLM_train",
+    COMBINED / "admet_MLM_train.parquet",
+    [computational_adme_raw, asap_train_raw],
+    BUILD,
+    {"targets": ["MLM"]},
 )
 
 admet_train_combined = {
@@ -182,11 +321,21 @@ admet_train_combined = {
 }
 
 ##########################
-# TDC Commons datasets
+# All five targets in one wide table, for the multi-task model.  Missing endpoints are null.
 ##########################
-tdc_lipophilicity_az_raw = NamedDataset(
-    "tdc_lipophilicity_az_raw", DATA_DIR_RAW / "tdc_lipophilicity_az.csv"
-)
-tdc_lipophilicity_az_clean = NamedDataset(
-    "tdc_lipophilicity_az_raw", DATA_DIR_CLEAN / "tdc_lipophilicity_az.csv"
+admet_multitask_train = NamedDataset(
+    "admet_multitask_train",
+    COMBINED / "admet_multitask_train.parquet",
+    list(admet_train_combined.values()),
+    "polaris_asap_admet.multitask:make_multitask_train",
 )
+
+# Everything above, in dependency order
+DATASETS = [
+    asap_train_raw,
+    asap_test_raw,
+    computational_adme_raw,
+    tdc_lipophilicity_az_raw,
+    *admet_train_combined.values(),
+    admet_multitask_train,
+]
@@ -1,12 +1,32 @@
 import atexit as _atexit
+import json
 import os
+import socket
 import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
 
 from loguru import logger as loguru_logger
 
 LOGURU_LOG_LEVEL = os.getenv("POLARIS_ASAP_ADMET_LOG_LEVEL", "INFO")
 LOGURU_LOG_TO_FILE = bool(os.getenv("POLARIS_ASAP_ADMET_LOG_TO_FILE", False))
-__all__ = ["logger"]
+# For parallel runs:  sinks write from a background thread, and child processes (pool workers, run-parallel's
+# jobs) send their records here over a socket instead of writing to the terminal themselves - see collect_child_logs
+LOGURU_LOG_ENQUEUE = os.getenv("POLARIS_ASAP_ADMET_LOG_ENQUEUE", "0") != "0"
+# JSON lines, one per record, with stage, target, pid and elapsed time, e.g. log/polaris-asap-admet.jsonl
+LOGURU_LOG_JSON = os.getenv("POLARIS_ASAP_ADMET_LOG_JSON")
+# Set (by collect_child_logs) in the environment children inherit:  where to send their records
+LOG_SOCKET_VAR = "POLARIS_ASAP_ADMET_LOG_SOCKET"
+# Set by metrics.stage:  the stage (and target) a child process was started in, for its records to carry
+LOG_STAGE_VAR = "POLARIS_ASAP_ADMET_LOG_STAGE"
+_INHERITED_STAGE = json.loads(os.environ.get(LOG_STAGE_VAR, "{}"))
+MAX_DATAGRAM = 60_000  # bytes; a child's record longer than this gets its message cut
+# What a DEBUG call may cost in a hot loop when the level filters it out (see benchmark_logging)
+FILTERED_BUDGET_NS = 1000
+FILTERED_CASES = ["debug, constant", "debug, deferred args", "rate-limited debug"]
+__all__ = ["logger", "RateLimitedLogger"]
 
 LOGURU_LOG_FORMAT = (
     "<level>{level: <8}| </level>"
@@ -14,32 +34,293 @@ LOGURU_LOG_FORMAT = (
     "<cyan>{name}:{line:<4d}| </cyan>"
     "<level>{message}</level>"
 )
+# With several processes in the one stream, say whose each line is
+LOGURU_LOG_FORMAT_PID = LOGURU_LOG_FORMAT.replace("<cyan>", "<magenta>{extra[pid]: <7}| </magenta><cyan>", 1)
 
-# Maybe gonna need another handler at some point, but this is fine for now
-LOGURU_HANDLER = {
-    "sink": sys.stdout,
-    "level": LOGURU_LOG_LEVEL,
-    "colorize": True,
-    "format": LOGURU_LOG_FORMAT,
-    # The internet claims diagnose and backtrace may deadlock.  Maybe?  Don't know.
-    # But, official docs state that diagnose may leak info in prod, so beware
-    "backtrace": True,
-    "diagnose": False,
-}
 
-loguru_logger.configure(handlers=[LOGURU_HANDLER])
+def _add_context(record) -> None:
+    """
+    Patcher:  the pid and, inside a metrics stage, the stage, its target and how long it's been running.
+    A child process started inside a stage gets that stage and target.
+    Only runs for records some sink wants - filtered-out ones never get this far.
+    """
+    extra = record["extra"]
+    extra.setdefault("pid", record["process"].id)
+    metrics = sys.modules.get("polaris_asap_admet.metrics")  # not imported, no stages
+    current = metrics.current_stage() if metrics else None
+    if current is not None:
+        extra.setdefault("stage", current.stage)
+        extra.setdefault("target", current.tags.get("target"))
+        extra.setdefault(
+            "stage_elapsed", (datetime.now() - datetime.fromisoformat(current.started_at)).total_seconds()
+        )
+    elif _INHERITED_STAGE:
+        extra.setdefault("stage", _INHERITED_STAGE["stage"])
+        extra.setdefault("target", _INHERITED_STAGE["target"])
+
+
+def _record_dict(record) -> dict:
+    extra = record["extra"]
+    out = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "name": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "pid": extra.get("pid", record["process"].id),
+        "elapsed": extra.get("elapsed", record["elapsed"].total_seconds()),
+        "stage": extra.get("stage"),
+        "target": extra.get("target"),
+        "stage_elapsed": extra.get("stage_elapsed"),
+    }
+    if record["exception"] is not None:
+        import traceback
+
+        out["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    return out
+
+
+class _JsonLinesSink:
+    """
+    One JSON object per line, written in one append - so processes that each have their own sink on the
+    same file (without collect_child_logs) don't split each other's lines.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+
+    def write(self, message) -> None:
+        line = json.dumps(_record_dict(message.record), default=str) + "\n"
+        with open(self.path, "a") as f:
+            f.write(line)
+
+
+class _SocketSink:
+    """
+    A child process's only sink:  each record goes to the parent's collector as one datagram.
+    No enqueue here - pool workers exit without running atexit, and anything still queued would be lost;
+    a datagram send is a few microseconds anyway.
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def write(self, message) -> None:
+        data = json.dumps(_record_dict(message.record), default=str).encode()
+        if len(data) > MAX_DATAGRAM:
+            record = _record_dict(message.record)
+            record["message"] = record["message"][: MAX_DATAGRAM // 2] + " ...[cut]"
+            record.pop("exception", None)
+            data = json.dumps(record, default=str).encode()
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError:
+            # the collector's gone (parent exited, or this was started some other way):  don't lose it
+            sys.stderr.write(message)
+
+
+class _Collector:
+    """
+    The parent's end:  receives child records and re-emits them through this process's sinks, in the order
+    they arrive, with the child's time, pid, module and line.
+    """
+
+    def __init__(self):
+        self.address = os.path.join(tempfile.gettempdir(), f"polaris-asap-admet-log-{os.getpid()}.sock")
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.address)
+        self.thread = threading.Thread(target=self._run, name="log-collector", daemon=True)
+        self.thread.start()
+
+    def _emit(self, data: bytes) -> None:
+        record = json.loads(data)
+        message = record["message"]
+        if record.get("exception"):
+            message = f"{message}\n{record['exception']}"
+
+        def patch(r):
+            # loguru's own datetime subclass, which knows its format tokens
+            when = type(r["time"]).fromisoformat(record["time"])
+            r.update(name=record["name"], function=record["function"], line=record["line"], time=when)
+
+        extra = {k: record[k] for k in ("pid", "elapsed", "stage", "target", "stage_elapsed") if record[k] is not None}
+        logger.patch(patch).bind(**extra).log(record["level"], "{}", message)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM + 4096)
+            except OSError:
+                return
+            try:
+                self._emit(data)
+            except Exception as e:
+                sys.stderr.write(f"Couldn't re-emit a child's log record ({e!r}): {data[:200]!r}\n")
+
+    def stop(self) -> None:
+        # Children are done by the time we exit; pick up whatever they sent that the thread hasn't yet
+        self.sock.setblocking(False)
+        try:
+            while True:
+                self._emit(self.sock.recv(MAX_DATAGRAM + 4096))
+        except OSError:
+            pass
+        self.sock.close()
+        os.unlink(self.address)
 
-logger = loguru_logger
 
-if LOGURU_LOG_TO_FILE:
-    logger.add(
-        "log/polaris-asap-admet.log",
-        level=LOGURU_LOG_LEVEL,
-        rotation="1 day",
-        compression="zip",
-        serialize=False,
-        format="{time} | {level} | {name}:{function}:{line} - {message}",
-    )
-
-# Clean up the logger on exit
+_collector: _Collector | None = None
+
+
+def collect_child_logs() -> None:
+    """
+    Have every process started from now on - spawn pool workers, subprocesses, and theirs - send its log
+    records to this one, so they come out as one stream through this process's sinks.  Works through the
+    environment, so there's nothing to pass to pools.  On by default with POLARIS_ASAP_ADMET_LOG_ENQUEUE.
+    """
+    global _collector
+    if _collector is None and LOG_SOCKET_VAR not in os.environ:
+        _collector = _Collector()
+        os.environ[LOG_SOCKET_VAR] = _collector.address
+        _atexit.register(_collector.stop)
+
+
+def configure() -> None:
+    child_of = os.environ.get(LOG_SOCKET_VAR)
+    if child_of:
+        loguru_logger.configure(
+            handlers=[{"sink": _SocketSink(child_of).write, "level": LOGURU_LOG_LEVEL, "format": "{message}\n"}],
+            patcher=_add_context,
+        )
+        return
+
+    # Maybe gonna need another handler at some point, but this is fine for now
+    handlers = [
+        {
+            "sink": sys.stdout,
+            "level": LOGURU_LOG_LEVEL,
+            "colorize": True,
+            "format": LOGURU_LOG_FORMAT_PID if LOGURU_LOG_ENQUEUE else LOGURU_LOG_FORMAT,
+            # The internet claims diagnose and backtrace may deadlock.  Maybe?  Don't know.
+            # But, official docs state that diagnose may leak info in prod, so beware
+            "backtrace": True,
+            "diagnose": False,
+            "enqueue": LOGURU_LOG_ENQUEUE,
+        }
+    ]
+    if LOGURU_LOG_JSON:
+        handlers.append(
+            {"sink": _JsonLinesSink(LOGURU_LOG_JSON).write, "level": LOGURU_LOG_LEVEL, "enqueue": LOGURU_LOG_ENQUEUE}
+        )
+    loguru_logger.configure(handlers=handlers, patcher=_add_context)
+    if LOGURU_LOG_TO_FILE:
+        loguru_logger.add(
+            "log/polaris-asap-admet.log",
+            level=LOGURU_LOG_LEVEL,
+            rotation="1 day",
+            compression="zip",
+            serialize=False,
+            format="{time} | {level} | {name}:{function}:{line} - {message}",
+            enqueue=LOGURU_LOG_ENQUEUE,
+        )
+    if LOGURU_LOG_ENQUEUE:
+        collect_child_logs()
+
+
+logger = loguru_logger
+# Clean up the logger on exit (which, with enqueue, waits for the queue to drain).  Registered first,
+# so it runs last:  after the collector's picked up the last of the children's records.
 _atexit.register(logger.remove)
+configure()
+
+
+class RateLimitedLogger:
+    """
+    For messages that could come once per molecule:  at most per_second of them get through (in bursts of up to
+    burst), and with sample_every, every sample_every-th one does regardless.  The next one through says how
+    many were dropped in between.  Levels below POLARIS_ASAP_ADMET_LOG_LEVEL cost one comparison.
+
+        per_molecule = RateLimitedLogger(per_second=2)
+        for smi in smiles:
+            ...
+            per_molecule.warning("Couldn't parse {}", smi)
+    """
+
+    def __init__(self, per_second: float = 1.0, burst: int = 5, sample_every: int | None = None):
+        self.per_second = per_second
+        self.burst = burst
+        self.sample_every = sample_every
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.seen = 0
+        self.dropped = 0
+        self.min_level = logger.level(LOGURU_LOG_LEVEL).no
+
+    def _log(self, level: str, message: str, args, kwargs) -> None:
+        self.seen += 1
+        if not (self.sample_every and self.seen % self.sample_every == 0):
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.per_second)
+            self.last = now
+            if self.tokens < 1:
+                self.dropped += 1
+                return
+            self.tokens -= 1
+        if self.dropped:
+            message = f"{message} ({self.dropped} similar dropped)"
+            self.dropped = 0
+        logger.opt(depth=2).log(level, message, *args, **kwargs)
+
+    # The level check is inlined in each, so a filtered-out call is one comparison
+    def debug(self, message: str, *args, **kwargs) -> None:
+        if self.min_level <= 10:
+            self._log("DEBUG", message, args, kwargs)
+
+    def info(self, message: str, *args, **kwargs) -> None:
+        if self.min_level <= 20:
+            self._log("INFO", message, args, kwargs)
+
+    def warning(self, message: str, *args, **kwargs) -> None:
+        if self.min_level <= 30:
+            self._log("WARNING", message, args, kwargs)
+
+
+def benchmark_logging(n: int = 200_000) -> dict[str, float]:
+    """
+    Nanoseconds per call of the ways we log in hot loops, at the current level.  Raises if the filtered-out
+    ones (DEBUG, at the default INFO) cost more than FILTERED_BUDGET_NS - f-strings and opt(lazy=True) are
+    measured but not held to it, since they pay for formatting or a new logger either way; use deferred
+    args ("{}", x) or a RateLimitedLogger in loops.  Emitted messages aren't measured:  that's the sinks' cost.
+    """
+    x = 3.14159
+
+    def timed(fn) -> float:
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - start) / n * 1e9
+
+    baseline = timed(lambda: None)
+    per_molecule = RateLimitedLogger(per_second=0, burst=0)  # drops everything, so the emit cost stays out
+    cases = {
+        "debug, constant": lambda: logger.debug("featurized a molecule"),
+        "debug, f-string": lambda: logger.debug(f"featurized a molecule with value {x:.3f}"),
+        "debug, deferred args": lambda: logger.debug("featurized a molecule with value {:.3f}", x),
+        "debug, lazy": lambda: logger.opt(lazy=True).debug("featurized a molecule with value {:.3f}", lambda: x),
+        "rate-limited debug": lambda: per_molecule.debug("featurized a molecule with value {:.3f}", x),
+        "rate-limited warning, dropped": lambda: per_molecule.warning("couldn't parse {}", x),
+    }
+    results = {name: timed(fn) - baseline for name, fn in cases.items()}
+    print(f"Logging cost at level {LOGURU_LOG_LEVEL}, ns per call over {n} calls (minus a {baseline:.0f} ns empty call):")
+    for name, ns in results.items():
+        print(f"  {name:<32}{ns:>8.0f}")
+    if logger.level(LOGURU_LOG_LEVEL).no > logger.level("DEBUG").no:
+        over = {k: round(results[k]) for k in FILTERED_CASES if results[k] > FILTERED_BUDGET_NS}
+        if over:
+            raise RuntimeError(f"Filtered-out logging calls over the {FILTERED_BUDGET_NS} ns budget: {over}")
+    return results
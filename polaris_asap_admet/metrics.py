@@ -0,0 +1,258 @@
+import cProfile
+import fnmatch
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+
+from polaris_asap_admet.logger import LOG_STAGE_VAR, logger
+
+# Append-only JSON lines, one per stage run.  Defaults to {data dir}/metrics/stages.jsonl.
+METRICS_PATH = os.getenv("POLARIS_ASAP_ADMET_METRICS_PATH")
+METRICS_ENABLED = os.getenv("POLARIS_ASAP_ADMET_METRICS", "1") != "0"
+# cProfile every stage whose name matches this glob, e.g. "download_*" or "*"
+PROFILE_STAGES = os.getenv("POLARIS_ASAP_ADMET_PROFILE")
+
+_current: ContextVar["StageMetrics | None"] = ContextVar("current_stage", default=None)
+_depth: ContextVar[int] = ContextVar("stage_depth", default=0)  # how many stages this one is nested in
+# Stages running in this process, across threads.  The RSS high-water mark and os.environ are process-wide,
+# so a stage only touches them when every active stage is one it's nested in.
+_active = 0
+_active_lock = threading.Lock()
+
+
+@dataclass
+class StageMetrics:
+    """
+    What one run of a stage cost.  rows/bytes in and out are filled in by NamedDataset as the stage
+    reads and writes datasets (see record_read/record_write); stages that don't go through
+    NamedDataset (train, predict) set rows_in/rows_out themselves.
+    """
+
+    stage: str
+    tags: dict = field(default_factory=dict)
+    pid: int = field(default_factory=os.getpid)
+    started_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    wall_time: float = 0.0
+    cpu_time: float = 0.0  # this process + any child processes reaped during the stage (e.g. pools)
+    peak_rss_mb: float = 0.0
+    rows_in: int | None = None
+    rows_out: int | None = None
+    bytes_read: int = 0
+    bytes_written: int = 0
+    ok: bool = True
+    profile: str | None = None  # cProfile stats, if this stage was profiled
+    inputs: dict = field(default_factory=dict)  # path -> (rows, bytes)
+    outputs: dict = field(default_factory=dict)
+
+    def summarize_io(self) -> None:
+        # A stage that reads back what it just wrote (to print a head(), say) didn't "read" it
+        inputs = {p: v for p, v in self.inputs.items() if p not in self.outputs}
+        if inputs and self.rows_in is None:
+            self.rows_in = _sum_rows(inputs.values())
+        if self.outputs and self.rows_out is None:
+            self.rows_out = _sum_rows(self.outputs.values())
+        self.bytes_read = sum(nbytes for _, nbytes in inputs.values())
+        self.bytes_written = sum(nbytes for _, nbytes in self.outputs.values())
+
+
+def _sum_rows(values) -> int | None:
+    rows = [r for r, _ in values]
+    return None if any(r is None for r in rows) else sum(rows)
+
+
+def metrics_path() -> Path:
+    if METRICS_PATH:
+        return Path(METRICS_PATH)
+    from polaris_asap_admet.io import data_dir
+
+    return data_dir() / "metrics" / "stages.jsonl"
+
+
+def current_stage() -> StageMetrics | None:
+    return _current.get()
+
+
+def record_read(path: Path | str, rows: int | None = None) -> None:
+    """
+    Note that the current stage (if any) read path.  Without rows, Parquet row counts come from the footer.
+    """
+    metrics = _current.get()
+    if metrics is None or str(path) in metrics.inputs:
+        return
+    metrics.inputs[str(path)] = (rows if rows is not None else _parquet_rows(path), _file_size(path))
+
+
+def record_write(path: Path | str, rows: int | None = None) -> None:
+    metrics = _current.get()
+    if metrics is None:
+        return
+    metrics.outputs[str(path)] = (rows if rows is not None else _parquet_rows(path), _file_size(path))
+
+
+def _file_size(path: Path | str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _parquet_rows(path: Path | str) -> int | None:
+    if not str(path).endswith(".parquet") or not os.path.exists(path):
+        return None
+    import polars as pl
+
+    return pl.scan_parquet(path).select(pl.len()).collect().item()
+
+
+def _reset_peak_rss() -> None:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:  # Linux only
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def _cpu_time() -> float:
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+@contextmanager
+def stage(name: str, **tags):
+    """
+    Measure a pipeline stage:  wall time, CPU time, peak RSS, rows and bytes in and out.
+    Appends one JSON line to metrics_path() when the stage finishes (or fails).
+
+        with stage("train", target="HLM") as m:
+            ...
+            m.rows_in = len(df)
+
+    Also works as a decorator, @stage("combine", target="HLM").  With POLARIS_ASAP_ADMET_PROFILE set to a
+    glob matching the stage name, the stage runs under cProfile and the stats go next to the metrics
+    file, in profiles/{stage}_{timestamp}.prof (open with snakeviz, or python -m pstats).
+    """
+    global _active
+    metrics = StageMetrics(stage=name, tags=tags)
+    outer, depth = _current.get(), _depth.get()
+    with _active_lock:
+        alone = _active == depth  # no stage on another thread is running
+        _active += 1
+    token, depth_token = _current.set(metrics), _depth.set(depth + 1)
+    profiler = None
+    if PROFILE_STAGES and fnmatch.fnmatch(name, PROFILE_STAGES):
+        profiler = cProfile.Profile()
+    # Where it's supported, reset the RSS high-water mark so the peak is this stage's; otherwise it's the process's.
+    # Only for the outermost stage, and only with no other stage running:  a reset would lose the peak those
+    # reached before it.  A nested or concurrent stage's peak is then an upper bound.
+    if outer is None and alone:
+        _reset_peak_rss()
+    # The pid makes it easy to point py-spy at a long stage:  py-spy record --pid <pid>
+    logger.debug(f"Stage {name} {tags or ''} starting in pid {metrics.pid}.")
+    # Processes started inside the stage (pool workers, subprocesses) log as part of it.  Stages running
+    # alongside one on another thread leave its tag alone; their processes log as part of that one.
+    outer_stage = os.environ.get(LOG_STAGE_VAR)
+    if alone:
+        os.environ[LOG_STAGE_VAR] = json.dumps({"stage": name, "target": tags.get("target")})
+    start_wall, start_cpu = time.perf_counter(), _cpu_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield metrics
+    except BaseException:
+        metrics.ok = False
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+        if alone:
+            if outer_stage is None:
+                os.environ.pop(LOG_STAGE_VAR, None)
+            else:
+                os.environ[LOG_STAGE_VAR] = outer_stage
+        with _active_lock:
+            _active -= 1
+        metrics.wall_time = time.perf_counter() - start_wall
+        metrics.cpu_time = _cpu_time() - start_cpu
+        metrics.peak_rss_mb = _peak_rss_mb()
+        _current.reset(token)
+        _depth.reset(depth_token)
+        metrics.summarize_io()
+        logger.info(
+            f"Stage {name}{' ' + str(tags) if tags else ''}: {metrics.wall_time:.2f}s wall, {metrics.cpu_time:.2f}s cpu, "
+            f"{metrics.peak_rss_mb:.0f} MB peak RSS, rows {metrics.rows_in} -> {metrics.rows_out}."
+        )
+        if METRICS_ENABLED:
+            _append(metrics, profiler)
+
+
+def _append(metrics: StageMetrics, profiler: cProfile.Profile | None) -> None:
+    path = metrics_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if profiler:
+        profile_path = path.parent / "profiles" / f"{metrics.stage}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof"
+        profile_path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(profile_path)
+        metrics.profile = str(profile_path)
+        logger.info(f"Wrote profile for {metrics.stage} to {profile_path}.")
+    record = asdict(metrics)
+    record.pop("inputs")
+    record["outputs"] = list(metrics.outputs)
+    # One short write in append mode, so parallel pipeline producers don't interleave lines
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def read_metrics(path: Path | str | None = None):
+    import polars as pl
+
+    path = Path(path or metrics_path())
+    if not path.exists():
+        return pl.DataFrame()
+    return pl.read_ndjson(path)
+
+
+def summarize_metrics(path: Path | str | None = None):
+    """
+    The latest run of every stage (per set of tags), slowest first.
+    """
+    import polars as pl
+
+    df = read_metrics(path)
+    if df.is_empty():
+        logger.info("No stage metrics recorded yet.")
+        return df
+    df = (
+        df.with_columns(
+            # ndjson unifies tags across lines, so drop the ones that don't apply to this stage
+            pl.col("tags").struct.json_encode().str.replace_all(r'"\w+":null,?', "").str.replace(",}", "}", literal=True)
+        )
+        .sort("started_at")
+        .group_by("stage", "tags")
+        .last()
+        .select(
+            "stage", "tags", "wall_time", "cpu_time", "peak_rss_mb",
+            "rows_in", "rows_out", "bytes_read", "bytes_written", "ok",
+        )
+        .sort("wall_time", descending=True)
+    )
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=250, fmt_str_lengths=80):
+        print(df)
+    return df
@@ -0,0 +1,177 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+import polars as pl
+
+from polaris_asap_admet.io import code_hash
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.molecules import ID_COL
+
+MODEL_CATALOG_PATH = Path("runs") / "model_cache.parquet"
+MODEL_CACHE_MAX_GB = float(os.getenv("POLARIS_ASAP_ADMET_MODEL_CACHE_MAX_GB", 20))
+# What a trained model depends on besides the data and the config.  A new version of any of these retrains.
+KEY_PACKAGES = ["chemprop", "descriptastorus", "lightning", "numpy", "polars", "rdkit", "torch"]
+# ...and these modules, along with every polaris_asap_admet module they import (features, splits, conformers, ...; see code_hash)
+KEY_CODE = ["polaris_asap_admet.driver"]
+# TrainConfig fields that don't change the model (just how it's trained), so don't go in the key
+UNKEYED_FIELDS = ["num_workers", "accelerator"]
+
+CATALOG_SCHEMA = {
+    "key": pl.String,
+    "target": pl.String,
+    "run_dir": pl.String,
+    "size_bytes": pl.Int64,
+    "created": pl.Datetime("us"),
+    "last_used": pl.Datetime("us"),
+}
+
+
+def _package_version(name: str) -> str | None:
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def training_key(df_train: pl.DataFrame, target_cols: list[str], config) -> tuple[str, dict]:
+    """
+    Hash of everything a trained model depends on:  the training rows (content, not file), the targets,
+    the TrainConfig (hyperparameters and split settings), the featurizer and training code, and the
+    versions of KEY_PACKAGES.  Returns the key and what went into it.
+    """
+    from polaris_asap_admet.features import FEATURIZER
+
+    inputs = {
+        # mol_id is just a label for the SMILES next to it
+        "data_sha256": hashlib.sha256(df_train.drop(ID_COL, strict=False).write_csv().encode()).hexdigest(),
+        "n_rows": len(df_train),
+        "target_cols": target_cols,
+        "config": {k: v for k, v in asdict(config).items() if k not in UNKEYED_FIELDS},
+        "featurizer": FEATURIZER,
+        "code": {module: code_hash(module) for module in KEY_CODE},
+        "packages": {name: _package_version(name) for name in KEY_PACKAGES},
+    }
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return key, inputs
+
+
+def _dir_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+@dataclass
+class ModelCache:
+    """
+    Catalog of trained run dirs by training_key, so an identical training run reuses best.pt instead
+    of training again.  A key can have several run dirs (after --retrain); lookups get the newest.
+
+    One Parquet file next to the runs, with each entry's size on disk and when it was last used.
+    When the catalogued runs add up to more than max_gb, the least recently used are deleted.
+    Only runs that went through the cache are catalogued; anything else in runs/ is left alone.
+    """
+
+    path: Path = MODEL_CATALOG_PATH
+    max_gb: float = MODEL_CACHE_MAX_GB
+
+    @contextmanager
+    def _locked(self):
+        # run-parallel trains every target at once, each in its own process, all updating the one catalog
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def load(self) -> pl.DataFrame:
+        if not self.path.exists():
+            return pl.DataFrame(schema=CATALOG_SCHEMA)
+        return pl.read_parquet(self.path)
+
+    def save(self, df_catalog: pl.DataFrame) -> None:
+        tmp_path = Path(f"{self.path}.{os.getpid()}.tmp")
+        df_catalog.write_parquet(tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, key: str) -> Path | None:
+        """
+        The newest run dir trained with this key that's still there (and mark it used).
+        """
+        with self._locked():
+            df_catalog = self.load()
+            for run_dir in df_catalog.filter(pl.col("key") == key).sort("created", descending=True)["run_dir"]:
+                if (Path(run_dir) / "model_0" / "best.pt").exists():
+                    break
+            else:
+                return None
+            self.save(
+                df_catalog.with_columns(
+                    pl.when(pl.col("run_dir") == run_dir)
+                    .then(pl.lit(datetime.now()))
+                    .otherwise("last_used")
+                    .alias("last_used")
+                )
+            )
+        return Path(run_dir)
+
+    def add(self, key: str, target: str, run_dir: Path, inputs: dict) -> None:
+        """
+        Catalog a freshly trained run dir, then collect garbage.
+        """
+        run_dir = Path(run_dir)
+        with open(run_dir / "training_key.json", "w") as f:
+            json.dump({"key": key, **inputs}, f, indent=2, default=str)
+        now = datetime.now()
+        df_new = pl.DataFrame(
+            [{"key": key, "target": target, "run_dir": str(run_dir), "size_bytes": _dir_size(run_dir),
+              "created": now, "last_used": now}],
+            schema=CATALOG_SCHEMA,
+        )
+        with self._locked():
+            self.save(self._collect(pl.concat([self.load(), df_new]), keep=str(run_dir)))
+
+    def _collect(self, df_catalog: pl.DataFrame, keep: str | None = None) -> pl.DataFrame:
+        """
+        Drop entries whose run dir is gone, then delete least recently used run dirs (never the keep dir)
+        until the rest fit in max_gb.  Returns what's left.
+        """
+        keep = keep or ""
+        df_catalog = df_catalog.filter(
+            pl.col("run_dir").map_elements(lambda d: Path(d).exists(), return_dtype=pl.Boolean)
+        )
+        df_catalog = df_catalog.sort(pl.col("run_dir") == keep, "last_used", descending=True).with_columns(
+            pl.col("size_bytes").cum_sum().alias("_total")
+        )
+        max_bytes = self.max_gb * 1024**3
+        df_evict = df_catalog.filter(pl.col("_total") > max_bytes, pl.col("run_dir") != keep)
+        for row in df_evict.iter_rows(named=True):
+            logger.info(
+                f"Model cache over {self.max_gb} GB:  deleting {row['run_dir']} "
+                f"({row['size_bytes'] / 1024**2:.1f} MB, last used {row['last_used']:%Y-%m-%d %H:%M})."
+            )
+            shutil.rmtree(row["run_dir"], ignore_errors=True)
+        return df_catalog.join(df_evict.select("run_dir"), on="run_dir", how="anti").drop("_total")
+
+    def gc(self) -> pl.DataFrame:
+        with self._locked():
+            df_catalog = self._collect(self.load())
+            self.save(df_catalog)
+        return df_catalog
+
+    def summarize(self) -> pl.DataFrame:
+        df_catalog = self.load().sort("last_used", descending=True)
+        print(df_catalog.with_columns((pl.col("size_bytes") / 1024**2).round(1).alias("size_mb")).drop("size_bytes"))
+        logger.info(
+            f"Model cache: {len(df_catalog)} runs, {df_catalog['size_bytes'].sum() / 1024**3:.2f} GB "
+            f"of {self.max_gb} GB."
+        )
+        return df_catalog
+
+
+model_cache = ModelCache()
@@ -0,0 +1,147 @@
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import polars as pl
+
+from polaris_asap_admet.logger import RateLimitedLogger, logger
+
+# Cheap per-molecule descriptors computed alongside parsing, as (RDKit module, function).
+# Anything that needs conformers or fingerprints doesn't belong here.
+# Names rather than functions, so importing this module doesn't import RDKit.
+DESCRIPTORS = {
+    "mol_wt": ("rdkit.Chem.Descriptors", "MolWt"),
+    "heavy_atom_count": ("rdkit.Chem.rdMolDescriptors", "CalcNumHeavyAtoms"),
+    "num_h_donors": ("rdkit.Chem.rdMolDescriptors", "CalcNumHBD"),
+    "num_h_acceptors": ("rdkit.Chem.rdMolDescriptors", "CalcNumHBA"),
+    "num_rotatable_bonds": ("rdkit.Chem.rdMolDescriptors", "CalcNumRotatableBonds"),
+    "tpsa": ("rdkit.Chem.rdMolDescriptors", "CalcTPSA"),
+    "mol_log_p": ("rdkit.Chem.Descriptors", "MolLogP"),
+}
+
+SCHEMA = {
+    "canonical_smiles": pl.String,
+    "inchikey": pl.String,
+    "mol_wt": pl.Float64,
+    "heavy_atom_count": pl.Int32,
+    "num_h_donors": pl.Int32,
+    "num_h_acceptors": pl.Int32,
+    "num_rotatable_bonds": pl.Int32,
+    "tpsa": pl.Float64,
+    "mol_log_p": pl.Float64,
+    "error": pl.String,
+}
+
+# Below this many rows, spinning up a process pool costs more than it saves.
+MIN_ROWS_FOR_POOL = 4096
+CHUNK_SIZE = 2048
+per_molecule = RateLimitedLogger(per_second=1)
+
+
+def _process_chunk(smiles: list[str | None]) -> dict[str, list]:
+    """
+    Parse a chunk of SMILES and compute DESCRIPTORS.  Runs in a worker process.
+    Failures are recorded per row in the "error" column rather than raised.
+    """
+    from rdkit import Chem, RDLogger
+
+    # RDKit spams stderr for every bad SMILES; we capture the failure ourselves
+    RDLogger.DisableLog("rdApp.*")
+    descriptors = {
+        name: getattr(importlib.import_module(module), fn)
+        for name, (module, fn) in DESCRIPTORS.items()
+    }
+    out = {k: [] for k in SCHEMA}
+    for smi in smiles:
+        row = dict.fromkeys(SCHEMA)
+        try:
+            mol = Chem.MolFromSmiles(smi) if smi is not None else None
+            if mol is None:
+                row["error"] = "null SMILES" if smi is None else "unparseable SMILES"
+                per_molecule.debug("{}: {!r}", row["error"], smi)
+            else:
+                row["canonical_smiles"] = Chem.MolToSmiles(mol)
+                row["inchikey"] = Chem.MolToInchiKey(mol) or None
+                for name, fn in descriptors.items():
+                    row[name] = fn(mol)
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+            per_molecule.warning("Processing {!r} failed: {}", smi, row["error"])
+        for k, v in row.items():
+            out[k].append(v)
+    return out
+
+
+def process_smiles(
+    smiles: pl.Series,
+    n_workers: int | None = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> pl.DataFrame:
+    """
+    Parse SMILES and compute canonical SMILES + cheap descriptors, in chunks on a process pool.
+
+    Returns a DataFrame with one row per input row (same order), the input column
+    (under its original name) and the SCHEMA columns.  Rows that failed have nulls
+    everywhere except "error".
+    """
+    values = smiles.cast(pl.String).to_list()
+    chunks = [values[i : i + chunk_size] for i in range(0, len(values), chunk_size)]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(chunks)))
+
+    logger.info(
+        f"Processing {len(values)} SMILES in {len(chunks)} chunks on {n_workers} workers..."
+    )
+    if n_workers == 1 or len(values) < MIN_ROWS_FOR_POOL:
+        results = [_process_chunk(c) for c in chunks]
+    else:
+        # spawn, not fork:  forking after polars has started its thread pool can deadlock the children
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+            results = list(pool.map(_process_chunk, chunks))
+
+    frames = [pl.DataFrame(r, schema=SCHEMA) for r in results]
+    df = pl.concat(frames) if frames else pl.DataFrame(schema=SCHEMA)
+    df = df.with_columns(smiles.alias(smiles.name)).select(smiles.name, *SCHEMA)
+    n_errors = df["error"].is_not_null().sum()
+    if n_errors:
+        logger.warning(f"{n_errors} of {len(df)} SMILES failed to process.")
+    logger.info("Done.")
+    return df
+
+
+def with_mol_properties(
+    df: pl.DataFrame,
+    smiles_col: str = "CXSMILES",
+    n_workers: int | None = None,
+    use_cache: bool = True,
+) -> pl.DataFrame:
+    """
+    Add the process_smiles columns to df, keeping its row order.  Duplicate SMILES are only processed once,
+    and with use_cache, only SMILES we haven't seen before are processed at all.
+    """
+    unique = df[smiles_col].unique(maintain_order=True)
+    if use_cache:
+        from polaris_asap_admet.mol_cache import mol_cache
+
+        props = mol_cache.lookup(unique, n_workers=n_workers)
+    else:
+        props = process_smiles(unique, n_workers=n_workers)
+    return df.join(props, on=smiles_col, how="left", join_nulls=True, maintain_order="left")
+
+
+def filter_valid_smiles(
+    df: pl.DataFrame | pl.LazyFrame, smiles_col: str = "CXSMILES"
+) -> pl.DataFrame | pl.LazyFrame:
+    """
+    Drop rows whose SMILES RDKit can't parse - chemprop will choke on them anyway.
+
+    For a LazyFrame only the SMILES column gets collected (RDKit needs real strings); the filter itself stays lazy.
+    """
+    if isinstance(df, pl.LazyFrame):
+        df_props = with_mol_properties(df.select(smiles_col).unique().collect(), smiles_col=smiles_col)
+        valid = df_props.filter(pl.col("error").is_null())[smiles_col]
+        return df.filter(pl.col(smiles_col).is_in(valid))
+    df_props = with_mol_properties(df.select(smiles_col), smiles_col=smiles_col)
+    return df.filter(df_props["error"].is_null())
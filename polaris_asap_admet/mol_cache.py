@@ -0,0 +1,144 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import polars as pl
+
+from polaris_asap_admet.io import data_dir
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.mol import SCHEMA, process_smiles
+
+MOL_CACHE_PATH = Path("cache") / "molecules.parquet"  # relative to the data dir
+MOL_CACHE_MAX_ROWS = int(os.getenv("POLARIS_ASAP_ADMET_MOL_CACHE_MAX_ROWS", 2_000_000))
+# Eviction only needs a rough LRU order, so hits don't rewrite the cache to bump last_used unless it's older than this
+LAST_USED_RESOLUTION = timedelta(days=1)
+
+CACHE_SCHEMA = {
+    "smiles_key": pl.String,
+    "smiles": pl.String,
+    **SCHEMA,
+    "last_used": pl.Datetime("us"),
+}
+
+
+def smiles_key(smiles: pl.Series) -> pl.Series:
+    """
+    Content hash of the input SMILES string (not the canonical form - we don't know that until we parse).
+    """
+    return pl.Series(
+        "smiles_key",
+        [
+            hashlib.sha1(s.encode()).hexdigest() if s is not None else None
+            for s in smiles.cast(pl.String)
+        ],
+        dtype=pl.String,
+    )
+
+
+@dataclass
+class MolCache:
+    """
+    On-disk, content-addressed cache of mol.process_smiles results, shared by every prep stage.
+
+    One Parquet file, keyed by a hash of the input SMILES.  Lookups are a join against
+    the cache; only misses get sent to the RDKit engine, and only misses (or hits not used
+    for LAST_USED_RESOLUTION) rewrite the file.  When the cache grows past max_rows, the
+    least recently used rows are evicted.
+    """
+
+    path: Path | None = None  # defaults to {data dir}/MOL_CACHE_PATH
+    max_rows: int = MOL_CACHE_MAX_ROWS
+
+    @property
+    def filepath(self) -> Path:
+        return Path(self.path) if self.path else data_dir() / MOL_CACHE_PATH
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False):
+        # parallel pipeline producers and run-parallel jobs all look up (and add to) the one cache
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.filepath}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def load(self) -> pl.DataFrame:
+        if not self.filepath.exists():
+            return pl.DataFrame(schema=CACHE_SCHEMA)
+        return pl.read_parquet(self.filepath)
+
+    def lookup(self, smiles: pl.Series, n_workers: int | None = None) -> pl.DataFrame:
+        """
+        Same contract as mol.process_smiles: one row per input row, in order,
+        with the input column plus the SCHEMA columns.
+        """
+        name = smiles.name
+        df_query = pl.DataFrame([smiles.cast(pl.String).alias("smiles"), smiles_key(smiles)])
+        with self._locked():
+            df_cache = self.load()
+
+        df_hits = df_query.join(
+            df_cache.drop("smiles"), on="smiles_key", how="left"
+        ).with_columns(pl.col("last_used").is_not_null().alias("_hit"))
+        df_misses = df_hits.filter(~pl.col("_hit") & pl.col("smiles").is_not_null())
+        df_misses = df_misses.unique("smiles_key", maintain_order=True)
+        n_hits = df_hits["_hit"].sum()
+        logger.info(
+            f"Molecule cache: {n_hits} hits, {len(df_misses)} misses ({len(df_cache)} cached)."
+        )
+
+        now = datetime.now()
+        df_new = pl.DataFrame(schema=CACHE_SCHEMA)
+        if len(df_misses):
+            # RDKit runs outside the lock; only the merge below holds it
+            df_new = process_smiles(df_misses["smiles"], n_workers=n_workers).with_columns(
+                smiles_key(df_misses["smiles"]),
+                pl.lit(now).alias("last_used"),
+            ).select(CACHE_SCHEMA.keys())
+            df_hits = df_query.join(pl.concat([df_cache, df_new]).drop("smiles"), on="smiles_key", how="left")
+
+        stale = df_hits.filter(pl.col("last_used") < now - LAST_USED_RESOLUTION)
+        if len(df_new) or len(stale):
+            touched = df_query["smiles_key"].unique()
+            with self._locked(exclusive=True):
+                # someone else may have added some of these since we read it
+                df_cache = self.load()
+                df_cache = pl.concat([df_cache, df_new.join(df_cache, on="smiles_key", how="anti")])
+                self.save(
+                    df_cache.with_columns(
+                        pl.when(pl.col("smiles_key").is_in(touched))
+                        .then(pl.lit(now))
+                        .otherwise(pl.col("last_used"))
+                        .alias("last_used")
+                    )
+                )
+
+        df_out = df_hits.select(pl.col("smiles").alias(name), *SCHEMA)
+        # null SMILES never make it into the cache
+        return df_out.with_columns(
+            pl.when(pl.col(name).is_null())
+            .then(pl.lit("null SMILES"))
+            .otherwise(pl.col("error"))
+            .alias("error")
+        )
+
+    def save(self, df_cache: pl.DataFrame) -> None:
+        if len(df_cache) > self.max_rows:
+            logger.info(
+                f"Molecule cache has {len(df_cache)} rows, evicting down to {self.max_rows}..."
+            )
+            df_cache = df_cache.sort("last_used", descending=True).head(self.max_rows)
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        # Write-then-rename, so a crash (or a concurrent stage) never leaves a truncated cache behind
+        tmp_path = Path(f"{self.filepath}.{os.getpid()}.tmp")
+        df_cache.write_parquet(tmp_path, compression="zstd")
+        os.replace(tmp_path, self.filepath)
+
+    def clear(self) -> None:
+        self.filepath.unlink(missing_ok=True)
+
+
+mol_cache = MolCache()
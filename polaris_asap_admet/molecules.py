@@ -0,0 +1,153 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+import polars as pl
+
+from polaris_asap_admet.io import data_dir
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.mol_cache import mol_cache
+
+MOLECULES_PATH = Path("molecules.parquet")  # relative to the data dir
+ID_COL = "mol_id"
+SMILES_COL = "CXSMILES"
+
+SCHEMA = {
+    ID_COL: pl.Int64,
+    "canonical_smiles": pl.String,
+}
+
+
+def mol_id(canonical_smiles: pl.Series) -> pl.Series:
+    """
+    A 63-bit hash of the canonical SMILES.  Derived from the molecule rather than handed out in order, so a
+    rebuilt table gives every molecule the same ID and files keyed by it never get remapped.  63 bits so it
+    reads back from CSV as an ordinary Int64.
+    """
+    return pl.Series(
+        ID_COL,
+        [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") >> 1 if s is not None else None
+            for s in canonical_smiles.cast(pl.String)
+        ],
+        dtype=pl.Int64,
+    )
+
+
+@dataclass
+class MoleculeTable:
+    """
+    Every molecule we've seen - in a training set, the test set or a prediction file - under one integer ID.
+
+    One Parquet file of (mol_id, canonical_smiles), and the only place SMILES are kept:  training sets,
+    dirty/ endpoints and prediction files store just the mol_id (see keyed), and scan_table joins the SMILES
+    back in (see with_smiles).  Molecules RDKit can't parse are keyed by their SMILES as written.
+    """
+
+    path: Path | None = None  # defaults to {data dir}/MOLECULES_PATH
+
+    @property
+    def filepath(self) -> Path:
+        return Path(self.path) if self.path else data_dir() / MOLECULES_PATH
+
+    @contextmanager
+    def _locked(self):
+        # run-parallel assigns IDs to the same test set from several processes at once
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.filepath}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def load(self) -> pl.DataFrame:
+        if not self.filepath.exists():
+            return pl.DataFrame(schema=SCHEMA)
+        return pl.read_parquet(self.filepath)
+
+    def save(self, df: pl.DataFrame) -> None:
+        tmp_path = Path(f"{self.filepath}.{os.getpid()}.tmp")
+        df.write_parquet(tmp_path, compression="zstd")
+        os.replace(tmp_path, self.filepath)
+
+    def ids(self, smiles: pl.Series, n_workers: int | None = None) -> pl.Series:
+        """
+        The mol_id of every SMILES, in order, registering the ones we haven't seen.  Null SMILES get null.
+        Canonicalization goes through the molecule cache, so only new spellings get parsed.
+        """
+        smiles = smiles.cast(pl.String).alias("_smiles")
+        df_props = mol_cache.lookup(smiles.unique().drop_nulls(), n_workers=n_workers)
+        df_keys = df_props.select("_smiles", pl.coalesce("canonical_smiles", "_smiles").alias("canonical_smiles"))
+        df_keys = df_keys.with_columns(mol_id(df_keys["canonical_smiles"]))
+        with self._locked():
+            df_table = self.load()
+            df_new = (
+                df_keys.select(ID_COL, "canonical_smiles")
+                .unique(maintain_order=True)
+                .join(df_table, on=ID_COL, how="anti")
+            )
+            df_table = pl.concat([df_table, df_new])
+            # 63 bits, so this should never happen - but if it did, two molecules would silently share an ID
+            clash = df_keys.join(df_table, on=ID_COL).filter(pl.col("canonical_smiles") != pl.col("canonical_smiles_right"))
+            if len(clash):
+                raise RuntimeError(f"mol_id collision: {clash}")
+            if len(df_new):
+                self.save(df_table)
+                logger.info(f"Registered {len(df_new)} new molecules ({len(df_table)} in the table).")
+        return smiles.to_frame().join(df_keys, on="_smiles", how="left", maintain_order="left")[ID_COL]
+
+    def with_ids(self, df: pl.DataFrame, smiles_col: str = SMILES_COL) -> pl.DataFrame:
+        """
+        df with a mol_id column first - as is, if it already has one.
+        """
+        if ID_COL in df.columns:
+            return df
+        return df.select(self.ids(df[smiles_col]), pl.all())
+
+    def keyed(self, df: pl.DataFrame, smiles_col: str = SMILES_COL) -> pl.DataFrame:
+        """
+        df with its SMILES column swapped for mol_id, for writing out.  with_smiles undoes it.
+        """
+        return self.with_ids(df, smiles_col).drop(smiles_col)
+
+    def with_smiles(self, lf: pl.LazyFrame, source: Path | str = "") -> pl.LazyFrame:
+        """
+        lf (keyed by mol_id) with its molecules' canonical SMILES as a CXSMILES column, first.
+        Raises if any of its IDs aren't in the table.
+        """
+        df_table = self.load().rename({"canonical_smiles": SMILES_COL})
+        unknown = lf.select(ID_COL).join(df_table.lazy(), on=ID_COL, how="anti").select(pl.len()).collect().item()
+        if unknown:
+            raise RuntimeError(
+                f"{unknown} mol_ids in {source or 'the table'} aren't in {self.filepath} - was it deleted?  "
+                f"`polaris-asap-admet prep-data` registers them again, under the same IDs."
+            )
+        columns = lf.collect_schema().names()
+        return lf.join(df_table.lazy(), on=ID_COL, how="left", maintain_order="left").select(SMILES_COL, *columns)
+
+    def missing_ids(self, path: Path | str) -> int:
+        """
+        How many of the mol_ids in a keyed Parquet file (one with mol_id and no SMILES) aren't in the table.
+        0 for anything else, or if the file doesn't exist.
+        """
+        if not str(path).endswith(".parquet") or not os.path.exists(path):
+            return 0
+        lf = pl.scan_parquet(path)
+        columns = lf.collect_schema().names()
+        if ID_COL not in columns or SMILES_COL in columns:
+            return 0
+        return lf.select(ID_COL).join(self.load().lazy(), on=ID_COL, how="anti").select(pl.len()).collect().item()
+
+    def smiles(self, ids: pl.Series) -> pl.Series:
+        """
+        Canonical SMILES for each mol_id, in order; null for IDs we don't have.
+        """
+        return (
+            ids.cast(pl.Int64)
+            .to_frame(ID_COL)
+            .join(self.load(), on=ID_COL, how="left", maintain_order="left")["canonical_smiles"]
+        )
+
+
+molecule_table = MoleculeTable()
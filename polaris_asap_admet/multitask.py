@@ -0,0 +1,148 @@
+import json
+import time
+from datetime import datetime
+
+import polars as pl
+
+from polaris_asap_admet.driver import (RUNS_DIR, SMILES_COL, TrainConfig,
+                                       load_datapoints, make_dataset, predict,
+                                       train)
+from polaris_asap_admet.io import (admet_multitask_train, admet_train_combined,
+                                   asap_test_raw)
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import stage
+from polaris_asap_admet.molecules import ID_COL, molecule_table
+from polaris_asap_admet.similarity import target_similarity
+from polaris_asap_admet.splits import dataset_split
+from polaris_asap_admet.util import print_info
+
+TARGETS = [
+    "HLM",
+    "KSOL",
+    "LogD",
+    "MDR1-MDCKII",
+    "MLM",
+]
+
+
+@stage("make_multitask_train")
+def make_multitask_train(save: bool = True) -> pl.DataFrame:
+    """
+    One wide training table over all five endpoints, from the combined per-target sets
+    (which already include the ASAP rows from asap_train_raw), one row per mol_id.
+    A molecule measured in several sources gets the mean; endpoints it wasn't measured for are null.
+    """
+    logger.info("Building multi-task training table...")
+    df_long = pl.concat(
+        [
+            molecule_table.with_ids(admet_train_combined[tgt].read())
+            .select(ID_COL, pl.lit(tgt).alias("target"), pl.col(tgt).cast(pl.Float64).alias("value"))
+            for tgt in TARGETS
+        ]
+    )
+    # grouping on the integer ID rather than pivoting on the SMILES string; scan_table puts the SMILES back
+    df = df_long.group_by(ID_COL, maintain_order=True).agg(
+        *[pl.col("value").filter(pl.col("target") == tgt).mean().alias(tgt) for tgt in TARGETS],
+    )
+    print_info(df)
+    logger.info(
+        f"Target coverage: {df.select(pl.col(TARGETS).is_not_null().mean()).row(0, named=True)}"
+    )
+    if save:
+        admet_multitask_train.save(df)
+    return df
+
+
+def run_multitask(config: TrainConfig | None = None) -> pl.DataFrame:
+    """
+    Train one masked-loss model over all five endpoints, and write all test predictions in one pass
+    to runs/multitask_{timestamp}_preds.csv.
+    """
+    config = config or TrainConfig()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_dir = RUNS_DIR / f"multitask_{timestamp}"
+    preds_file = RUNS_DIR / f"multitask_{timestamp}_preds.csv"
+
+    df_train = admet_multitask_train.read()
+    split = dataset_split(admet_multitask_train.filepath, config.split_type, config.split_sizes, config.data_seed)
+    result = train(df_train, TARGETS, output_dir, config, split=split)
+
+    df_test = asap_test_raw.read()
+    test_dset = make_dataset(load_datapoints(df_test, shape_descriptors=config.shape_descriptors))
+    preds = predict(result.model, test_dset, config)
+    df_preds = molecule_table.with_ids(df_test).select(ID_COL).with_columns(
+        [pl.Series(tgt, preds[:, i]) for i, tgt in enumerate(TARGETS)]
+    )
+    # The loss is masked per endpoint, so what matters is how close each molecule is to that endpoint's labels
+    df_preds = df_preds.with_columns(target_similarity(df_test[SMILES_COL], "multitask"))
+    df_preds.write_csv(preds_file)
+    logger.info(f"Wrote predictions to {preds_file}")
+    return df_preds
+
+
+def benchmark_multitask(config: TrainConfig | None = None) -> pl.DataFrame:
+    """
+    Time and score the five per-target models against the one multi-task model, on the same test set.
+
+    Scores are each model's own held-out KMEANS split, so they're comparable in aggregate,
+    not molecule-for-molecule.  Results go to runs/multitask_benchmark_{timestamp}.json.
+    """
+    config = config or TrainConfig()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    df_test = asap_test_raw.read()
+    test_dset = make_dataset(load_datapoints(df_test, shape_descriptors=config.shape_descriptors))
+    rows = []
+
+    start = time.perf_counter()
+    for tgt in TARGETS:
+        df_train = admet_train_combined[tgt].read()
+        split = dataset_split(admet_train_combined[tgt].filepath, config.split_type, config.split_sizes, config.data_seed)
+        result = train(
+            df_train, [tgt], RUNS_DIR / f"benchmark_{timestamp}" / tgt, config, split=split
+        )
+        predict(result.model, test_dset, config)
+        rows.append(
+            {
+                "mode": "per-target",
+                "target": tgt,
+                **{k.split("/")[1]: v for k, v in result.test_scores.items()},
+            }
+        )
+    per_target_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_train = admet_multitask_train.read()
+    split = dataset_split(admet_multitask_train.filepath, config.split_type, config.split_sizes, config.data_seed)
+    result = train(df_train, TARGETS, RUNS_DIR / f"benchmark_{timestamp}" / "multitask", config, split=split)
+    predict(result.model, test_dset, config)
+    multitask_time = time.perf_counter() - start
+    for tgt in TARGETS:
+        rows.append(
+            {
+                "mode": "multitask",
+                "target": tgt,
+                "r2": result.test_scores[f"{tgt}/r2"],
+                "mae": result.test_scores[f"{tgt}/mae"],
+            }
+        )
+
+    df = pl.DataFrame(rows)
+    print(df.pivot(on="mode", index="target", values=["r2", "mae"]))
+    logger.info(
+        f"Wall time: per-target {per_target_time:.1f}s, multitask {multitask_time:.1f}s "
+        f"({per_target_time / multitask_time:.1f}x)."
+    )
+    out = RUNS_DIR / f"multitask_benchmark_{timestamp}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(
+            {
+                "per_target_seconds": per_target_time,
+                "multitask_seconds": multitask_time,
+                "scores": rows,
+            },
+            f,
+            indent=2,
+        )
+    logger.info(f"Wrote {out}")
+    return df
@@ -0,0 +1,123 @@
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from polaris_asap_admet.io import DATASETS, NamedDataset, code_hash, file_hash
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.molecules import molecule_table
+
+
+def staleness(datasets: list[NamedDataset] = DATASETS) -> dict[str, str]:
+    """
+    {dataset name: why it needs rebuilding} for every stale dataset.  Datasets not in here are current.
+
+    A dataset is stale if it's missing, has no manifest, was changed outside the pipeline, its producer's
+    code changed, it's keyed by mol_ids the molecule table doesn't have (molecules.parquet was deleted, say - it's
+    the only place their SMILES are kept), an upstream dataset's content changed since it was built, or an
+    upstream dataset is stale.
+    Datasets with no upstream (downloads) are only rebuilt when missing.
+    """
+    stale = {}
+    for ds in datasets:  # DATASETS is in dependency order, so upstream reasons are already known
+        # Sources left as CSV (old data dirs) count once converted to Parquet.
+        # Derived datasets just show up as missing and get rebuilt as Parquet.
+        if not ds.upstream:
+            ds.migrate()
+        manifest = ds.read_manifest()
+        if not os.path.exists(ds.filepath):
+            reason = "missing"
+        elif not ds.upstream:
+            continue
+        elif manifest is None:
+            reason = "no manifest"
+        elif manifest["content_hash"] != file_hash(ds.filepath):
+            reason = "modified outside the pipeline"
+        elif manifest["code_hash"] != code_hash(ds.producer):
+            reason = f"code changed ({ds.producer})"
+        elif missing := molecule_table.missing_ids(ds.filepath):
+            reason = f"{missing} mol_ids missing from {molecule_table.filepath}"
+        else:
+            reason = None
+            for up in ds.upstream:
+                if up.name in stale:
+                    reason = f"upstream {up.name} is stale"
+                    break
+                if manifest["upstream"].get(up.name) != file_hash(up.filepath):
+                    reason = f"upstream {up.name} changed"
+                    break
+        if reason is not None:
+            stale[ds.name] = reason
+    return stale
+
+
+def _job(ds: NamedDataset) -> str | None:
+    """
+    What building ds runs, e.g. "polaris_asap_admet.sources:build_training_sets(targets=['KSOL'])".
+    Datasets with the same job are built by one call.
+    """
+    if ds.producer is None or not ds.producer_kwargs:
+        return ds.producer
+    return f"{ds.producer}({', '.join(f'{k}={v!r}' for k, v in sorted(ds.producer_kwargs.items()))})"
+
+
+def _run_producer(producer: str, kwargs: dict | None = None) -> str:
+    module, function = producer.split(":")
+    getattr(importlib.import_module(module), function)(**(kwargs or {}))
+    return producer
+
+
+def run_pipeline(
+    dry_run: bool = False,
+    n_workers: int | None = None,
+    datasets: list[NamedDataset] = DATASETS,
+) -> list[str]:
+    """
+    Rebuild only the stale datasets, running independent producers in parallel.
+
+    Works in waves: each wave runs every stale producer whose upstream is current, then staleness is
+    re-checked - so a producer that rewrites byte-identical output doesn't trigger its downstream.
+    A producer is called once per distinct producer_kwargs among its stale datasets (see _job).
+    With dry_run, just print what would be rebuilt and why.  Returns the jobs that were run.
+    """
+    by_name = {ds.name: ds for ds in datasets}
+    stale = staleness(datasets)
+    if not stale:
+        logger.info("Everything is up to date.")
+        return []
+    for name, reason in stale.items():
+        logger.info(f"{'Would rebuild' if dry_run else 'Stale'}: {name} ({reason}) <- {_job(by_name[name])}")
+    if dry_run:
+        return sorted({_job(by_name[name]) for name in stale})
+
+    ran = []
+    while stale:
+        jobs = {
+            _job(by_name[name]): by_name[name]
+            for name in stale
+            if not any(up.name in stale for up in by_name[name].upstream)
+        }
+        ready = sorted(jobs, key=str)
+        if None in ready:
+            missing = [name for name in stale if by_name[name].producer is None]
+            raise RuntimeError(
+                f"Don't know how to build {missing} - run `make download` first."
+            )
+        if not ready or set(ready) <= set(ran):
+            raise RuntimeError(f"Pipeline isn't making progress; still stale: {stale}")
+
+        logger.info(f"Running {len(ready)} producers: {ready}")
+        args = [(jobs[job].producer, jobs[job].producer_kwargs) for job in ready]
+        if len(ready) == 1:
+            _run_producer(*args[0])
+        else:
+            # spawn - staleness() has already run polars in this process, and forking after that can hang
+            with ProcessPoolExecutor(
+                max_workers=min(len(ready), n_workers or os.cpu_count() or 1),
+                mp_context=get_context("spawn"),
+            ) as pool:
+                list(pool.map(_run_producer, *zip(*args)))
+        ran.extend(ready)
+        stale = staleness(datasets)
+    logger.info(f"Done. Ran {len(ran)} jobs.")
+    return ran
@@ -0,0 +1,171 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import psutil
+
+from polaris_asap_admet.io import admet_train_combined, asap_test_raw
+from polaris_asap_admet.logger import logger
+
+# Same jobs as the run-* Makefile targets:  {job (what its run dirs are called): combined training set}
+JOBS = {
+    "HLM": "HLM",
+    "KSOL": "KSOL",
+    "LOGD": "LogD",
+    "MDR1-MDCKII": "MDR1-MDCKII",
+    "MLM": "MLM",
+}
+RUN_CHEMPROP = Path(__file__).resolve().parents[1] / "run_chemprop.py"
+
+# Rough peak RSS of one run_chemprop.py process on our data; used to decide how many fit at once
+MEM_PER_JOB_GB = float(os.getenv("POLARIS_ASAP_ADMET_MEM_PER_JOB_GB", 3))
+MIN_CORES_PER_JOB = 2
+
+
+@dataclass
+class Job:
+    target: str
+    train_path: str
+    test_path: str | None = None  # defaults to asap_test_raw
+    cores: int = 0
+    num_workers: int = 0
+    returncode: int | None = None
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    max_rss_mb: float = 0.0
+    tail: list[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.test_path = self.test_path or str(asap_test_raw.filepath)
+
+    def command(self) -> list[str]:
+        # cores covers both:  num_workers dataloader processes, and torch threads for the rest
+        return [
+            sys.executable,
+            str(RUN_CHEMPROP),
+            self.target,
+            self.train_path,
+            self.test_path,
+            "--num-workers",
+            str(self.num_workers),
+            "--threads",
+            str(max(1, self.cores - self.num_workers)),
+        ]
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def plan(n_jobs: int, cores: int, mem_gb: float) -> tuple[int, int, int]:
+    """
+    How many jobs to run at once, and how many cores / dataloader workers each one gets.
+
+    Cores are split evenly across the jobs that fit in memory; each job gets a quarter of its
+    cores as dataloader workers and the rest as torch threads.
+    """
+    max_by_mem = max(1, int(mem_gb // MEM_PER_JOB_GB))
+    max_by_cores = max(1, cores // MIN_CORES_PER_JOB)
+    n_parallel = max(1, min(n_jobs, max_by_mem, max_by_cores))
+    cores_per_job = max(1, cores // n_parallel)
+    num_workers = cores_per_job // 4
+    return n_parallel, cores_per_job, num_workers
+
+
+def _run_job(job: Job) -> None:
+    """
+    Run one job to completion, streaming its output through our logger.
+    """
+    env = dict(os.environ)
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        env[var] = str(job.cores)
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        job.command(),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+    )
+    for line in proc.stdout:
+        line = line.rstrip()
+        if line:
+            logger.info(f"[{job.target}] {line}")
+            job.tail = (job.tail + [line])[-20:]
+    # wait4 rather than proc.wait(), so we get the job's own rusage (including its dataloader workers)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    job.returncode = proc.returncode
+    job.wall_time = time.perf_counter() - start
+    job.cpu_time = rusage.ru_utime + rusage.ru_stime
+    job.max_rss_mb = rusage.ru_maxrss / 1024  # KB on Linux
+    logger.info(
+        f"[{job.target}] finished with exit code {job.returncode} in {job.wall_time:.1f}s."
+    )
+
+
+def run_parallel(
+    targets: list[str] | None = None,
+    cores: int | None = None,
+    mem_gb: float | None = None,
+) -> list[Job]:
+    """
+    Run the per-target chemprop jobs concurrently, splitting cores and memory between them.
+    Jobs that don't fit right away wait in a queue until a running job finishes.
+    """
+    targets = targets or list(JOBS)
+    cores = cores or available_cores()
+    mem_gb = mem_gb or psutil.virtual_memory().available / 1024**3
+    n_parallel, cores_per_job, num_workers = plan(len(targets), cores, mem_gb)
+    logger.info(
+        f"Running {len(targets)} jobs, {n_parallel} at a time, on {cores} cores / {mem_gb:.1f} GB: "
+        f"{cores_per_job - num_workers} threads + {num_workers} dataloader workers per job."
+    )
+
+    jobs = [
+        Job(tgt, str(admet_train_combined[JOBS[tgt]].filepath), cores=cores_per_job, num_workers=num_workers)
+        for tgt in targets
+    ]
+    slots = threading.Semaphore(n_parallel)
+
+    def worker(job: Job) -> None:
+        with slots:
+            logger.info(f"Starting {job.target}: {' '.join(job.command())}")
+            _run_job(job)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(job,)) for job in jobs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    summarize(jobs, time.perf_counter() - start)
+    failed = [job.target for job in jobs if job.returncode != 0]
+    if failed:
+        for job in jobs:
+            if job.returncode != 0:
+                logger.error(f"[{job.target}] last output:\n" + "\n".join(job.tail))
+        raise RuntimeError(f"Jobs failed: {failed}")
+    return jobs
+
+
+def summarize(jobs: list[Job], total_wall_time: float) -> None:
+    lines = [f"{'target':<12} {'exit':>4} {'wall (s)':>9} {'cpu (s)':>9} {'cpu/wall':>8} {'rss (MB)':>9}"]
+    for job in jobs:
+        ratio = job.cpu_time / job.wall_time if job.wall_time else 0.0
+        lines.append(
+            f"{job.target:<12} {str(job.returncode):>4} {job.wall_time:>9.1f} {job.cpu_time:>9.1f} {ratio:>8.2f} {job.max_rss_mb:>9.0f}"
+        )
+    total_cpu = sum(job.cpu_time for job in jobs)
+    lines.append(
+        f"{'total':<12} {'':>4} {total_wall_time:>9.1f} {total_cpu:>9.1f} {total_cpu / total_wall_time if total_wall_time else 0:>8.2f}"
+    )
+    logger.info("Summary:\n" + "\n".join(lines))
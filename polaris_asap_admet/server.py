@@ -0,0 +1,390 @@
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import torch
+from chemprop import data, featurizers, models
+from rdkit import Chem, RDLogger
+
+from polaris_asap_admet.conformers import shape_features
+from polaris_asap_admet.driver import (RUNS_DIR, SMILES_COL, TARGETS, descriptor_width,
+                                       latest_models, load_model)
+from polaris_asap_admet.features import (N_FEATURES, _featurize_chunk,
+                                         feature_store)
+from polaris_asap_admet.logger import logger
+
+HOST = os.getenv("POLARIS_ASAP_ADMET_SERVE_HOST", "127.0.0.1")
+PORT = int(os.getenv("POLARIS_ASAP_ADMET_SERVE_PORT", 8765))
+# Serve on this Unix socket instead of HOST:PORT
+SOCKET = os.getenv("POLARIS_ASAP_ADMET_SERVE_SOCKET")
+MAX_BATCH = 256  # molecules per forward pass
+MAX_WAIT_MS = 5.0  # how long the first request in a batch waits for company
+RELOAD_INTERVAL = 10.0  # seconds between checks of runs/ for newer models
+FEATURE_CACHE_SIZE = 100_000  # molecules' descriptors kept in memory
+LATENCY_WINDOW = 10_000  # requests the latency percentiles are over
+
+
+@dataclass
+class LoadedModel:
+    target: str
+    path: Path
+    mtime: float
+    model: models.MPNN
+    column: int  # which of the model's outputs is target
+    loaded_at: str = field(default_factory=lambda: datetime.now().isoformat())
+
+
+class ModelRegistry:
+    """
+    The model being served for each target.  refresh() swaps in newer best.pt files as they show up;
+    requests already running keep the model they started with.
+    """
+
+    def __init__(self, runs_dir: Path | str = RUNS_DIR):
+        self.runs_dir = Path(runs_dir)
+        self._models: dict[str, LoadedModel] = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> dict[str, LoadedModel]:
+        with self._lock:
+            return dict(self._models)
+
+    def refresh(self) -> list[str]:
+        """
+        Load any target whose newest best.pt isn't the one being served.  Returns the targets (re)loaded.
+        """
+        loaded = self.snapshot()
+        reloaded = []
+        for target, path in latest_models(self.runs_dir).items():
+            current = loaded.get(target)
+            mtime = path.stat().st_mtime
+            if current is not None and current.path == path and current.mtime == mtime:
+                continue
+            try:
+                model = self._load(target, path, mtime)
+            except Exception as e:
+                # e.g. a run that's still writing best.pt - try again next time
+                logger.warning(f"Couldn't load {path} for {target}, still serving the old one: {e!r}")
+                continue
+            with self._lock:
+                self._models[target] = model
+            logger.info(f"{'Reloaded' if current else 'Loaded'} {target} from {path}.")
+            reloaded.append(target)
+        return reloaded
+
+    @staticmethod
+    def _load(target: str, path: Path, mtime: float) -> LoadedModel:
+        model, column = load_model(path, target)
+        return LoadedModel(target, path, mtime, model, column)
+
+
+class DescriptorCache:
+    """
+    v1_rdkit_2d_normalized descriptors for the models' X_d:  in memory (LRU), then the feature store
+    (read-only - the server never rewrites it), then computed on the spot.
+    """
+
+    def __init__(self, max_size: int = FEATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.hits = self.store_hits = self.misses = 0
+
+    def get(self, smiles: list[str]) -> np.ndarray:
+        out = np.empty((len(smiles), N_FEATURES), dtype=np.float32)
+        todo = []
+        for i, smi in enumerate(smiles):
+            row = self._cache.get(smi)
+            if row is None:
+                todo.append(i)
+            else:
+                self._cache.move_to_end(smi)
+                out[i] = row
+        self.hits += len(smiles) - len(todo)
+        if todo:
+            X, found = feature_store.lookup(pl.Series([smiles[i] for i in todo], dtype=pl.String))
+            self.store_hits += int(found.sum())
+            missing = [i for i, hit in zip(todo, found) if not hit]
+            self.misses += len(missing)
+            if missing:
+                X[~found] = _featurize_chunk([smiles[i] for i in missing])
+            for i, row in zip(todo, X):
+                out[i] = row
+                self._cache[smiles[i]] = row
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return out
+
+
+class LatencyStats:
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.requests = self.molecules = self.batches = 0
+
+    def record_request(self, seconds: float, n_molecules: int) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+            self.requests += 1
+            self.molecules += n_molecules
+
+    def record_batch(self, n_molecules: int) -> None:
+        with self._lock:
+            self._batch_sizes.append(n_molecules)
+            self.batches += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+        out = {"requests": self.requests, "molecules": self.molecules, "batches": self.batches}
+        if len(latencies):
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            out["latency_ms"] = {"p50": p50, "p90": p90, "p99": p99, "max": latencies.max()}
+        if len(batch_sizes):
+            out["mean_batch_size"] = float(batch_sizes.mean())
+        return out
+
+
+@dataclass
+class _Request:
+    smiles: list[str]
+    future: Future = field(default_factory=Future)
+
+
+class MicroBatcher:
+    """
+    Merges concurrent requests into one forward pass:  a batch goes out once it has max_batch molecules,
+    or max_wait_ms after its first request arrived, whichever is sooner.
+    """
+
+    def __init__(self, predict_fn, stats: LatencyStats, max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS):
+        self.predict_fn = predict_fn
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: queue.Queue[_Request] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, smiles: list[str]) -> Future:
+        request = _Request(smiles)
+        self._queue.put(request)
+        return request.future
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            n = len(batch[0].smiles)
+            deadline = time.monotonic() + self.max_wait
+            while n < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n += len(request.smiles)
+            self.stats.record_batch(n)
+            try:
+                results = self.predict_fn([smi for request in batch for smi in request.smiles])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            start = 0
+            for request in batch:
+                request.future.set_result(results[start : start + len(request.smiles)])
+                start += len(request.smiles)
+
+
+class InferenceServer:
+    """
+    Every endpoint's latest model, resident, behind a micro-batcher.  Transport-agnostic; see serve().
+    """
+
+    def __init__(
+        self,
+        runs_dir: Path | str = RUNS_DIR,
+        max_batch: int = MAX_BATCH,
+        max_wait_ms: float = MAX_WAIT_MS,
+        reload_interval: float = RELOAD_INTERVAL,
+    ):
+        RDLogger.DisableLog("rdApp.*")
+        self.registry = ModelRegistry(runs_dir)
+        self.registry.refresh()
+        missing = set(TARGETS) - set(self.registry.snapshot())
+        if missing:
+            logger.warning(f"No model under {runs_dir} for {sorted(missing)} yet; those come back null.")
+        self.descriptors = DescriptorCache()
+        self.graph_featurizer = featurizers.SimpleMoleculeMolGraphFeaturizer()
+        self.stats = LatencyStats()
+        self.batcher = MicroBatcher(self._predict_batch, self.stats, max_batch, max_wait_ms)
+        self.reload_interval = reload_interval
+        self._stop = threading.Event()
+        threading.Thread(target=self._watch, name="model-watcher", daemon=True).start()
+
+    def predict(self, smiles: list[str]) -> list[dict]:
+        """
+        [{CXSMILES, HLM, KSOL, LogD, MDR1-MDCKII, MLM, error}, ...], one per input SMILES.
+        """
+        start = time.perf_counter()
+        results = self.batcher.submit(smiles).result()
+        self.stats.record_request(time.perf_counter() - start, len(smiles))
+        return results
+
+    def _predict_batch(self, smiles: list[str]) -> list[dict]:
+        loaded = self.registry.snapshot()
+        results = [{SMILES_COL: smi, **dict.fromkeys(TARGETS), "error": None} for smi in smiles]
+        mols = [Chem.MolFromSmiles(smi) if isinstance(smi, str) else None for smi in smiles]
+        valid = [i for i, mol in enumerate(mols) if mol is not None]
+        for i in set(range(len(smiles))) - set(valid):
+            results[i]["error"] = "unparseable SMILES"
+        if not valid or not loaded:
+            return results
+
+        X_d = self.descriptors.get([smiles[i] for i in valid])
+        if any(descriptor_width(lm.model) > N_FEATURES for lm in loaded.values()):
+            X_d = np.hstack([X_d, shape_features([smiles[i] for i in valid])])
+        dset = data.MoleculeDataset(
+            [data.MoleculeDatapoint(mols[i], x_d=x_d) for i, x_d in zip(valid, X_d)],
+            self.graph_featurizer,
+        )
+        batch = data.collate_batch([dset[i] for i in range(len(dset))])
+        with torch.inference_mode():
+            for target, lm in loaded.items():
+                # eval mode, so the model unscales its outputs back to target units itself
+                X_d = batch.X_d[:, : descriptor_width(lm.model)]
+                preds = lm.model(batch.bmg, batch.V_d, X_d)[:, lm.column].numpy()
+                for i, value in zip(valid, preds):
+                    results[i][target] = float(value)
+        return results
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.reload_interval):
+            try:
+                self.registry.refresh()
+            except Exception as e:
+                logger.warning(f"Checking {self.registry.runs_dir} for new models failed: {e!r}")
+
+    def status(self) -> dict:
+        return {
+            "models": {
+                tgt: {"path": str(lm.path), "loaded_at": lm.loaded_at}
+                for tgt, lm in self.registry.snapshot().items()
+            },
+            **self.stats.summary(),
+            "descriptor_cache": {
+                "size": len(self.descriptors._cache),
+                "hits": self.descriptors.hits,
+                "feature_store_hits": self.descriptors.store_hits,
+                "computed": self.descriptors.misses,
+            },
+        }
+
+    def close(self) -> None:
+        self._stop.set()
+
+
+def make_handler(server: InferenceServer) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: dict) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path in ("/health", "/stats"):
+                self._send(200, server.status())
+            else:
+                self._send(404, {"error": f"no such endpoint {self.path}"})
+
+        def do_POST(self):
+            if self.path == "/reload":
+                self._send(200, {"reloaded": server.registry.refresh()})
+                return
+            if self.path != "/predict":
+                self._send(404, {"error": f"no such endpoint {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                smiles = body["smiles"]
+                smiles = [smiles] if isinstance(smiles, str) else list(smiles)
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {"error": f'expected {{"smiles": [...]}}: {e!r}'})
+                return
+            try:
+                self._send(200, {"predictions": server.predict(smiles)})
+            except Exception as e:
+                logger.exception("Prediction failed")
+                self._send(500, {"error": repr(e)})
+
+        def log_message(self, format, *args):
+            # Unix socket clients have no address, which the default implementation chokes on
+            logger.debug(format % args)
+
+    return Handler
+
+
+# The default listen backlog of 5 resets connections as soon as a few dozen clients show up at once
+REQUEST_QUEUE_SIZE = 1024
+
+
+class TCPHTTPServer(ThreadingHTTPServer):
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+def serve(
+    host: str = HOST,
+    port: int = PORT,
+    socket_path: str | None = SOCKET,
+    runs_dir: Path | str = RUNS_DIR,
+) -> None:
+    """
+    Serve predictions for all five endpoints until interrupted.
+
+        curl -s localhost:8765/predict -d '{"smiles": ["CCO", "c1ccccc1O"]}'
+        curl -s --unix-socket /tmp/admet.sock http://x/predict -d '{"smiles": "CCO"}'
+        curl -s localhost:8765/stats    # models being served, latency percentiles, batch sizes
+        curl -s -X POST localhost:8765/reload    # don't wait for the watcher to notice a new run
+
+    A newer best.pt under runs_dir gets picked up within RELOAD_INTERVAL seconds.
+    """
+    server = InferenceServer(runs_dir)
+    handler = make_handler(server)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        httpd = UnixHTTPServer(socket_path, handler)
+        where = f"unix:{socket_path}"
+    else:
+        httpd = TCPHTTPServer((host, port), handler)
+        where = f"http://{host}:{port}"
+    logger.info(f"Serving {sorted(server.registry.snapshot())} on {where}.")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down.")
+    finally:
+        server.close()
+        httpd.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
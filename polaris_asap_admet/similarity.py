@@ -0,0 +1,342 @@
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import cache
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from polaris_asap_admet.io import admet_train_combined, data_dir, file_hash, migrate_csv, scan_table
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.molecules import ID_COL, molecule_table
+
+SMILES_COL = "CXSMILES"
+FP_RADIUS = 2
+FP_BITS = 2048
+INDEX_DIR = Path("similarity")  # relative to the data dir; one index per training file content
+TOP_K = 5
+CHUNK_SIZE = 2048  # molecules per fingerprinting task
+MIN_ROWS_FOR_POOL = 4096  # below this, fingerprint / query in-process
+QUERY_BATCH = 256  # queries scored together, against...
+BLOCK_ROWS = 512  # ...this many index rows at a time - 256 queries x ~100 on bits x 512 rows is ~13 MB per temporary
+RUNS_DIR = Path("runs")
+PREDS_RE = re.compile(r"^(?P<target>.+)_\d{8}_\d{6}_preds$")
+
+# Set bits in every 16-bit value:  numpy 1.x has no popcount, and a 64 KB table beats bit-twiddling in numpy
+_POPCOUNT16 = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    """
+    Set bits in each row of packed uint64 words (summed over the last axis), as uint32.
+    """
+    if hasattr(np, "bitwise_count"):  # numpy 2
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.uint32)
+    return _POPCOUNT16[np.ascontiguousarray(x).view(np.uint16)].sum(axis=-1, dtype=np.uint32)
+
+
+def _fingerprint_chunk(smiles: list[str | None]) -> np.ndarray:
+    """
+    Morgan bit vectors packed into uint64 words, shape (len(smiles), FP_BITS // 64).  Runs in a worker process.
+    Unparseable SMILES get a row of zeros.
+    """
+    from rdkit import Chem, RDLogger
+    from rdkit.Chem import rdFingerprintGenerator
+
+    RDLogger.DisableLog("rdApp.*")
+    generator = rdFingerprintGenerator.GetMorganGenerator(radius=FP_RADIUS, fpSize=FP_BITS)
+    out = np.zeros((len(smiles), FP_BITS // 8), dtype=np.uint8)
+    for i, smi in enumerate(smiles):
+        mol = Chem.MolFromSmiles(smi) if smi else None
+        if mol is not None:
+            out[i] = np.packbits(generator.GetFingerprintAsNumPy(mol), bitorder="little")
+    return out.view(np.uint64)
+
+
+def fingerprints(smiles: list[str | None], n_workers: int | None = None) -> np.ndarray:
+    """
+    Packed fingerprints for every SMILES, in order, in chunks on a process pool.
+    """
+    chunks = [smiles[i : i + CHUNK_SIZE] for i in range(0, len(smiles), CHUNK_SIZE)]
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(chunks)))
+    if n_workers == 1 or len(smiles) < MIN_ROWS_FOR_POOL:
+        results = [_fingerprint_chunk(c) for c in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+            results = list(pool.map(_fingerprint_chunk, chunks))
+    return np.concatenate(results) if results else np.empty((0, FP_BITS // 64), dtype=np.uint64)
+
+
+def _on_bits(q: np.ndarray) -> np.ndarray:
+    """
+    Each query's set bit positions, padded with FP_BITS (an all-zero row in _intersections) to the longest.
+    """
+    bits = np.unpackbits(np.ascontiguousarray(q).view(np.uint8), axis=1, bitorder="little")
+    n_on = bits.sum(axis=1, dtype=np.int64)
+    on = np.full((len(q), max(1, int(n_on.max(initial=0)))), FP_BITS, dtype=np.int64)
+    rows, cols = np.nonzero(bits)
+    # position of each set bit within its row
+    on[rows, np.arange(len(rows)) - np.repeat(np.cumsum(n_on) - n_on, n_on)] = cols
+    return on
+
+
+def _intersections(q: np.ndarray, q_on: np.ndarray, fps: np.ndarray) -> np.ndarray:
+    """
+    Bits in common between every query and every row, shape (len(q), len(fps)).
+
+    With numpy 2, AND and popcount.  Without a popcount ufunc, popcount over the AND is ~1.5M pairs/s a core;
+    Morgan vectors are sparse (~50 of 2048 bits), so it's ~8x faster to unpack the block to one byte per bit,
+    transposed, and sum the rows at each query's set bits.
+    """
+    if hasattr(np, "bitwise_count"):
+        return popcount(q[:, None, :] & fps[None, :, :])
+    block = np.zeros((FP_BITS + 1, len(fps)), dtype=np.uint8)
+    block[:FP_BITS] = np.unpackbits(np.ascontiguousarray(fps).view(np.uint8), axis=1, bitorder="little").T
+    return block[q_on].sum(axis=1, dtype=np.uint16)
+
+
+def _tanimoto(q: np.ndarray, q_counts: np.ndarray, q_on: np.ndarray, fps: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Tanimoto similarity of every query against every row, shape (len(q), len(fps)).  0 if both are empty.
+    """
+    inter = _intersections(q, q_on, fps).astype(np.float32)
+    union = q_counts[:, None].astype(np.float32) + counts[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def _merge_top_k(best: np.ndarray, best_rows: np.ndarray, sims: np.ndarray, rows: np.ndarray, k: int):
+    sims = np.concatenate([best, sims], axis=1)
+    rows = np.concatenate([best_rows, np.broadcast_to(rows, (len(sims), len(rows)))], axis=1)
+    if sims.shape[1] > k:
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        sims, rows = np.take_along_axis(sims, top, 1), np.take_along_axis(rows, top, 1)
+    return sims, rows
+
+
+@dataclass
+class FingerprintIndex:
+    """
+    Packed Morgan fingerprints of a training set, for top-k Tanimoto queries.
+
+    Lives in a directory of three memory-mapped .npy files, with rows sorted by bit count:
+      - fps.npy: uint64, FP_BITS // 64 words per molecule
+      - counts.npy: bits set per molecule
+      - rows.npy: each molecule's row in the training set
+    plus meta.json (where it came from).  Sorting by bit count is what makes pruning cheap:  Tanimoto(a, b)
+    is at most min(|a|, |b|) / max(|a|, |b|), so once a query has k neighbours at similarity t, only rows
+    with between t|a| and |a|/t bits can beat them - a contiguous slice.
+    """
+
+    path: Path
+    fps: np.ndarray
+    counts: np.ndarray
+    rows: np.ndarray
+
+    @classmethod
+    def build(cls, smiles: list[str | None], path: Path | str, n_workers: int | None = None, **meta) -> "FingerprintIndex":
+        path = Path(path)
+        fps = fingerprints(smiles, n_workers)
+        counts = popcount(fps)
+        order = np.argsort(counts, kind="stable")
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        np.save(tmp_path / "fps.npy", fps[order])
+        np.save(tmp_path / "counts.npy", counts[order])
+        np.save(tmp_path / "rows.npy", order.astype(np.int64))
+        with open(tmp_path / "meta.json", "w") as f:
+            json.dump({"n": len(smiles), "radius": FP_RADIUS, "bits": FP_BITS, **meta}, f, indent=2)
+        # Built whole, then renamed into place, so a half-built index is never opened
+        try:
+            os.replace(tmp_path, path)
+        except OSError:  # another process got there first
+            shutil.rmtree(tmp_path)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path: Path | str) -> "FingerprintIndex":
+        path = Path(path)
+        return cls(
+            path,
+            np.load(path / "fps.npy", mmap_mode="r"),
+            np.load(path / "counts.npy", mmap_mode="r"),
+            np.load(path / "rows.npy", mmap_mode="r"),
+        )
+
+    def _query_batch(self, q: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top-k for a batch of queries of similar bit count.  Blocks of rows are scored outwards from the
+        queries' bit count, and each direction stops as soon as no row further on could beat any query's
+        k-th best so far.
+        """
+        q_counts, q_on = popcount(q).astype(np.float32), _on_bits(q)
+        n = len(self.counts)
+        best = np.full((len(q), 0), -1.0, dtype=np.float32)
+        best_rows = np.full((len(q), 0), -1, dtype=np.int64)
+        left = right = int(np.searchsorted(self.counts, np.median(q_counts)))
+        while left > 0 or right < n:
+            threshold = best.min(axis=1) if best.shape[1] == k else np.zeros(len(q), dtype=np.float32)
+            if right < n:
+                # every row from here right has at least `fewest` bits
+                fewest = float(self.counts[right])
+                bound = np.where(q_counts > fewest, 1.0, q_counts / max(fewest, 1.0))
+                if np.all(bound < threshold):
+                    right = n
+                else:
+                    lo, right = right, min(right + BLOCK_ROWS, n)
+                    sims = _tanimoto(q, q_counts, q_on, self.fps[lo:right], self.counts[lo:right])
+                    best, best_rows = _merge_top_k(best, best_rows, sims, np.arange(lo, right), k)
+            if left > 0:
+                # ...and every row from here left at most `most`
+                most = float(self.counts[left - 1])
+                bound = np.where(q_counts < most, 1.0, most / q_counts)
+                if np.all(bound < threshold):
+                    left = 0
+                else:
+                    left, hi = max(left - BLOCK_ROWS, 0), left
+                    sims = _tanimoto(q, q_counts, q_on, self.fps[left:hi], self.counts[left:hi])
+                    best, best_rows = _merge_top_k(best, best_rows, sims, np.arange(left, hi), k)
+
+        order = np.argsort(-best, axis=1)
+        best, best_rows = np.take_along_axis(best, order, 1), np.take_along_axis(best_rows, order, 1)
+        best_rows = np.where(best_rows >= 0, self.rows[np.maximum(best_rows, 0)], -1)
+        return best, best_rows
+
+    def query(self, q: np.ndarray, k: int = TOP_K) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The k most similar training molecules for each query fingerprint:  similarities (descending) and
+        training-set rows, each shape (len(q), k).  Queries are sorted by bit count and scored in batches,
+        so each batch's pruning window is narrow.  Empty queries (unparseable SMILES) get NaN and -1, and so
+        does every query against an empty index.
+        """
+        k = min(k, len(self.counts)) if len(self.counts) else k
+        sims = np.full((len(q), k), np.nan, dtype=np.float32)
+        rows = np.full((len(q), k), -1, dtype=np.int64)
+        if len(self.counts) == 0:
+            return sims, rows
+        q_counts = popcount(q)
+        live = np.flatnonzero(q_counts > 0)
+        live = live[np.argsort(q_counts[live], kind="stable")]
+        for start in range(0, len(live), QUERY_BATCH):
+            batch = live[start : start + QUERY_BATCH]
+            sims[batch], rows[batch] = self._query_batch(q[batch], k)
+        return sims, rows
+
+
+@cache
+def _open_index(path: str) -> FingerprintIndex:
+    return FingerprintIndex.open(path)
+
+
+def _query_chunk(index_path: str, smiles: list[str | None], k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Fingerprint a chunk and query an index with it.  Runs in a worker process; the index is memory-mapped,
+    so every worker shares its pages.
+    """
+    return _open_index(index_path).query(_fingerprint_chunk(smiles), k)
+
+
+def index_for(train_path: Path | str, n_workers: int | None = None) -> FingerprintIndex:
+    """
+    The fingerprint index of a training file, building it if need be.  Indexes are keyed by the file's
+    content hash, so a rebuilt training set gets a new index and an unchanged one is never rebuilt.
+    """
+    migrate_csv(train_path)
+    content_hash = file_hash(train_path)
+    if content_hash is None:
+        raise FileNotFoundError(train_path)
+    path = data_dir() / INDEX_DIR / content_hash[:16]
+    if not path.exists():
+        smiles = scan_table(train_path).select(SMILES_COL).collect()[SMILES_COL].to_list()
+        logger.info(f"Building fingerprint index of {len(smiles)} molecules in {train_path}...")
+        FingerprintIndex.build(smiles, path, n_workers, source=str(train_path), content_hash=content_hash)
+    return _open_index(str(path))
+
+
+def similarity_columns(sims: np.ndarray, prefix: str = "") -> list[pl.Series]:
+    """
+    {prefix}nn_similarity (nearest training molecule's Tanimoto) and {prefix}knn_similarity (mean over the
+    top k), null for unparseable SMILES.
+    """
+    return [
+        pl.Series(f"{prefix}nn_similarity", sims[:, 0] if sims.shape[1] else np.full(len(sims), np.nan)).fill_nan(None),
+        pl.Series(f"{prefix}knn_similarity", sims.mean(axis=1) if sims.shape[1] else np.full(len(sims), np.nan)).fill_nan(None),
+    ]
+
+
+@stage("nn_similarity")
+def nn_similarity(
+    smiles: pl.Series, train_path: Path | str, k: int = TOP_K, prefix: str = "", n_workers: int | None = None
+) -> list[pl.Series]:
+    """
+    Applicability-domain columns for smiles against a training file (see similarity_columns).
+    Big query sets are split into chunks across a process pool.
+    """
+    index = index_for(train_path, n_workers)
+    values = smiles.cast(pl.String).to_list()
+    chunks = [values[i : i + CHUNK_SIZE] for i in range(0, len(values), CHUNK_SIZE)]
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(chunks)))
+    if n_workers == 1 or len(values) < MIN_ROWS_FOR_POOL:
+        results = [index.query(_fingerprint_chunk(c), k) for c in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+            results = list(pool.map(_query_chunk, [str(index.path)] * len(chunks), chunks, [k] * len(chunks)))
+    k = min(k, len(index.counts)) if len(index.counts) else k
+    sims = np.concatenate([r[0] for r in results]) if results else np.empty((0, k), dtype=np.float32)
+    metrics = current_stage()
+    metrics.rows_in, metrics.rows_out = len(index.counts), len(sims)
+    return similarity_columns(sims, prefix)
+
+
+def train_paths_for(target: str) -> dict[str, Path]:
+    """
+    {column prefix: training file} for a run's target:  its own training set, or every target's for multitask.
+    """
+    by_name = {tgt.upper(): tgt for tgt in admet_train_combined}
+    if target == "multitask":
+        return {f"{tgt}_": ds.filepath for tgt, ds in admet_train_combined.items()}
+    if target.upper() in by_name:
+        return {"": admet_train_combined[by_name[target.upper()]].filepath}
+    return {}
+
+
+def target_similarity(smiles: pl.Series, target: str, k: int = TOP_K) -> list[pl.Series]:
+    """
+    nn_similarity against a target's combined training set(s) - per target, prefixed, for multitask.
+    Training sets not on disk are skipped.
+    """
+    train_paths = {p: f for p, f in train_paths_for(target).items() if migrate_csv(f) or f.exists()}
+    return [c for prefix, f in train_paths.items() for c in nn_similarity(smiles, f, k, prefix)]
+
+
+def add_similarity_columns(runs_dir: Path | str = RUNS_DIR, k: int = TOP_K) -> list[Path]:
+    """
+    Add nearest-neighbour similarity columns to every runs/{target}_{timestamp}_preds.csv that doesn't have
+    them yet, against that target's combined training set.  Runs written since these columns existed
+    already have them, against the training file they were actually trained on.
+    """
+    done = []
+    for path in sorted(Path(runs_dir).glob("*_preds.csv")):
+        match = PREDS_RE.match(path.stem)
+        if match is None:
+            continue
+        df = pl.read_csv(path)
+        if any(c.endswith("nn_similarity") for c in df.columns):
+            continue
+        smiles = df[SMILES_COL] if SMILES_COL in df.columns else molecule_table.smiles(df[ID_COL])
+        columns = target_similarity(smiles, match["target"], k)
+        if not columns:
+            logger.warning(f"No training set on disk for {path.name}; leaving it as is.")
+            continue
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        df.with_columns(columns).write_csv(tmp_path)
+        os.replace(tmp_path, path)
+        done.append(path)
+        logger.info(f"Added similarity columns to {path}.")
+    logger.info(f"Added similarity columns to {len(done)} prediction files.")
+    return done
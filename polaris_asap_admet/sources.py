@@ -0,0 +1,331 @@
+import fcntl
+import os
+from dataclasses import dataclass, field
+
+import polars as pl
+
+from polaris_asap_admet.io import (COMBINED, DIRTY, PARQUET_OPTIONS,
+                                   NamedDataset, admet_train_combined,
+                                   asap_train_raw, computational_adme_raw,
+                                   data_dir, tdc_lipophilicity_az_raw)
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import stage
+from polaris_asap_admet.mol import SCHEMA, with_mol_properties
+from polaris_asap_admet.molecules import molecule_table
+
+SMILES_COL = "CXSMILES"
+TARGETS = [
+    "HLM",
+    "KSOL",
+    "LogD",
+    "MDR1-MDCKII",
+    "MLM",
+]
+
+# Replicates - the same molecule from several sources, or under different SMILES spellings - get collapsed
+# into one row.  Key:  "inchikey", "canonical_smiles" or None (keep every row).  Molecules RDKit can't
+# parse fall back to their SMILES string as the key.
+DEDUP_KEY = "inchikey"
+# How replicates' values are combined:  "mean", "median", or "asap_wins" (the mean of the preferred
+# sources' values, if any of them measured it, else of everyone's)
+AGGREGATE = "mean"
+DEDUP_REPORT = COMBINED / "dedup_report.parquet"  # relative to the data dir
+
+
+@dataclass
+class Endpoint:
+    """
+    One ASAP endpoint as measured by a source:  which column it's in, and how to get it into ASAP's units.
+
+    value is a polars expression over the source's columns (plus any Source.mol_properties);
+    it defaults to the column as-is.  Rows where any of filters is false don't count for this endpoint.
+    """
+
+    target: str
+    column: str
+    value: pl.Expr | None = None
+    filters: list[pl.Expr] = field(default_factory=list)
+
+    def expr(self) -> pl.Expr:
+        value = pl.col(self.column) if self.value is None else self.value
+        if self.filters:
+            value = pl.when(pl.all_horizontal(self.filters)).then(value)
+        return value.cast(pl.Float64).alias(self.target)
+
+
+@dataclass
+class Source:
+    """
+    A raw dataset and the endpoints it has data for.
+
+    valid_smiles drops molecules RDKit can't parse.  mol_properties are columns from mol.SCHEMA
+    (e.g. mol_wt) that Endpoint.value expressions can use; they come from the molecule cache.
+    When replicates are collapsed, a preferred source's SMILES spelling is the one kept, and with
+    AGGREGATE = "asap_wins" its values override everyone else's.
+    """
+
+    name: str
+    dataset: NamedDataset
+    endpoints: list[Endpoint]
+    smiles_col: str = SMILES_COL
+    valid_smiles: bool = False
+    mol_properties: list[str] = field(default_factory=list)
+    preferred: bool = False
+
+    @property
+    def targets(self) -> list[str]:
+        return [ep.target for ep in self.endpoints]
+
+
+# Estimated liver microsomal protein content: ~40 mg/g liver, ~20 g liver/kg body weight → ~800 mg protein/kg.
+MG_PROTEIN_PER_KG = 800
+# HLM: 0.05 looked like crap - overestimates in vitro/in vivo scaling, compressing values to 0.3–0.6 uL/min/mg.
+# MLM: TODO: NOT sure I buy this value, need to double check
+CLINT_SCALING_FACTOR = 0.5
+# MDR1: Placeholder—tune to match ASAP's 10^-6 cm/s distribution
+MDR1_SCALING_FACTOR = 10
+
+
+def _clint_ul_min_mg(column: str) -> pl.Expr:
+    """
+    log(mL/min/kg) - presumably that's kg of body weight - to uL/min/mg:  unlog, mL to uL, per kg to per mg protein.
+    """
+    return 10 ** pl.col(column) * 1_000 / MG_PROTEIN_PER_KG * CLINT_SCALING_FACTOR
+
+
+# Every (source, endpoint) pair we train on.  Rows come out in this order, sources first, ASAP last.
+# To add a dataset:  declare its raw NamedDataset in io.py (and add it to the upstream of the combined
+# datasets it feeds), then add a Source here.
+SOURCES = [
+    Source(
+        name="computational_adme",
+        dataset=computational_adme_raw,
+        smiles_col="SMILES",
+        valid_smiles=True,  # chemprop will choke on the ones RDKit can't parse anyway
+        mol_properties=["mol_wt"],
+        endpoints=[
+            # ADME_public_set_3521.csv gives HLM data in log scale (mL/min/kg). Convert to uL/min/mg.
+            Endpoint("HLM", "LOG HLM_CLint (mL/min/kg)", _clint_ul_min_mg("LOG HLM_CLint (mL/min/kg)")),
+            # LOG SOLUBILITY PH 6.8 (ug/mL), scaled by RDKit molar mass exactly as the baseline's prep_data_ksol.py
+            # does (test_sources pins it):  10 ** logS_ug_mL / (mol_wt / 1000 * 1e-3) = S_ug_mL * 1e6 / mol_wt.
+            # Not a unit conversion as such - S_ug_mL * 1000 / mol_wt would be uM - but it's what the baseline trained on.
+            Endpoint(
+                "KSOL",
+                "LOG SOLUBILITY PH 6.8 (ug/mL)",
+                (10 ** pl.col("LOG SOLUBILITY PH 6.8 (ug/mL)")) / (pl.col("mol_wt") / 1000 * 1e-3),
+                filters=[pl.col("mol_wt").is_not_null()],
+            ),
+            # MDR1-MDCK efflux ratio (unitless) to MDR1-MDCKII permeability in 10^-6 cm/s.
+            # Assumes log(efflux ratio) correlates with permeability.  Placeholder: refine based on ASAP docs.
+            Endpoint(
+                "MDR1-MDCKII",
+                "LOG MDR1-MDCK ER (B-A/A-B)",
+                pl.col("LOG MDR1-MDCK ER (B-A/A-B)").log10() * 1e-6 * MDR1_SCALING_FACTOR,
+            ),
+            # Rat, not mouse - how similar are rats and mice, anyway?  Perhaps we'll find out!
+            # TODO - confirm the 800 mg/kg protein estimate applies to MLM too.
+            Endpoint("MLM", "LOG RLM_CLint (mL/min/kg)", _clint_ul_min_mg("LOG RLM_CLint (mL/min/kg)")),
+        ],
+    ),
+    Source(
+        name="tdc_lipophilicity_az",
+        dataset=tdc_lipophilicity_az_raw,
+        smiles_col="Drug",
+        endpoints=[Endpoint("LogD", "Y")],
+    ),
+    Source(
+        name="asap",
+        dataset=asap_train_raw,
+        endpoints=[Endpoint(tgt, tgt) for tgt in TARGETS],
+        preferred=True,
+    ),
+]
+
+
+def compile_source(source: Source) -> pl.LazyFrame:
+    """
+    One lazy query over a source's raw file:  SMILES plus every endpoint it has, in ASAP units, one column
+    per target.  Rows with none of its endpoints are dropped.  Only the columns the spec uses get read.
+    """
+    lf = source.dataset.scan()
+    smiles = pl.col(source.smiles_col)
+    if source.valid_smiles or source.mol_properties:
+        # RDKit needs real strings, so the unique SMILES get collected; everything else stays lazy
+        missing = set(source.mol_properties) - set(SCHEMA)
+        if missing:
+            raise ValueError(f"{source.name}: unknown mol_properties {missing}; see mol.SCHEMA.")
+        df_props = with_mol_properties(
+            lf.select(smiles).unique().collect(), smiles_col=source.smiles_col
+        )
+        if source.valid_smiles:
+            df_props = df_props.filter(pl.col("error").is_null())
+        lf = lf.join(
+            df_props.select(source.smiles_col, *source.mol_properties).lazy(),
+            on=source.smiles_col,
+            how="inner" if source.valid_smiles else "left",
+            join_nulls=True,
+            maintain_order="left",
+        )
+    return lf.select(
+        smiles.alias(SMILES_COL), *[ep.expr() for ep in source.endpoints]
+    ).filter(pl.any_horizontal(pl.col(source.targets).is_not_null()))
+
+
+def _aggregate(target: str, how: str) -> pl.Expr:
+    value = pl.col(target)
+    if how == "mean":
+        return value.mean()
+    if how == "median":
+        return value.median()
+    if how == "asap_wins":
+        return (
+            pl.when(pl.col("_preferred").any())
+            .then(value.filter(pl.col("_preferred")).mean())
+            .otherwise(value.mean())
+        )
+    raise ValueError(f"Unknown aggregation {how!r}; expected mean, median or asap_wins.")
+
+
+def dedup_keys(smiles: pl.Series, key: str = DEDUP_KEY, n_workers: int | None = None) -> pl.DataFrame:
+    """
+    SMILES -> replicate key, for each unique SMILES.  Parsing goes through the molecule cache,
+    so only SMILES it hasn't seen get sent to RDKit (in parallel).
+    """
+    if key not in ("inchikey", "canonical_smiles"):
+        raise ValueError(f"Unknown dedup key {key!r}; expected inchikey, canonical_smiles or None.")
+    df_props = with_mol_properties(
+        smiles.unique().to_frame(SMILES_COL), smiles_col=SMILES_COL, n_workers=n_workers
+    )
+    fallbacks = ["canonical_smiles"] if key == "inchikey" else []
+    return df_props.select(
+        SMILES_COL,
+        pl.coalesce(key, *fallbacks, SMILES_COL).alias("_key"),
+    )
+
+
+def collapse_replicates(
+    df: pl.DataFrame, target: str, df_keys: pl.DataFrame, how: str = AGGREGATE
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    One row per replicate key, in order of first appearance, from df's (CXSMILES, target, _source, _preferred) rows.
+    The SMILES kept is the first preferred source's, or else the first one seen.
+
+    Returns the collapsed (CXSMILES, target) frame, and rows in/out/collapsed per source - a source's
+    rows are collapsed when the group they're in kept some other row's SMILES.
+    """
+    df = df.with_row_index("_order").join(df_keys, on=SMILES_COL, how="left")
+    # one global sort rather than one per group:  after it, each group's first row is its representative
+    df_groups = (
+        df.sort("_preferred", "_order", descending=[True, False])
+        .group_by("_key")
+        .agg(
+            pl.col("_order").first(),
+            pl.col("_order").min().alias("_first"),
+            _aggregate(target, how).alias(target),
+        )
+        .sort("_first")
+    )
+    df_kept = df.select("_order", SMILES_COL, "_source").join(
+        df_groups.select("_order", target), on="_order", how="inner"
+    )
+    df_report = (
+        df.group_by("_source", maintain_order=True)
+        .agg(pl.len().alias("rows_in"))
+        .join(df_kept.group_by("_source").agg(pl.len().alias("rows_out")), on="_source", how="left")
+        .with_columns(pl.col("rows_out").fill_null(0))
+        .select(
+            pl.lit(target).alias("target"),
+            pl.col("_source").alias("source"),
+            "rows_in",
+            "rows_out",
+            (pl.col("rows_in") - pl.col("rows_out")).alias("collapsed"),
+        )
+    )
+    # rows come out in order of their group's first appearance, not the representative's
+    df_out = df_groups.select("_order").join(df_kept, on="_order", how="left").select(SMILES_COL, target)
+    return df_out, df_report
+
+
+def write_dedup_report(df_report: pl.DataFrame) -> None:
+    """
+    Merge df_report into combined/dedup_report.parquet, replacing just the rows for the targets in it.
+    The pipeline builds each target separately, often several at once, so this holds a lock.
+    """
+    path = data_dir() / DEDUP_REPORT
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if path.exists():
+            built = df_report["target"].unique()
+            df_report = pl.concat(
+                [pl.read_parquet(path).filter(~pl.col("target").is_in(built)), df_report], how="diagonal_relaxed"
+            )
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        df_report.write_parquet(tmp_path, **PARQUET_OPTIONS)
+        os.replace(tmp_path, path)
+
+
+@stage("build_training_sets")
+def build_training_sets(
+    targets: list[str] | None = None,
+    sources: list[Source] = SOURCES,
+    debug: bool = False,
+    dedup: str | None = DEDUP_KEY,
+    aggregate: str = AGGREGATE,
+) -> dict[str, pl.DataFrame]:
+    """
+    Build the combined training set for every target (or just the ones named) straight from the raw files.
+
+    Each source is read once, by one query that emits all of its endpoints; the queries run together
+    (pl.collect_all) and each target's set is then the rows from every source that measured it, with
+    replicates collapsed (see DEDUP_KEY, AGGREGATE), keyed by mol_id - the SMILES live in the molecule table,
+    and scan_table joins them back in.  How many rows that dropped per source and target goes to combined/dedup_report.parquet (see
+    write_dedup_report).
+    With debug, each source's converted endpoints also get written to dirty/{source}_endpoints.parquet.
+    """
+    targets = targets or TARGETS
+    sources = [src for src in sources if set(src.targets) & set(targets)]
+    logger.info(f"Building training sets for {targets} from {[src.name for src in sources]}...")
+    wide = pl.collect_all([compile_source(src) for src in sources])
+
+    if debug:
+        for src, df in zip(sources, wide):
+            NamedDataset(f"{src.name}_endpoints", DIRTY / f"{src.name}_endpoints.parquet").save(molecule_table.keyed(df))
+
+    if dedup is not None:
+        df_keys = dedup_keys(pl.concat([df[SMILES_COL] for df in wide]), key=dedup)
+
+    out, reports = {}, []
+    for tgt in targets:
+        df = pl.concat(
+            [
+                df.select(
+                    SMILES_COL,
+                    tgt,
+                    pl.lit(src.name).alias("_source"),
+                    pl.lit(src.preferred).alias("_preferred"),
+                ).filter(pl.col(tgt).is_not_null())
+                for src, df in zip(sources, wide)
+                if tgt in src.targets
+            ]
+        )
+        if dedup is None:
+            df_report = df.group_by("_source", maintain_order=True).agg(
+                pl.lit(tgt).alias("target"), pl.len().alias("rows_in"), pl.len().alias("rows_out"),
+                pl.lit(0, dtype=pl.UInt32).alias("collapsed"),
+            ).rename({"_source": "source"}).select("target", "source", "rows_in", "rows_out", "collapsed")
+            df = df.select(SMILES_COL, tgt)
+        else:
+            df, df_report = collapse_replicates(df, tgt, df_keys, how=aggregate)
+        df = molecule_table.keyed(df)
+        counts = {row["source"]: f"{row['rows_in']} (-{row['collapsed']})" for row in df_report.iter_rows(named=True)}
+        logger.info(f"{tgt}: {len(df)} rows from {counts}.")
+        admet_train_combined[tgt].save(df)
+        out[tgt] = df
+        reports.append(df_report)
+
+    write_dedup_report(
+        pl.concat(reports).with_columns(pl.lit(dedup).alias("dedup_key"), pl.lit(aggregate).alias("aggregate"))
+    )
+    logger.info("Done.")
+    return out
@@ -0,0 +1,224 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from polaris_asap_admet.io import (admet_multitask_train, admet_train_combined, code_hash, file_hash,
+                                   migrate_csv, scan_table)
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.similarity import FP_BITS, FP_RADIUS, fingerprints
+
+SMILES_COL = "CXSMILES"
+# Split types computed here (TrainConfig.split_type, case-insensitive); anything else is left to chemprop
+SPLIT_TYPES = ["kmeans", "scaffold_balanced"]
+# chemprop (astartes) asks for n // 10 + 1 k-means clusters - 100k of them for 1M molecules, which never
+# finishes.  Splitting needs enough clusters to fill val and test from whole ones, not that many.
+MAX_CLUSTERS = 100
+KMEANS_BATCH = 4096  # molecules per mini-batch k-means step
+CSR_CHUNK = 65536  # fingerprints unpacked to a sparse matrix this many at a time
+CHUNK_SIZE = 2048  # molecules per scaffold task
+MIN_ROWS_FOR_POOL = 4096
+
+
+def _scaffold_chunk(smiles: list[str | None]) -> list[str]:
+    """
+    Bemis-Murcko scaffold SMILES, ignoring atom maps and chirality.  Runs in a worker process.
+    Acyclic and unparseable molecules get "".
+    """
+    from rdkit import Chem, RDLogger
+    from rdkit.Chem.Scaffolds import MurckoScaffold
+
+    RDLogger.DisableLog("rdApp.*")
+    out = []
+    for smi in smiles:
+        mol = Chem.MolFromSmiles(smi) if smi else None
+        if mol is None:
+            out.append("")
+            continue
+        for atom in mol.GetAtoms():
+            atom.SetAtomMapNum(0)
+        out.append(MurckoScaffold.MurckoScaffoldSmiles(mol=mol, includeChirality=False))
+    return out
+
+
+def scaffold_labels(smiles: list[str | None], n_workers: int | None = None) -> np.ndarray:
+    chunks = [smiles[i : i + CHUNK_SIZE] for i in range(0, len(smiles), CHUNK_SIZE)]
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(chunks)))
+    if n_workers == 1 or len(smiles) < MIN_ROWS_FOR_POOL:
+        results = [_scaffold_chunk(c) for c in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+            results = list(pool.map(_scaffold_chunk, chunks))
+    scaffolds = pl.Series([s for r in results for s in r], dtype=pl.String)
+    return scaffolds.rank("dense").to_numpy()
+
+
+def _fingerprint_matrix(fps: np.ndarray):
+    """
+    Packed fingerprints as a float32 CSR matrix, one column per bit.  Morgan vectors are ~2% set, so this
+    is ~50 entries a row instead of 2048 - what makes k-means on a million molecules fit in memory.
+    """
+    from scipy import sparse
+
+    parts = [
+        sparse.csr_matrix(np.unpackbits(fps[i : i + CSR_CHUNK].view(np.uint8), axis=1, bitorder="little"), dtype=np.float32)
+        for i in range(0, len(fps), CSR_CHUNK)
+    ]
+    return sparse.vstack(parts, format="csr") if parts else sparse.csr_matrix((0, FP_BITS), dtype=np.float32)
+
+
+def kmeans_labels(
+    smiles: list[str | None], seed: int = 0, n_clusters: int | None = None, n_workers: int | None = None
+) -> np.ndarray:
+    """
+    Mini-batch k-means over Morgan fingerprints (chemprop's KMEANS split clusters the same fingerprints,
+    with full k-means).  n_clusters defaults to chemprop's n // 10 + 1, up to MAX_CLUSTERS.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    X = _fingerprint_matrix(fingerprints(smiles, n_workers))
+    n_clusters = n_clusters or min(MAX_CLUSTERS, len(smiles) // 10 + 1)
+    if len(smiles) <= n_clusters:
+        return np.arange(len(smiles))
+    kmeans = MiniBatchKMeans(n_clusters, batch_size=KMEANS_BATCH, n_init=1, random_state=seed)
+    return kmeans.fit_predict(X)
+
+
+def assign_clusters(
+    labels: np.ndarray, sizes: tuple[float, float, float], seed: int = 0
+) -> tuple[list[int], list[int], list[int]]:
+    """
+    (train, val, test) row indices that never split a cluster.  Clusters are taken in a seeded random order,
+    each into test if it still fits, else val if it fits, else train - so val and test come out at most
+    their share and train takes the rest.  If that leaves val or test empty, it gets the smallest train cluster.
+    """
+    n = len(labels)
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    room = [n, sizes[1] * n, sizes[2] * n]
+    filled = [0, 0, 0]
+    split_of = np.zeros(len(counts), dtype=np.int8)  # 0 train, 1 val, 2 test
+    for c in np.random.default_rng(seed).permutation(len(counts)):
+        s = next(s for s in (2, 1, 0) if s == 0 or filled[s] + counts[c] <= room[s])
+        split_of[c] = s
+        filled[s] += counts[c]
+    for s in (2, 1):
+        in_train = np.flatnonzero(split_of == 0)
+        if sizes[s] > 0 and filled[s] == 0 and len(in_train) > 1:
+            c = in_train[np.argmin(counts[in_train])]
+            split_of[c] = s
+            filled[s] += counts[c]
+    row_split = split_of[inverse.reshape(-1)]
+    return tuple(np.flatnonzero(row_split == s).tolist() for s in (0, 1, 2))
+
+
+@stage("split")
+def split_indices(
+    smiles: list[str | None],
+    split_type: str = "kmeans",
+    sizes: tuple[float, float, float] = (0.8, 0.1, 0.1),
+    seed: int = 0,
+    n_workers: int | None = None,
+) -> tuple[list[int], list[int], list[int]]:
+    """
+    (train, val, test) row indices, clustered by split_type:  "kmeans" (Morgan fingerprints) or
+    "scaffold_balanced" (Bemis-Murcko scaffolds).
+    """
+    split_type = split_type.lower()
+    if split_type == "kmeans":
+        labels = kmeans_labels(smiles, seed, n_workers=n_workers)
+    elif split_type == "scaffold_balanced":
+        labels = scaffold_labels(smiles, n_workers)
+    else:
+        raise ValueError(f"Unsupported split type {split_type!r}; expected one of {SPLIT_TYPES}.")
+    split = assign_clusters(labels, sizes, seed)
+    metrics = current_stage()
+    metrics.rows_in, metrics.rows_out = len(smiles), len(split[0])
+    metrics.tags["clusters"] = int(len(np.unique(labels)))
+    logger.info(f"{split_type} split of {len(smiles)} rows into {metrics.tags['clusters']} clusters: {[len(s) for s in split]}")
+    return split
+
+
+def splits_path(
+    data_path: Path | str, split_type: str, sizes: tuple[float, float, float], seed: int
+) -> Path:
+    """
+    Where a dataset's split lives, next to it:  data/combined/admet_HLM_train.kmeans-80-10-10-seed0.splits.json.
+    """
+    data_path = Path(data_path)
+    name = "-".join([split_type.lower(), *(f"{round(s * 100)}" for s in sizes), f"seed{seed}"])
+    return data_path.with_name(f"{data_path.stem}.{name}.splits.json")
+
+
+def _write_json(path: Path, value) -> None:
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def dataset_split(
+    data_path: Path | str,
+    split_type: str = "kmeans",
+    sizes: tuple[float, float, float] = (0.8, 0.1, 0.1),
+    seed: int = 0,
+    n_workers: int | None = None,
+) -> tuple[list[int], list[int], list[int]] | None:
+    """
+    A dataset's (train, val, test) split, computed once per version of the file and reused by every run,
+    replicate and hyperparameter trial after that.  None for split types we don't compute (see SPLIT_TYPES).
+
+    Saved in chemprop's --splits-file format (see splits_path), with a .manifest.json recording the
+    dataset's content hash and how the split was made; if either changes, the split is recomputed.
+    """
+    if split_type.lower() not in SPLIT_TYPES:
+        return None
+    migrate_csv(data_path)
+    path = splits_path(data_path, split_type, sizes, seed)
+    manifest_path = Path(f"{path}.manifest.json")
+    manifest = {
+        "content_hash": file_hash(data_path),
+        "code_hash": code_hash(__name__),
+        "split_type": split_type.lower(),
+        "sizes": list(sizes),
+        "seed": seed,
+        "fingerprint": f"morgan{FP_RADIUS}-{FP_BITS}",
+    }
+    if manifest["content_hash"] is None:
+        raise FileNotFoundError(data_path)
+    if path.exists() and manifest_path.exists():
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                with open(path) as f:
+                    split = json.load(f)[0]
+                return split["train"], split["val"], split["test"]
+
+    smiles = scan_table(data_path).select(SMILES_COL).collect()[SMILES_COL].to_list()
+    split = split_indices(smiles, split_type, sizes, seed, n_workers)
+    # Split first, manifest second:  a split without a matching manifest is just recomputed
+    _write_json(path, [dict(zip(["train", "val", "test"], split))])
+    _write_json(manifest_path, manifest)
+    logger.info(f"Wrote {path}")
+    return split
+
+
+def make_splits(n_workers: int | None = None) -> dict[str, Path]:
+    """
+    Precompute the default TrainConfig split of every training set on disk (per-target and multi-task),
+    so parallel runs find them ready.  Up-to-date splits are left alone.
+    """
+    from polaris_asap_admet.driver import TrainConfig
+
+    config = TrainConfig()
+    done = {}
+    for name, ds in [*admet_train_combined.items(), ("multitask", admet_multitask_train)]:
+        if not (migrate_csv(ds.filepath) or ds.filepath.exists()):
+            logger.warning(f"No {ds.filepath}; skipping its split.")
+            continue
+        dataset_split(ds.filepath, config.split_type, config.split_sizes, config.data_seed, n_workers)
+        done[name] = splits_path(ds.filepath, config.split_type, config.split_sizes, config.data_seed)
+    return done
@@ -0,0 +1,99 @@
+import re
+from datetime import datetime
+from pathlib import Path
+
+import polars as pl
+
+from polaris_asap_admet.io import asap_test_raw, scan_table
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.molecules import ID_COL, SMILES_COL, molecule_table
+
+RUNS_DIR = Path("runs")
+PREDS_RE = re.compile(r"^(?P<target>.+)_(?P<timestamp>\d{8}_\d{6})_preds$")
+TARGETS = [
+    "HLM",
+    "KSOL",
+    "LogD",
+    "MDR1-MDCKII",
+    "MLM",
+]
+LONG_SCHEMA = {ID_COL: pl.Int64, "target": pl.String, "value": pl.Float64}
+
+
+def latest_predictions(runs_dir: Path | str = RUNS_DIR, targets: list[str] = TARGETS) -> dict[str, Path]:
+    """
+    {target: newest runs/{target}_{timestamp}_preds.csv}, by the timestamp in the name.  Targets with no
+    run of their own fall back to the newest multitask run, if there is one.
+    """
+    by_name = {tgt.upper(): tgt for tgt in targets}
+    newest = {}
+    for path in Path(runs_dir).glob("*_preds.csv"):
+        match = PREDS_RE.match(path.stem)
+        if match is None:
+            continue
+        name = "multitask" if match["target"] == "multitask" else by_name.get(match["target"].upper())
+        if name is not None and match["timestamp"] > newest.get(name, ("", None))[0]:
+            newest[name] = (match["timestamp"], path)
+    multitask = newest.pop("multitask", (None, None))[1]
+    latest = {tgt: path for tgt, (_, path) in newest.items()}
+    if multitask is not None:
+        latest = {tgt: latest.get(tgt, multitask) for tgt in targets}
+    return latest
+
+
+def _long_predictions(path: Path, target: str) -> pl.DataFrame:
+    """
+    (mol_id, target, value) rows from one prediction file.  Runs written before they were keyed by mol_id
+    get their IDs looked up from the SMILES.
+    """
+    lf = scan_table(path)
+    columns = lf.collect_schema().names()
+    column = next((c for c in columns if c.upper() == target.upper()), None)
+    if column is None:
+        raise ValueError(f"{path} has no {target} column (columns: {columns}).")
+    if ID_COL in columns:
+        df = lf.select(pl.col(ID_COL).cast(pl.Int64), column).collect()
+    else:
+        df = lf.select(SMILES_COL, column).collect()
+        df = df.select(molecule_table.ids(df[SMILES_COL]), column)
+    return df.select(ID_COL, pl.lit(target).alias("target"), pl.col(column).cast(pl.Float64).alias("value"))
+
+
+@stage("submission")
+def assemble_submission(
+    runs_dir: Path | str = RUNS_DIR, test_path: Path | str | None = None, targets: list[str] = TARGETS
+) -> pl.DataFrame:
+    """
+    Every target's newest predictions (see latest_predictions) as one table over the test set, in its
+    order - CXSMILES, mol_id and a column per target - written to runs/submission_{timestamp}.csv.
+
+    The prediction files are stacked into one long (mol_id, target, value) table and widened by mol_id,
+    so the test set takes a single integer-keyed join.
+    """
+    test_path = test_path or asap_test_raw.filepath
+    sources = latest_predictions(runs_dir, targets)
+    missing = [tgt for tgt in targets if tgt not in sources]
+    if missing:
+        logger.warning(f"No predictions under {runs_dir} for {missing}; those columns come out null.")
+    for tgt, path in sources.items():
+        logger.info(f"{tgt}: {path}")
+
+    df_test = molecule_table.with_ids(scan_table(test_path).select(SMILES_COL).collect())
+    frames = [_long_predictions(path, tgt) for tgt, path in sources.items()]
+    df_long = pl.concat(frames) if frames else pl.DataFrame(schema=LONG_SCHEMA)
+    df_wide = df_long.group_by(ID_COL).agg(
+        *[pl.col("value").filter(pl.col("target") == tgt).mean().alias(tgt) for tgt in targets]
+    )
+    df = df_test.join(df_wide, on=ID_COL, how="left", maintain_order="left").select(SMILES_COL, ID_COL, *targets)
+
+    uncovered = {tgt: n for tgt, n in df.select(pl.col(targets).null_count()).row(0, named=True).items() if n}
+    if uncovered:
+        logger.warning(f"Test molecules without a prediction, per target: {uncovered}")
+    out = Path(runs_dir) / f"submission_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    df.write_csv(out)
+    metrics = current_stage()
+    metrics.rows_in, metrics.rows_out = len(df_long), len(df)
+    logger.info(f"Wrote {len(df)} rows to {out}")
+    return df
@@ -0,0 +1,191 @@
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import polars as pl
+
+from polaris_asap_admet.logger import logger
+from polaris_asap_admet.metrics import current_stage, stage
+from polaris_asap_admet.sources import TARGETS
+
+RUNS_DIR = Path("runs")
+# Every scalar from every event file under runs/, as Parquet parts plus _index.json - read it with scan_scalars()
+SCALARS_DIR = RUNS_DIR / "tensorboard_scalars"
+INDEX = "_index.json"  # committed parts, and how far into each event file they cover
+MAX_PARTS = 16  # past this many parts, they're compacted into one
+MIN_FILES_FOR_POOL = 8  # fewer new event files than this aren't worth starting processes for
+SCHEMA = {
+    "run": pl.String,
+    "model": pl.String,
+    "target": pl.String,
+    "tag": pl.String,
+    "step": pl.Int64,
+    "value": pl.Float64,
+    "wall_time": pl.Float64,
+}
+
+
+def _run_model_target(path: Path, runs_dir: Path) -> tuple[str, str | None, str | None]:
+    """
+    For runs/HLM_20250227_012525/model_0/trainer_logs/version_0/events...:  ("HLM_20250227_012525", "model_0", "HLM").
+    Also understands runs/hpo/HLM/trial_3/model_0/... and runs/benchmark_{ts}/HLM/model_0/....
+    """
+    parts = path.relative_to(runs_dir).parts[:-1]
+    model_idx = next((i for i, p in enumerate(parts) if p.startswith("model_")), None)
+    run_parts = parts[:model_idx] if model_idx is not None else parts
+    by_name = {tgt.upper(): tgt for tgt in [*TARGETS, "multitask"]}
+    target = None
+    for part in run_parts:
+        name = part.rsplit("_", 2)[0] if part.count("_") >= 2 else part  # HLM_20250227_012525 -> HLM
+        target = by_name.get(name.upper(), target)
+    return "/".join(run_parts), parts[model_idx] if model_idx is not None else None, target
+
+
+def read_scalars(path: str, offset: int = 0) -> tuple[int, dict[str, list]]:
+    """
+    Every scalar in the TFRecord event file at path from byte offset on.  Returns the offset of the end of
+    the last complete record - a record still being written is left for next time - and the scalars as columns.
+    Runs in a worker process.
+    """
+    from tensorboard.compat.proto import event_pb2
+    from tensorboard.util import tensor_util
+
+    columns = {"tag": [], "step": [], "value": [], "wall_time": []}
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    pos = 0
+    # Each record:  uint64 length, uint32 length crc, data, uint32 data crc
+    while pos + 12 <= len(data):
+        (length,) = struct.unpack_from("<Q", data, pos)
+        end = pos + 12 + length + 4
+        if end > len(data):
+            break
+        event = event_pb2.Event.FromString(data[pos + 12 : pos + 12 + length])
+        pos = end
+        for value in event.summary.value:
+            kind = value.WhichOneof("value")
+            if kind == "simple_value":
+                scalar = value.simple_value
+            elif kind == "tensor" and value.metadata.plugin_data.plugin_name == "scalars":
+                scalar = tensor_util.make_ndarray(value.tensor).item()
+            else:
+                continue
+            columns["tag"].append(value.tag)
+            columns["step"].append(event.step)
+            columns["value"].append(float(scalar))
+            columns["wall_time"].append(event.wall_time)
+    return offset + pos, columns
+
+
+def _read_index(out_dir: Path) -> dict:
+    path = out_dir / INDEX
+    if not path.exists():
+        return {"parts": [], "offsets": {}, "next_part": 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_index(out_dir: Path, index: dict) -> None:
+    tmp_path = out_dir / f"{INDEX}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, out_dir / INDEX)
+
+
+def _write_part(out_dir: Path, index: dict, df: pl.DataFrame) -> str:
+    name = f"part-{index['next_part']:05d}.parquet"
+    index["next_part"] += 1
+    tmp_path = out_dir / f"{name}.tmp"
+    df.write_parquet(tmp_path, compression="zstd", statistics=True)
+    os.replace(tmp_path, out_dir / name)
+    return name
+
+
+def scan_scalars(out_dir: Path | str = SCALARS_DIR) -> pl.LazyFrame:
+    """
+    The exported scalars (run, model, target, tag, step, value, wall_time), e.g.
+    scan_scalars().filter(pl.col("tag") == "val_loss").group_by("run").agg(pl.col("value").min()).collect()
+    """
+    out_dir = Path(out_dir)
+    parts = [out_dir / p for p in _read_index(out_dir)["parts"]]
+    if not parts:
+        return pl.LazyFrame(schema=SCHEMA)
+    return pl.scan_parquet(parts)
+
+
+@stage("export_tensorboard_logs")
+def export_tensorboard_logs(
+    runs_dir: Path | str = RUNS_DIR, out_dir: Path | str | None = None, n_workers: int | None = None
+) -> pl.LazyFrame:
+    """
+    Bring the scalars table up to date with every TensorBoard event file under runs_dir.
+
+    Event files are only ever appended to, so for each one we remember how many bytes we've read and
+    only parse what's new (in parallel, across files).  New scalars go into a new Parquet part and the
+    index is swapped in after it, so an interrupted export leaves the table as it was.  Once there are
+    more than MAX_PARTS parts they're compacted into one, sorted by run, tag and step.
+    """
+    runs_dir = Path(runs_dir)
+    out_dir = Path(out_dir) if out_dir else runs_dir / SCALARS_DIR.relative_to(RUNS_DIR)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    index = _read_index(out_dir)
+    # Parts an interrupted export wrote but never committed
+    for path in out_dir.glob("part-*.parquet*"):
+        if path.name not in index["parts"]:
+            path.unlink()
+
+    files = sorted(runs_dir.rglob("events.out.tfevents.*"))
+    todo = [
+        (str(path), index["offsets"].get(str(path), 0))
+        for path in files
+        if path.stat().st_size > index["offsets"].get(str(path), 0)
+    ]
+    logger.info(f"{len(files)} event files under {runs_dir}, {len(todo)} with new records.")
+    if todo:
+        n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(todo)))
+        if n_workers == 1 or len(todo) < MIN_FILES_FOR_POOL:
+            results = [read_scalars(path, offset) for path, offset in todo]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn")) as pool:
+                results = list(pool.map(read_scalars, *zip(*todo), chunksize=max(1, len(todo) // (4 * n_workers))))
+
+        frames = []
+        for (path, _), (offset, columns) in zip(todo, results):
+            index["offsets"][path] = offset
+            if columns["tag"]:
+                run, model, target = _run_model_target(Path(path), runs_dir)
+                frames.append(
+                    pl.DataFrame(columns, schema_overrides={"step": pl.Int64}).select(
+                        pl.lit(run).alias("run"), pl.lit(model, pl.String).alias("model"),
+                        pl.lit(target, pl.String).alias("target"), pl.all(),
+                    )
+                )
+        df_new = pl.concat(frames).cast(SCHEMA) if frames else pl.DataFrame(schema=SCHEMA)
+        if len(df_new):
+            index["parts"].append(_write_part(out_dir, index, df_new))
+        _write_index(out_dir, index)
+        logger.info(f"Added {len(df_new)} scalars from {len(todo)} event files to {out_dir}.")
+        current_stage().rows_out = len(df_new)
+
+    if len(index["parts"]) > MAX_PARTS:
+        old_parts = index["parts"]
+        df_all = pl.read_parquet([out_dir / p for p in old_parts]).sort("run", "model", "tag", "step")
+        index["parts"] = [_write_part(out_dir, index, df_all)]
+        _write_index(out_dir, index)
+        for name in old_parts:
+            (out_dir / name).unlink()
+        logger.info(f"Compacted {len(old_parts)} parts into {index['parts'][0]} ({len(df_all)} scalars).")
+
+    lf = scan_scalars(out_dir)
+    print(
+        lf.filter(pl.col("tag").is_in(["train_loss", "val_loss"]))
+        .group_by("run", "tag")
+        .agg(pl.col("step").max().alias("last_step"), pl.col("value").min().alias("min"), pl.col("value").sort_by("step").last())
+        .sort("run", "tag")
+        .collect()
+    )
+    return lf
@@ -1,12 +1,25 @@
+import os
+
 import polars as pl
 
 from polaris_asap_admet.logger import logger
 
+# Turns on the diagnostics that cost something (estimated size, approximate unique counts) everywhere
+DIAGNOSTICS = os.getenv("POLARIS_ASAP_ADMET_DIAGNOSTICS", "0") != "0"
+
 
-def print_info(df: pl.DataFrame, show_columns: bool = True, show_unique: bool = False):
+def print_info(
+    df: pl.DataFrame,
+    show_columns: bool = True,
+    show_unique: bool | None = None,
+    show_size: bool | None = None,
+):
     """
     Print diagnostic info about this dataframe.
+    Shape and columns are free; size and unique counts are off unless asked for (or DIAGNOSTICS is on).
     """
+    show_unique = DIAGNOSTICS if show_unique is None else show_unique
+    show_size = DIAGNOSTICS if show_size is None else show_size
     if show_columns:
         # columns = df.columns
         columns = []
@@ -14,46 +27,12 @@ def print_info(df: pl.DataFrame, show_columns: bool = True, show_unique: bool =
             columns.append(f"{i}: {j}")
     else:
         columns = "<you asked not to see these>"
-    logger.info(
-        f"Shape: {df.shape}, size: {df.estimated_size(unit='gb')} GB ({df.estimated_size(unit='mb')} MB), columns: {columns}."
-    )
+    if show_size:
+        size_mb = df.estimated_size(unit="mb")
+        size = f", size: {size_mb / 1024} GB ({size_mb} MB)"
+    else:
+        size = ""
+    logger.info(f"Shape: {df.shape}{size}, columns: {columns}.")
     if show_unique:
         print(f"Unique:  {df.approx_n_unique()}")
 
-
-def export_tensorboard_logs():
-    """
-    Export tensorboard logs to CSV, including timestamped directory names.
-    """
-    import os
-
-    from tensorboard.backend.event_processing import event_accumulator
-
-    for root, _, files in os.walk("runs/"):
-        for file in files:
-            if "events.out.tfevents" in file:
-                path = os.path.join(root, file)
-                run_name = path.split("/")[1]
-                ea = event_accumulator.EventAccumulator(path)
-                ea.Reload()
-                for tag in ea.Tags()["scalars"]:
-                    if "val_loss" in tag or "train_loss" in tag:
-                        data = ea.Scalars(tag)
-                        steps = [d.step for d in data]
-                        values = [d.value for d in data]
-                        # Extract directory name (e.g., HLM_20250227_012525) from root path
-                        # cbrown:  ...nope, we fixed run_name above
-                        # run_name = os.path.basename(root)  # Gets the last folder, e.g., HLM_20250227_012525
-                        print(
-                            f"{run_name}_{tag}: Steps {min(steps)}–{max(steps)}, Values {min(values):.4f}–{max(values):.4f}"
-                        )
-                        # Optional: Write to CSV
-                        # with open(f"runs/{run_name}_{tag}.csv", "w") as f:
-                        #     f.write("step,value\n")
-                        #     for step, value in zip(steps, values):
-                        #         f.write(f"{step},{value}\n")
-    print("Done.")
-
-
-if __name__ == "__main__":
-    export_tensorboard_logs()
@@ -0,0 +1,37 @@
+import argparse
+
+import torch
+
+from polaris_asap_admet.batch_predict import BATCH_SIZE, CHUNK_SIZE, predict_library
+
+# workers are spawned, so they re-import this file:  keep the work behind the main guard
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score a CSV/Parquet/.smi library with the newest model for every target, resumably."
+    )
+    parser.add_argument("input_file")  # e.g., library.smi
+    parser.add_argument("output_dir")  # e.g., preds/library - one Parquet file per chunk, plus _checkpoint.json
+    parser.add_argument("--smiles-col", default="CXSMILES")
+    parser.add_argument("--id-col", default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--num-workers", type=int, default=None)  # featurization processes
+    parser.add_argument("--threads", type=int, default=None)  # torch intra-op threads
+    parser.add_argument("--restart", action="store_true")  # throw away existing output instead of resuming
+    parser.add_argument("--no-similarity", action="store_true")  # skip the nearest-training-molecule columns
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    predict_library(
+        args.input_file,
+        args.output_dir,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        n_workers=args.num_workers,
+        smiles_col=args.smiles_col,
+        id_col=args.id_col,
+        restart=args.restart,
+        similarity=not args.no_similarity,
+    )
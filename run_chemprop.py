@@ -1,48 +1,45 @@
-import os
-import subprocess
-import sys
-from datetime import datetime
+import argparse
+from dataclasses import replace
 
-import pandas as pd
+import torch
 
-# Args: train_file, test_file, config_name
-base_name = sys.argv[1]  # e.g., HLM
-train_file = sys.argv[2]  # e.g., ADME_HLM_train.csv
-test_file = sys.argv[3]  # e.g., ADME_HLM_test.csv
+from polaris_asap_admet.driver import TrainConfig, run
+from polaris_asap_admet.ensemble import train_ensemble
 
 targets = ["HLM", "KSOL", "LOGD", "MDR1-MDCKII", "MLM"]
-if base_name not in targets:
-    raise ValueError(f"Invalid base_name {base_name}; must be one of {targets}")
 
-
-train_path = os.path.join(".", train_file)
-test_path = os.path.join(".", test_file)
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")  # e.g., 20250220_153022
-output_dir = os.path.join("runs", f"{base_name}_{timestamp}")
-preds_file = f"runs/{base_name}_{timestamp}_preds.csv"
-
-# Ensure runs/ exists
-os.makedirs("runs", exist_ok=True)
-
-# Train with RDKit features and r2
-train_cmd = (
-    f"chemprop train --data-path {train_path} "
-    f"--molecule-featurizers v1_rdkit_2d_normalized --no-bond-feature-scaling "
-    f"--metric r2 --dropout 0.2 --epochs 10 --batch-size 64 --output-dir {output_dir} --accelerator gpu --num-workers 4 "
-    f"--split-type KMEANS --split-size 0.8 0.1 0.1 "
-)
-subprocess.run(train_cmd, shell=True, check=True)
-
-# Predict command
-predict_cmd = (
-    f"chemprop predict --test-path {test_path} "
-    f"--molecule-featurizers v1_rdkit_2d_normalized --no-bond-feature-scaling "
-    f"--model-path {output_dir}/model_0/best.pt "
-    f"--preds-path {preds_file} "
-    f"--num-workers 4 --batch-size 64 "
-)
-subprocess.run(predict_cmd, shell=True, check=True)
-
-# Read predictions
-test_pred = pd.read_csv(preds_file)
-print(test_pred.head())
+# --ensemble/--folds train in spawned processes, which re-import this file:  keep the work behind the main guard
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base_name", choices=targets)  # e.g., HLM
+    parser.add_argument("train_file")  # e.g., data/combined/admet_HLM_train.parquet
+    parser.add_argument("test_file")  # e.g., data/raw/asap_test_raw.parquet
+    parser.add_argument("--accelerator", default="auto")
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=None)  # torch intra-op threads
+    parser.add_argument("--ensemble", type=int, default=None)  # train this many replicates in parallel and average
+    parser.add_argument("--folds", type=int, default=None)  # or one model per fold of a k-fold split
+    parser.add_argument("--ensemble-workers", type=int, default=None)  # members trained at once
+    parser.add_argument("--config", default=None)  # TrainConfig JSON, e.g. configs/HLM.json from search_hparams.py
+    parser.add_argument("--retrain", action="store_true")  # even if the model cache has this exact run already
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # Train with RDKit features and r2, then predict, all in this process
+    config = TrainConfig.load(args.config) if args.config else TrainConfig()
+    config = replace(config, accelerator=args.accelerator, num_workers=args.num_workers)
+    if args.ensemble or args.folds:
+        test_pred = train_ensemble(
+            args.base_name,
+            args.train_file,
+            args.test_file,
+            n_members=args.ensemble or 1,
+            folds=args.folds,
+            n_workers=args.ensemble_workers,
+            config=config,
+        )
+    else:
+        test_pred = run(args.base_name, args.train_file, args.test_file, config, use_cache=not args.retrain)
+    print(test_pred.head())
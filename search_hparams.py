@@ -0,0 +1,33 @@
+import argparse
+
+from polaris_asap_admet.hpo import MAX_EPOCHS, PRUNERS, SAMPLERS, STORAGE, search
+
+targets = ["HLM", "KSOL", "LogD", "MDR1-MDCKII", "MLM"]
+
+# with --jobs > 1 trials run in spawned processes, which re-import this file:  keep the work behind the main guard
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Tune one target's hyperparameters within a budget; re-run to resume. Writes configs/{target}.json."
+    )
+    parser.add_argument("target", choices=targets)
+    parser.add_argument("--trials", type=int, default=None)  # finished trials, over all sessions
+    parser.add_argument("--budget-cpu-hours", type=float, default=None)  # trial CPU time, over all sessions
+    parser.add_argument("--jobs", type=int, default=None)  # trials at once
+    parser.add_argument("--sampler", choices=SAMPLERS, default="tpe")
+    parser.add_argument("--pruner", choices=PRUNERS, default="hyperband")
+    parser.add_argument("--max-epochs", type=int, default=MAX_EPOCHS)
+    parser.add_argument("--storage", default=STORAGE)  # e.g., sqlite:///runs/hpo/studies.sqlite3
+    parser.add_argument("--train-file", default=None)  # defaults to data/combined/admet_{target}_train
+    args = parser.parse_args()
+
+    search(
+        args.target,
+        n_trials=args.trials,
+        budget_cpu_hours=args.budget_cpu_hours,
+        n_jobs=args.jobs,
+        sampler=args.sampler,
+        pruner=args.pruner,
+        max_epochs=args.max_epochs,
+        storage=args.storage,
+        train_path=args.train_file,
+    )
@@ -0,0 +1,15 @@
+import pytest
+
+from polaris_asap_admet.io import data_dir
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """
+    A fresh POLARIS_ASAP_ADMET_HOME, so stores and caches start empty.  Spawned workers inherit it.
+    """
+    monkeypatch.setenv("POLARIS_ASAP_ADMET_HOME", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    data_dir.cache_clear()
+    yield tmp_path
+    data_dir.cache_clear()
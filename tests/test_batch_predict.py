@@ -0,0 +1,58 @@
+import numpy as np
+import polars as pl
+from chemprop import nn
+from chemprop.models.utils import save_model
+
+from polaris_asap_admet.batch_predict import iter_chunks, predict_library
+from polaris_asap_admet.driver import (SMILES_COL, TrainConfig, build_model, load_datapoints,
+                                       make_dataset, predict)
+
+SMILES = [
+    "CCO",
+    "c1ccccc1N",
+    "CC(=O)Nc1ccc(O)cc1",
+    "C[Se]C",  # descriptastorus gives NaN descriptors for these three
+    "O=[Pt](Cl)Cl",
+    "CC(C)(C)[Sn](C)(C)C",
+    "OC1CCCCC1",
+    "Clc1ccccc1",
+]
+
+
+def _untrained_model(df: pl.DataFrame):
+    dset = make_dataset(load_datapoints(df.with_columns(HLM=pl.int_range(len(df)).cast(pl.Float64)), ["HLM"]))
+    X_d_transform = nn.ScaleTransform.from_standard_scaler(dset.normalize_inputs("X_d"))
+    output_transform = nn.UnscaleTransform.from_standard_scaler(dset.normalize_targets())
+    model = build_model(dset, TrainConfig(), X_d_transform, output_transform)
+    model.eval()
+    return model
+
+
+def test_batch_matches_driver(home):
+    df = pl.DataFrame({SMILES_COL: SMILES})
+    model = _untrained_model(df)
+    model_path = home / "HLM_20250101_000000" / "model_0" / "best.pt"
+    model_path.parent.mkdir(parents=True)
+    save_model(model_path, model, ["HLM"])
+    expected = predict(model, make_dataset(load_datapoints(df)), TrainConfig(num_workers=0))[:, 0]
+
+    df.write_csv(home / "library.csv")
+    predict_library(
+        home / "library.csv", home / "preds", model_paths={"HLM": model_path}, n_workers=1, similarity=False
+    )
+    got = pl.read_parquet(home / "preds" / "*.parquet")["HLM"].to_numpy()
+
+    assert not np.isnan(got).any()
+    np.testing.assert_allclose(got, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_smi_skips_blank_and_comment_lines(tmp_path):
+    path = tmp_path / "library.smi"
+    path.write_text("# a comment\nCCO ethanol\n\nc1ccccc1N aniline\n  # indented comment\nOC1CCCCC1\n\n")
+    df = pl.concat(iter_chunks(path, chunk_size=2))
+    assert df.to_dict(as_series=False) == {
+        SMILES_COL: ["CCO", "c1ccccc1N", "OC1CCCCC1"],
+        "name": ["ethanol", "aniline", None],
+    }
+    # resuming skips molecules, not lines
+    assert pl.concat(iter_chunks(path, chunk_size=2, skip=2))[SMILES_COL].to_list() == ["OC1CCCCC1"]
@@ -0,0 +1,79 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from polaris_asap_admet.download import fetch_url
+
+BODY = bytes(range(256)) * 64
+ETAG = '"v1"'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves BODY with an ETag, honouring If-None-Match and Range/If-Range.  Records each request's headers.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        rng = self.headers.get("Range")
+        if rng and self.headers.get("If-Range") == ETAG:
+            start = int(rng.removeprefix("bytes=").rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(BODY) - 1}/{len(BODY)}")
+            body = BODY[start:]
+        else:
+            self.send_response(200)
+            body = BODY
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/file.csv"
+
+
+def test_fetch_url_resumes_a_partial_download(server, tmp_path):
+    dest = tmp_path / "file.csv"
+    # an earlier download stopped a third of the way in
+    (tmp_path / "file.csv.part").write_bytes(BODY[: len(BODY) // 3])
+    (tmp_path / "file.csv.part.etag").write_text(ETAG)
+
+    assert fetch_url(_url(server), dest, sha256=hashlib.sha256(BODY).hexdigest()) == (True, ETAG)
+    assert dest.read_bytes() == BODY
+    assert server.requests[-1]["Range"] == f"bytes={len(BODY) // 3}-"
+    assert not (tmp_path / "file.csv.part").exists() and not (tmp_path / "file.csv.part.etag").exists()
+
+    # unchanged since: the server says so and nothing is rewritten
+    assert fetch_url(_url(server), dest, etag=ETAG) == (False, ETAG)
+    assert server.requests[-1]["If-None-Match"] == ETAG
+
+
+def test_fetch_url_rejects_a_checksum_mismatch(server, tmp_path):
+    dest = tmp_path / "file.csv"
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        fetch_url(_url(server), dest, sha256="0" * 64)
+    assert not dest.exists()
+    # the bad bytes aren't kept around to resume from
+    assert not (tmp_path / "file.csv.part").exists()
@@ -0,0 +1,34 @@
+import pickle
+
+import numpy as np
+import polars as pl
+from chemprop import featurizers
+from lightning import pytorch as lightning_pl
+from rdkit import Chem
+
+from polaris_asap_admet.driver import SMILES_COL, SharedMolGraphs, TrainConfig, train
+
+SMILES = ["CCO", "c1ccccc1N", "CC(=O)Nc1ccc(O)cc1", "OC1CCCCC1", "Clc1ccccc1", "CCN(CC)CC", "C", "O=C=O"]
+
+
+def test_shared_molgraphs_match_the_featurizer(home):
+    mgs = SharedMolGraphs.write(SMILES, home / "molgraphs")
+    featurizer = featurizers.SimpleMoleculeMolGraphFeaturizer()
+    subset = pickle.loads(pickle.dumps(mgs.take([5, 0, 6])))
+    assert len(mgs) == len(SMILES) and len(subset) == 3
+    for i, mg in zip([5, 0, 6], subset):
+        expected = featurizer(Chem.MolFromSmiles(SMILES[i]))
+        for field in SharedMolGraphs.FIELDS:
+            np.testing.assert_array_equal(getattr(mg, field), getattr(expected, field))
+
+
+def test_training_on_shared_molgraphs_matches(home):
+    df = pl.DataFrame({SMILES_COL: SMILES, "HLM": [float(i) for i in range(len(SMILES))]})
+    mgs = SharedMolGraphs.write(SMILES, home / "molgraphs")
+    config = TrainConfig(epochs=2, num_workers=0)
+    split = ([0, 1, 2, 3], [4, 5], [6, 7])
+    scores = []
+    for member, molgraphs in enumerate([None, mgs]):
+        lightning_pl.seed_everything(0, verbose=False)
+        scores.append(train(df, ["HLM"], home / "run", config, member=member, split=split, molgraphs=molgraphs).test_scores)
+    assert scores[0]["HLM/mae"] == scores[1]["HLM/mae"]
@@ -0,0 +1,30 @@
+import numpy as np
+import polars as pl
+
+from polaris_asap_admet import features
+from polaris_asap_admet.features import FeatureStore
+
+
+def test_update_only_adds_new_molecules(home, monkeypatch):
+    store = FeatureStore()
+    first = pl.Series(["CCO", "c1ccccc1N", "OC1CCCCC1"])
+    X_first = store.get(first, n_workers=1)
+    shard_0 = store.shard_path(0)
+    before = (shard_0.stat().st_mtime_ns, shard_0.read_bytes())
+
+    featurized = []
+    featurize_chunk = features._featurize_chunk
+    monkeypatch.setattr(features, "_featurize_chunk", lambda c: featurized.extend(c) or featurize_chunk(c))
+    second = pl.Series(["CCO", "Clc1ccccc1", "CC(=O)Nc1ccc(O)cc1", "c1ccccc1N"])
+    X_second = store.get(second, n_workers=1)
+
+    assert featurized == ["Clc1ccccc1", "CC(=O)Nc1ccc(O)cc1"]
+    # the existing rows' file isn't rewritten; the new ones are in a shard of their own
+    assert (shard_0.stat().st_mtime_ns, shard_0.read_bytes()) == before
+    assert len(store.load_shard(1)) == 2
+    np.testing.assert_array_equal(X_second[[0, 3]], X_first[[0, 1]])
+    np.testing.assert_array_equal(X_second[1:3], featurize_chunk(second[1:3].to_list()))
+
+    X, found = store.lookup(pl.Series(["CCO", "CCCl", "Clc1ccccc1"]))
+    assert found.tolist() == [True, False, True]
+    assert np.isnan(X[1]).all()
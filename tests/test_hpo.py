@@ -0,0 +1,11 @@
+import subprocess
+import sys
+
+from polaris_asap_admet.hpo import _cpu_seconds
+
+
+def test_cpu_seconds_count_child_processes():
+    # what dataloader workers are to a trial:  the CPU is spent in another process
+    start = _cpu_seconds()
+    subprocess.run([sys.executable, "-c", "sum(range(20_000_000))"], check=True)
+    assert _cpu_seconds() - start > 0.1
@@ -0,0 +1,63 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from polaris_asap_admet.logger import (LOG_SOCKET_VAR, RateLimitedLogger, _Collector, _JsonLinesSink,
+                                       logger)
+from polaris_asap_admet.metrics import stage
+
+
+def _log_from_child(message: str) -> int:
+    logger.info(message)
+    return os.getpid()
+
+
+def test_child_records_reach_the_parents_json_sink(home, monkeypatch):
+    monkeypatch.setattr("polaris_asap_admet.metrics.METRICS_ENABLED", False)
+    path = home / "log.jsonl"
+    sink = logger.add(_JsonLinesSink(str(path)).write, level="INFO")
+    collector = _Collector()
+    monkeypatch.setenv(LOG_SOCKET_VAR, collector.address)
+    try:
+        with stage("child_logs", target="HLM"):
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                child_pid = pool.submit(_log_from_child, "hello from the child").result()
+        # the collector re-emits on its own thread
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            records = [json.loads(line) for line in path.read_text().splitlines()] if path.exists() else []
+            from_child = [r for r in records if r["message"] == "hello from the child"]
+            if from_child:
+                break
+            time.sleep(0.05)
+    finally:
+        collector.stop()
+        logger.remove(sink)
+
+    assert len(from_child) == 1
+    record = from_child[0]
+    assert record["pid"] == child_pid != os.getpid()
+    assert (record["stage"], record["target"]) == ("child_logs", "HLM")
+    assert (record["name"], record["function"]) == ("test_logger", "_log_from_child")
+
+
+def test_rate_limited_logger_drops_and_samples():
+    messages = []
+    sink = logger.add(lambda m: messages.append(m.record["message"]), level="INFO", format="{message}")
+    try:
+        per_molecule = RateLimitedLogger(per_second=0, burst=2, sample_every=4)
+        for i in range(1, 9):
+            per_molecule.info("molecule {}", i)
+        per_molecule.debug("below the level, so not even counted")
+    finally:
+        logger.remove(sink)
+    # two from the burst, then only every fourth, each saying how many were dropped since the last
+    assert messages == [
+        "molecule 1",
+        "molecule 2",
+        "molecule 4 (1 similar dropped)",
+        "molecule 8 (3 similar dropped)",
+    ]
+    assert per_molecule.seen == 8
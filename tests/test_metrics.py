@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from polaris_asap_admet import metrics
+from polaris_asap_admet.logger import LOG_STAGE_VAR
+from polaris_asap_admet.metrics import stage
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="needs a resettable RSS high-water mark")
+def test_nested_stage_keeps_outer_peak(home, monkeypatch):
+    monkeypatch.setattr("polaris_asap_admet.metrics.METRICS_ENABLED", False)
+    with stage("outer") as outer:
+        a = np.ones(200_000_000 // 8)
+        a[:] = 2
+        del a
+        with stage("inner"):
+            pass
+    assert outer.peak_rss_mb > 200
+
+
+def test_concurrent_stages_leave_the_first_ones_process_state_alone(home, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+    resets = []
+    monkeypatch.setattr(metrics, "_reset_peak_rss", lambda: resets.append(1))
+    a_started, b_done = threading.Event(), threading.Event()
+    seen = {}
+
+    def run_a():
+        with stage("a"):
+            a_started.set()
+            b_done.wait(10)
+            seen["a"] = os.environ.get(LOG_STAGE_VAR)
+            with stage("a_nested"):
+                seen["a_nested"] = os.environ.get(LOG_STAGE_VAR)
+
+    def run_b():
+        a_started.wait(10)
+        with stage("b"):
+            seen["b"] = os.environ.get(LOG_STAGE_VAR)
+        b_done.set()
+
+    threads = [threading.Thread(target=run_a), threading.Thread(target=run_b)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # b started while a was running:  it didn't reset a's peak, or retag (then untag) a's child processes
+    assert len(resets) == 1
+    assert json.loads(seen["b"])["stage"] == "a"
+    assert json.loads(seen["a"])["stage"] == "a"
+    # once b is done, a's own nested stages work as before
+    assert json.loads(seen["a_nested"])["stage"] == "a_nested"
+    assert LOG_STAGE_VAR not in os.environ
@@ -0,0 +1,34 @@
+from dataclasses import replace
+
+import polars as pl
+
+from polaris_asap_admet import io
+from polaris_asap_admet.driver import TrainConfig
+from polaris_asap_admet.model_cache import training_key
+
+DF = pl.DataFrame({"CXSMILES": ["CCO", "c1ccccc1N"], "mol_id": [1, 2], "HLM": [1.0, 2.0]})
+
+
+def _key(df: pl.DataFrame = DF, config: TrainConfig = TrainConfig()) -> str:
+    return training_key(df, ["HLM"], config)[0]
+
+
+def test_training_key_tracks_what_the_model_depends_on(monkeypatch):
+    key = _key()
+    assert _key() == key
+    # not what the model depends on
+    assert _key(config=replace(TrainConfig(), num_workers=7)) == key
+    assert _key(config=replace(TrainConfig(), accelerator="cpu")) == key
+    assert _key(config=replace(TrainConfig(), accelerator="gpu")) == key
+    assert _key(DF.with_columns(mol_id=pl.lit(99))) == key
+    # what it does
+    assert _key(DF.with_columns(HLM=pl.lit(3.0))) != key
+    assert _key(config=replace(TrainConfig(), epochs=TrainConfig().epochs + 1)) != key
+
+    # code the driver only reaches through other modules counts too
+    file_hash = io.file_hash
+    for module in ["conformers.py", "molecules.py", "similarity.py"]:
+        monkeypatch.setattr(
+            io, "file_hash", lambda path, module=module: "edited" if str(path).endswith(module) else file_hash(path)
+        )
+        assert _key() != key
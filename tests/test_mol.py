@@ -0,0 +1,26 @@
+import numpy as np
+import polars as pl
+
+from polaris_asap_admet.mol import filter_valid_smiles, with_mol_properties
+
+SMILES = ["CCO", "not a molecule", "c1ccccc1N", "C1CC", "OC1CCCCC1", None]
+
+
+def _df(n: int = 200_000) -> pl.DataFrame:
+    # big enough that polars joins in parallel - where an unordered join would shuffle rows
+    idx = np.random.default_rng(0).integers(0, len(SMILES), n)
+    return pl.DataFrame({"CXSMILES": [SMILES[i] for i in idx], "row": np.arange(n)})
+
+
+def test_with_mol_properties_keeps_row_order(home):
+    df = _df()
+    df_props = with_mol_properties(df)
+    assert df_props["row"].to_list() == df["row"].to_list()
+    assert df_props["CXSMILES"].to_list() == df["CXSMILES"].to_list()
+
+
+def test_filter_valid_smiles_drops_the_right_rows(home):
+    df = _df()
+    valid = ~df["CXSMILES"].is_in(["not a molecule", "C1CC"]) & df["CXSMILES"].is_not_null()
+    assert filter_valid_smiles(df)["row"].to_list() == df.filter(valid)["row"].to_list()
+    assert set(filter_valid_smiles(df.lazy()).collect()["row"]) == set(df.filter(valid)["row"])
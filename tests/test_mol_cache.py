@@ -0,0 +1,30 @@
+from datetime import datetime
+
+import polars as pl
+
+from polaris_asap_admet.mol_cache import LAST_USED_RESOLUTION, mol_cache
+
+
+def test_only_misses_rewrite_the_cache(home):
+    df = mol_cache.lookup(pl.Series("CXSMILES", ["CCO", "not a molecule", None, "CCO"]))
+    assert df["canonical_smiles"].to_list() == ["CCO", None, None, "CCO"]
+    assert df["error"].to_list() == [None, "unparseable SMILES", "null SMILES", None]
+    mtime = mol_cache.filepath.stat().st_mtime_ns
+
+    # all hits:  nothing to write
+    assert mol_cache.lookup(pl.Series("CXSMILES", ["CCO"]))["canonical_smiles"].to_list() == ["CCO"]
+    assert mol_cache.filepath.stat().st_mtime_ns == mtime
+
+    # a miss adds to the cache, and keeps what was there
+    assert mol_cache.lookup(pl.Series("CXSMILES", ["OCC", "c1ccccc1N"]))["canonical_smiles"].to_list() == ["CCO", "Nc1ccccc1"]
+    assert set(mol_cache.load()["smiles"]) == {"CCO", "not a molecule", "OCC", "c1ccccc1N"}
+
+
+def test_old_hits_get_last_used_bumped(home):
+    mol_cache.lookup(pl.Series("CXSMILES", ["CCO", "OCC"]))
+    long_ago = datetime.now() - 2 * LAST_USED_RESOLUTION
+    mol_cache.save(mol_cache.load().with_columns(pl.lit(long_ago).alias("last_used")))
+
+    mol_cache.lookup(pl.Series("CXSMILES", ["CCO"]))
+    last_used = dict(mol_cache.load().select("smiles", "last_used").iter_rows())
+    assert last_used["CCO"] > long_ago and last_used["OCC"] == long_ago
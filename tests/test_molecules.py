@@ -0,0 +1,31 @@
+import polars as pl
+import pytest
+
+from polaris_asap_admet.io import scan_table
+from polaris_asap_admet.molecules import ID_COL, SMILES_COL, molecule_table
+
+
+def test_keyed_files_read_back_with_smiles(home):
+    # "OCC" and "CCO" are the same molecule, so they share an ID and read back as one spelling
+    df = pl.DataFrame({SMILES_COL: ["OCC", "c1ccccc1N", "CCO", "not a molecule"], "HLM": [1.0, 2.0, 3.0, 4.0]})
+    df_keyed = molecule_table.keyed(df)
+    assert df_keyed.columns == [ID_COL, "HLM"] and df_keyed[ID_COL].dtype == pl.Int64
+    df_keyed.write_parquet(home / "keyed.parquet")
+
+    df_back = scan_table(home / "keyed.parquet").collect()
+    assert df_back.columns == [SMILES_COL, ID_COL, "HLM"]
+    assert df_back[SMILES_COL].to_list() == ["CCO", "Nc1ccccc1", "CCO", "not a molecule"]
+    assert df_back["HLM"].to_list() == df["HLM"].to_list()
+
+
+def test_ids_survive_a_rebuilt_table(home):
+    smiles = pl.Series(SMILES_COL, ["CCO", "c1ccccc1N"])
+    ids = molecule_table.ids(smiles)
+    pl.DataFrame({ID_COL: ids}).write_parquet(home / "keyed.parquet")
+
+    molecule_table.filepath.unlink()
+    with pytest.raises(RuntimeError, match="aren't in"):
+        scan_table(home / "keyed.parquet")
+    # registering the same molecules again (in another order) hands out the same IDs
+    assert molecule_table.ids(smiles.reverse()).reverse().to_list() == ids.to_list()
+    assert scan_table(home / "keyed.parquet").collect()[SMILES_COL].to_list() == ["CCO", "Nc1ccccc1"]
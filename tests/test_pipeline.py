@@ -0,0 +1,84 @@
+import polars as pl
+import pytest
+
+from polaris_asap_admet import io
+from polaris_asap_admet.io import (admet_train_combined, asap_test_raw, asap_train_raw,
+                                   computational_adme_raw, tdc_lipophilicity_az_raw)
+from polaris_asap_admet.molecules import molecule_table
+from polaris_asap_admet.pipeline import run_pipeline, staleness
+from polaris_asap_admet.sources import DEDUP_REPORT
+
+SMILES = ["CCO", "c1ccccc1N", "CC(=O)Nc1ccc(O)cc1", "OC1CCCCC1", "Clc1ccccc1", "CCN(CC)CC"]
+
+
+@pytest.fixture
+def raw_data(home):
+    """
+    Tiny raw files for every source, so the pipeline can build everything downstream of them.
+    """
+    n = len(SMILES)
+    asap_train_raw.save(
+        pl.DataFrame(
+            {
+                "CXSMILES": SMILES,
+                **{tgt: [float(i) for i in range(n)] for tgt in ["HLM", "KSOL", "LogD", "MDR1-MDCKII", "MLM"]},
+            }
+        )
+    )
+    asap_test_raw.save(pl.DataFrame({"CXSMILES": SMILES[:2]}))
+    computational_adme_raw.save(
+        pl.DataFrame(
+            {
+                "SMILES": SMILES,
+                "LOG HLM_CLint (mL/min/kg)": [1.0] * n,
+                "LOG SOLUBILITY PH 6.8 (ug/mL)": [1.0] * n,
+                "LOG MDR1-MDCK ER (B-A/A-B)": [1.0] * n,
+                "LOG RLM_CLint (mL/min/kg)": [1.0] * n,
+            }
+        )
+    )
+    tdc_lipophilicity_az_raw.save(pl.DataFrame({"Drug": SMILES, "Y": [2.0] * n}))
+    return home
+
+
+def test_pipeline_is_incremental(raw_data):
+    run_pipeline(n_workers=1)
+    assert staleness() == {}
+    assert run_pipeline(n_workers=1) == []
+
+    mtimes = {tgt: ds.filepath.stat().st_mtime_ns for tgt, ds in admet_train_combined.items()}
+    # a LogD-only source changes:  only LogD (and the multi-task table built from it) should rebuild
+    tdc_lipophilicity_az_raw.save(pl.DataFrame({"Drug": SMILES, "Y": [3.0] * len(SMILES)}))
+    assert set(staleness()) == {"admet_LogD_train", "admet_multitask_train"}
+    ran = run_pipeline(n_workers=1)
+    assert len(ran) == 2 and "targets=['LogD']" in ran[0] + ran[1]
+    for tgt, ds in admet_train_combined.items():
+        assert (ds.filepath.stat().st_mtime_ns == mtimes[tgt]) == (tgt != "LogD")
+    assert staleness() == {}
+
+    # every target's rows survive a rebuild of just one of them
+    df_report = pl.read_parquet(raw_data / "data" / DEDUP_REPORT)
+    assert set(df_report["target"]) == set(admet_train_combined)
+
+
+def test_imported_code_changes_make_datasets_stale(raw_data, monkeypatch):
+    run_pipeline(n_workers=1)
+    # sources.py (which builds the combined sets) doesn't change, but mol.py, which it uses via the molecule table, does
+    file_hash = io.file_hash
+    monkeypatch.setattr(io, "file_hash", lambda path: "edited" if str(path).endswith("mol.py") else file_hash(path))
+    stale = staleness()
+    assert set(stale) == {ds.name for ds in admet_train_combined.values()} | {"admet_multitask_train"}
+    assert all(reason.startswith("code changed") for reason in stale.values())
+
+
+def test_lost_molecule_table_makes_keyed_datasets_stale(raw_data):
+    run_pipeline(n_workers=1)
+    # the training sets are keyed by mol_id; their SMILES only live in the molecule table
+    molecule_table.filepath.unlink()
+    stale = staleness()
+    assert set(stale) == {ds.name for ds in admet_train_combined.values()} | {"admet_multitask_train"}
+    assert all("mol_ids missing" in reason for reason in stale.values())
+
+    run_pipeline(n_workers=1)
+    assert staleness() == {}
+    assert len(io.scan_table(admet_train_combined["HLM"].filepath).collect()) == len(SMILES)
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from polaris_asap_admet import server
+from polaris_asap_admet.server import (DescriptorCache, LatencyStats, LoadedModel, MicroBatcher,
+                                       ModelRegistry)
+
+
+def _batcher(max_batch: int, max_wait_ms: float):
+    batches = []
+    release = threading.Event()
+
+    def predict_fn(smiles):
+        release.wait(10)
+        batches.append(list(smiles))
+        return [smi.lower() for smi in smiles]
+
+    return MicroBatcher(predict_fn, LatencyStats(), max_batch, max_wait_ms), batches, release
+
+
+def test_micro_batcher_coalesces_concurrent_requests():
+    batcher, batches, release = _batcher(max_batch=5, max_wait_ms=2_000)
+    futures = [batcher.submit([f"A{i}", f"B{i}"]) for i in range(4)]
+    release.set()
+    # each request gets its own molecules back, from batches that stop taking requests at max_batch
+    assert [f.result(10) for f in futures] == [[f"a{i}", f"b{i}"] for i in range(4)]
+    assert batches == [["A0", "B0", "A1", "B1", "A2", "B2"], ["A3", "B3"]]
+    assert batcher.stats.summary()["batches"] == 2
+
+
+def test_micro_batcher_flushes_a_lone_request_after_max_wait():
+    batcher, batches, release = _batcher(max_batch=100, max_wait_ms=50)
+    release.set()
+    start = time.monotonic()
+    assert batcher.submit(["CCO"]).result(10) == ["cco"]
+    assert 0.04 < time.monotonic() - start < 1
+    assert batches == [["CCO"]]
+
+
+def test_micro_batcher_fails_every_request_in_a_failed_batch():
+    batcher = MicroBatcher(lambda smiles: 1 / 0, LatencyStats(), max_batch=10, max_wait_ms=50)
+    futures = [batcher.submit(["CCO"]), batcher.submit(["CCN"])]
+    for future in futures:
+        with pytest.raises(ZeroDivisionError):
+            future.result(10)
+
+
+def test_model_registry_reloads_changed_checkpoints(tmp_path, monkeypatch):
+    loads = []
+
+    def load(target, path, mtime):
+        if path.read_text() == "half-written":
+            raise EOFError
+        loads.append((target, path.read_text()))
+        return LoadedModel(target, path, mtime, model=None, column=0)
+
+    monkeypatch.setattr(ModelRegistry, "_load", staticmethod(load))
+    best = tmp_path / "HLM_20250101_000000" / "model_0" / "best.pt"
+    best.parent.mkdir(parents=True)
+    best.write_text("v1")
+    registry = ModelRegistry(tmp_path)
+
+    assert registry.refresh() == ["HLM"]
+    assert registry.refresh() == []  # nothing changed
+    best.write_text("v2")
+    os.utime(best, (time.time() + 10, time.time() + 10))
+    assert registry.refresh() == ["HLM"]
+    assert loads == [("HLM", "v1"), ("HLM", "v2")]
+
+    # a checkpoint that won't load leaves the old model being served
+    before = registry.snapshot()["HLM"]
+    best.write_text("half-written")
+    os.utime(best, (time.time() + 20, time.time() + 20))
+    assert registry.refresh() == []
+    assert registry.snapshot()["HLM"] is before
+
+
+def test_descriptor_cache_evicts_least_recently_used(monkeypatch):
+    computed = []
+
+    def featurize(smiles):
+        computed.extend(smiles)
+        return np.full((len(smiles), server.N_FEATURES), len(computed), dtype=np.float32)
+
+    monkeypatch.setattr(server, "_featurize_chunk", featurize)
+    monkeypatch.setattr(
+        server.feature_store,
+        "lookup",
+        lambda smiles: (np.full((len(smiles), server.N_FEATURES), np.nan, dtype=np.float32), np.zeros(len(smiles), bool)),
+    )
+    cache = DescriptorCache(max_size=2)
+    cache.get(["CCO", "CCN"])
+    cache.get(["CCO"])  # CCO is now the most recently used, so CCN goes first
+    cache.get(["CCC"])
+    assert list(cache._cache) == ["CCO", "CCC"]
+    assert computed == ["CCO", "CCN", "CCC"]
+
+    X = cache.get(["CCN", "CCO"])
+    assert computed == ["CCO", "CCN", "CCC", "CCN"]  # evicted, so computed again
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert (X[0, 0], X[1, 0]) == (4, 2)  # CCO's row is still the one computed first
+    assert list(cache._cache) == ["CCO", "CCN"]
@@ -0,0 +1,30 @@
+import numpy as np
+from rdkit import Chem, DataStructs
+from rdkit.Chem import rdFingerprintGenerator
+
+from polaris_asap_admet.benchmark import synthetic_smiles
+from polaris_asap_admet.similarity import FP_BITS, FP_RADIUS, FingerprintIndex, fingerprints
+
+
+def test_index_matches_rdkit_bulk_tanimoto(home):
+    # a few thousand rows, so queries prune across several BLOCK_ROWS blocks
+    train = synthetic_smiles(3000, seed=1).to_list()
+    queries = synthetic_smiles(200, seed=2).to_list() + ["not a molecule"]
+    index = FingerprintIndex.build(train, home / "index")
+    sims, rows = index.query(fingerprints(queries), k=5)
+
+    generator = rdFingerprintGenerator.GetMorganGenerator(radius=FP_RADIUS, fpSize=FP_BITS)
+    train_fps = [generator.GetFingerprint(Chem.MolFromSmiles(s)) for s in train]
+    for i, smi in enumerate(queries[:-1]):
+        expected = np.array(DataStructs.BulkTanimotoSimilarity(generator.GetFingerprint(Chem.MolFromSmiles(smi)), train_fps))
+        np.testing.assert_allclose(sims[i], np.sort(expected)[::-1][:5], atol=1e-6)
+        # ties can come back in either order, but every row returned has the similarity given for it
+        np.testing.assert_allclose(expected[rows[i]], sims[i], atol=1e-6)
+    assert np.isnan(sims[-1]).all() and (rows[-1] == -1).all()
+
+
+def test_empty_index_gives_nan(home):
+    index = FingerprintIndex.build([], home / "index")
+    sims, rows = index.query(fingerprints(["CCO", "c1ccccc1N"]), k=5)
+    assert sims.shape == rows.shape == (2, 5)
+    assert np.isnan(sims).all() and (rows == -1).all()
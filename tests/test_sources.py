@@ -0,0 +1,83 @@
+import numpy as np
+import polars as pl
+from rdkit import Chem
+from rdkit.Chem import Descriptors
+
+from polaris_asap_admet.io import computational_adme_raw, tdc_lipophilicity_az_raw
+from polaris_asap_admet.sources import SOURCES, collapse_replicates, compile_source
+
+SMILES = ["CCO", "c1ccccc1N", "CC(=O)Nc1ccc(O)cc1", "OC1CCCCC1"]
+LOG_VALUES = [0.5, 1.0, 1.5, 2.0]
+
+
+def _source(name: str):
+    return next(src for src in SOURCES if src.name == name)
+
+
+def test_computational_adme_units_match_baseline(home):
+    computational_adme_raw.save(
+        pl.DataFrame(
+            {
+                "SMILES": [*SMILES, "not a molecule"],
+                "LOG HLM_CLint (mL/min/kg)": [*LOG_VALUES, 1.0],
+                "LOG SOLUBILITY PH 6.8 (ug/mL)": [*LOG_VALUES, 1.0],
+                "LOG MDR1-MDCK ER (B-A/A-B)": [*LOG_VALUES, 1.0],
+                "LOG RLM_CLint (mL/min/kg)": [*LOG_VALUES, 1.0],
+            }
+        )
+    )
+    df = compile_source(_source("computational_adme")).collect()
+
+    # valid_smiles drops what RDKit can't parse
+    assert df["CXSMILES"].to_list() == SMILES
+    x = np.array(LOG_VALUES)
+    # the baseline's prep_data_*.py conversions, written out
+    clint = 10**x * 1_000 / 800 * 0.5
+    molar_mass_mg_umol = np.array([Descriptors.MolWt(Chem.MolFromSmiles(s)) / 1000 for s in SMILES])
+    np.testing.assert_allclose(df["HLM"], clint)
+    np.testing.assert_allclose(df["MLM"], clint)
+    np.testing.assert_allclose(df["KSOL"], 10**x / (molar_mass_mg_umol * 1e-3))
+    np.testing.assert_allclose(df["MDR1-MDCKII"], np.log10(x) * 1e-6 * 10)
+
+
+def test_tdc_logd_is_taken_as_is(home):
+    tdc_lipophilicity_az_raw.save(pl.DataFrame({"Drug": SMILES, "Y": LOG_VALUES}))
+    df = compile_source(_source("tdc_lipophilicity_az")).collect()
+    assert df.columns == ["CXSMILES", "LogD"]
+    assert df["LogD"].to_list() == LOG_VALUES
+
+
+def _replicates() -> tuple[pl.DataFrame, pl.DataFrame]:
+    # "OCC" and "CCO" are the same molecule; "c1ccccc1N" is measured by both sources
+    df = pl.DataFrame(
+        {
+            "CXSMILES": ["OCC", "c1ccccc1N", "CCCl", "CCO", "c1ccccc1N"],
+            "HLM": [1.0, 2.0, 3.0, 5.0, 6.0],
+            "_source": ["other", "other", "other", "asap", "asap"],
+            "_preferred": [False, False, False, True, True],
+        }
+    )
+    df_keys = pl.DataFrame(
+        {"CXSMILES": ["OCC", "CCO", "c1ccccc1N", "CCCl"], "_key": ["ethanol", "ethanol", "aniline", "chloroethane"]}
+    )
+    return df, df_keys
+
+
+def test_collapse_replicates_mean():
+    df, df_keys = _replicates()
+    df_out, df_report = collapse_replicates(df, "HLM", df_keys, how="mean")
+    # first appearance order; the preferred source's spelling is kept
+    assert df_out.to_dict(as_series=False) == {
+        "CXSMILES": ["CCO", "c1ccccc1N", "CCCl"],
+        "HLM": [3.0, 4.0, 3.0],
+    }
+    report = {row["source"]: row for row in df_report.iter_rows(named=True)}
+    assert (report["other"]["rows_in"], report["other"]["rows_out"], report["other"]["collapsed"]) == (3, 1, 2)
+    assert (report["asap"]["rows_in"], report["asap"]["rows_out"], report["asap"]["collapsed"]) == (2, 2, 0)
+
+
+def test_collapse_replicates_asap_wins_and_median():
+    df, df_keys = _replicates()
+    assert collapse_replicates(df, "HLM", df_keys, how="asap_wins")[0]["HLM"].to_list() == [5.0, 6.0, 3.0]
+    df = pl.concat([df, df.head(1).with_columns(HLM=pl.lit(10.0))])
+    assert collapse_replicates(df, "HLM", df_keys, how="median")[0]["HLM"].to_list() == [5.0, 4.0, 3.0]
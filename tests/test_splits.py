@@ -0,0 +1,30 @@
+import numpy as np
+
+from polaris_asap_admet.splits import assign_clusters
+
+
+def test_assign_clusters_sizes():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 100, size=1000)
+    train, val, test = assign_clusters(labels, (0.8, 0.1, 0.1), seed=1)
+
+    assert sorted(train + val + test) == list(range(len(labels)))
+    # val and test never go over their share, and small clusters fill them up to within one cluster of it
+    biggest = np.bincount(labels).max()
+    for rows, share in [(val, 0.1), (test, 0.1)]:
+        assert len(labels) * share - biggest < len(rows) <= len(labels) * share
+    # no cluster is split
+    split_of = {}
+    for s, rows in enumerate([train, val, test]):
+        for label in labels[rows]:
+            assert split_of.setdefault(label, s) == s
+
+    assert assign_clusters(labels, (0.8, 0.1, 0.1), seed=1) == (train, val, test)
+
+
+def test_assign_clusters_never_leaves_val_or_test_empty():
+    # every cluster is bigger than val's or test's share; each still gets the smallest one
+    labels = np.repeat([0, 1, 2, 3], [40, 30, 20, 10])
+    train, val, test = assign_clusters(labels, (0.9, 0.05, 0.05))
+    assert {len(val), len(test)} == {10, 20}
+    assert len(train) == 70